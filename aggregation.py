@@ -0,0 +1,283 @@
+import argparse
+import math
+
+import numpy as np
+
+"""
+Sliding-window aggregation of a series of samples over days.
+
+Samples are bucketed by floor(day) once, into a count, a sum and a sum of squared deviations per day. The windowed
+count, mean and standard deviation of every day are then combined from those buckets, and percentiles from a slice of
+the day-sorted samples, so the cost no longer grows with days x samples.
+"""
+
+"""
+The aggregates accepted by --agg. Percentiles are written as p<q>, for example p90.
+"""
+AGGREGATES = ["mean", "median", "p<q>"]
+
+
+def parse_aggregate(text):
+    """
+    Validate an --agg value.
+    :param text: mean, median or p<q> with 0 <= q <= 100
+    :return: The value, normalised to lower case
+    """
+    text = text.lower()
+    if text in ("mean", "median"):
+        return text
+    if text.startswith("p"):
+        try:
+            q = float(text[1:])
+        except ValueError:
+            q = -1
+        if 0 <= q <= 100:
+            return text
+    raise argparse.ArgumentTypeError("expected one of " + ', '.join(AGGREGATES) + ", got '" + text + "'")
+
+
+def aggregate_percentile(agg):
+    """
+    :param agg: A value accepted by parse_aggregate
+    :return: The percentile that the aggregate represents, or None for the mean
+    """
+    if agg == "mean":
+        return None
+    if agg == "median":
+        return 50
+    return float(agg[1:])
+
+
+def aggregate_name(agg):
+    """
+    :param agg: A value accepted by parse_aggregate
+    :return: A human-readable name for the aggregate
+    """
+    if agg in ("mean", "median"):
+        return agg
+    return agg[1:] + "th percentile"
+
+
+class DayBuckets:
+    """
+    Per-day totals of one series: the number of samples, their sum and their sum of squared deviations from the mean
+    of the day, for each floor(day).
+    """
+    def __init__(self):
+        """
+        The day of the first bucket; bucket i holds the samples of day first_day + i.
+        """
+        self.first_day = 0
+        """
+        The number of samples, their sum and their sum of squared deviations from the day's mean, per day. Keeping the
+        squares relative to each day's mean avoids the cancellation of a plain sum of squares, so a window holding a
+        single sample still has a standard deviation of exactly 0.
+        """
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0)
+        self.squares = np.zeros(0)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def last_day(self):
+        return self.first_day + len(self.counts) - 1
+
+    def means(self):
+        """
+        :return: The mean of each day, or 0 for days without samples
+        """
+        return self.sums / np.maximum(self.counts, 1)
+
+    def add(self, days, values):
+        """
+        Add samples to the buckets.
+        :param days: The day of each sample, rounded down
+        :param values: The value of each sample
+        :return: None
+        """
+        if len(days) == 0:
+            return
+        days = np.asarray(days, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        self.grow(int(days.min()), int(days.max()))
+        index = days - self.first_day
+        counts = np.bincount(index, minlength=len(self.counts))
+        sums = np.bincount(index, weights=values, minlength=len(self.counts))
+        means = sums / np.maximum(counts, 1)
+        squares = np.bincount(index, weights=(values - means[index]) ** 2, minlength=len(self.counts))
+        self.merge(counts, sums, squares)
+
+    def count(self, days):
+        """
+        Add samples that have no value, such as missing ones, to the counts of the buckets.
+        :param days: The day of each sample, rounded down
+        :return: None
+        """
+        if len(days) == 0:
+            return
+        days = np.asarray(days, dtype=np.int64)
+        self.grow(int(days.min()), int(days.max()))
+        self.counts = self.counts + np.bincount(days - self.first_day, minlength=len(self.counts))
+
+    def merge(self, counts, sums, squares):
+        """
+        Combine per-day totals covering the same days into the buckets, with the pairwise update of Chan et al. for
+        the squared deviations.
+        """
+        total = self.counts + counts
+        delta = sums / np.maximum(counts, 1) - self.means()
+        self.squares = self.squares + squares + delta ** 2 * self.counts * counts / np.maximum(total, 1)
+        self.sums = self.sums + sums
+        self.counts = total
+
+    def grow(self, first_day, last_day):
+        """
+        Extend the buckets so that they cover the given days.
+        """
+        if len(self.counts) == 0:
+            self.first_day = first_day
+        before = max(self.first_day - first_day, 0)
+        after = max(last_day - self.last_day, 0)
+        if before or after:
+            self.counts = np.pad(self.counts, (before, after))
+            self.sums = np.pad(self.sums, (before, after))
+            self.squares = np.pad(self.squares, (before, after))
+            self.first_day -= before
+
+    def window(self, window, last_day=None):
+        """
+        Aggregate the buckets with a sliding window. For each day from 0 to last_day, the window holds the samples
+        whose day is within window / 2 days of it. The buckets of each window are added up directly, which costs
+        O(days x min(window, len(self))) rather than the O(days) of differencing prefix sums, in exchange for sums that
+        do not depend on the days before the window.
+        :param window: The width of the window, in days
+        :param last_day: The last day to aggregate; defaults to the last day with samples
+        :return: The days that have at least one sample in their window, and for each of them the number of samples,
+        the mean and the standard deviation
+        """
+        if last_day is None:
+            last_day = self.last_day
+        half = math.floor(window / 2)
+        days = np.arange(0, last_day + 1) if half >= 0 else np.zeros(0, dtype=np.int64)
+        lo = np.clip(days - half - self.first_day, 0, len(self.counts))
+        hi = np.clip(days + half + 1 - self.first_day, 0, len(self.counts))
+        counts = prefix_sum(self.counts)
+        counts = counts[hi] - counts[lo]
+        keep = counts > 0
+        days, lo, hi, counts = days[keep], lo[keep], hi[keep], counts[keep]
+        # sum the buckets of each window directly rather than differencing float prefix sums, which would lose the
+        # low bits of small windows next to a large running total, even when compensated, and would no longer give a
+        # window holding a single sample a standard deviation of exactly 0; this touches days x window buckets, not
+        # samples, and only the offsets that reach a bucket from some day
+        offsets = range(0)
+        if len(days):
+            offsets = range(max(-half, self.first_day - int(days[-1])), min(half, self.last_day - int(days[0])) + 1)
+        sums = np.zeros(len(days))
+        for offset in offsets:
+            index, inside = self.window_index(days, offset)
+            sums[inside] += self.sums[index]
+        means = sums / counts
+        # the squared deviations of a window are those of each day plus the spread of the day means around the window
+        # mean
+        day_means = self.means()
+        squares = np.zeros(len(days))
+        for offset in offsets:
+            index, inside = self.window_index(days, offset)
+            squares[inside] += self.squares[index] + self.counts[index] * (day_means[index] - means[inside]) ** 2
+        return days, counts, means, np.sqrt(squares / counts)
+
+    def window_counts(self, days, window):
+        """
+        :param days: The days to look up
+        :param window: The width of the window, in days
+        :return: The number of samples in the window of each of days, the same window as in window()
+        """
+        half = math.floor(window / 2)
+        lo = np.clip(days - half - self.first_day, 0, len(self.counts))
+        hi = np.clip(days + half + 1 - self.first_day, 0, len(self.counts))
+        counts = prefix_sum(self.counts)
+        return counts[hi] - counts[lo]
+
+    def window_index(self, days, offset):
+        """
+        :return: For each of days, the bucket offset days away, and a mask of the days for which it exists
+        """
+        index = days + offset - self.first_day
+        inside = (index >= 0) & (index < len(self.counts))
+        return index[inside], inside
+
+
+def completeness(present, missing):
+    """
+    Summarize how complete a series is.
+    :param present: The DayBuckets of the samples that have a value
+    :param missing: The DayBuckets of the samples whose value is missing
+    :return: A dict with the number of samples, of present and of missing values, the percentage of samples that have a
+    value (None without samples), the number of days with a sample and the number of days with a value
+    """
+    nonempty = [buckets for buckets in (present, missing) if len(buckets)]
+    days = 0
+    if nonempty:
+        first_day = min(buckets.first_day for buckets in nonempty)
+        sampled = np.zeros(max(buckets.last_day for buckets in nonempty) - first_day + 1, dtype=np.int64)
+        for buckets in nonempty:
+            sampled[buckets.first_day - first_day:buckets.last_day - first_day + 1] += buckets.counts
+        days = int(np.count_nonzero(sampled))
+    count_present = int(present.counts.sum())
+    count_missing = int(missing.counts.sum())
+    samples = count_present + count_missing
+    return {"samples": samples, "present": count_present, "missing": count_missing,
+            "percent_complete": 100 * count_present / samples if samples else None,
+            "days": days, "days_with_value": int(np.count_nonzero(present.counts))}
+
+
+def prefix_sum(values):
+    """
+    :return: The running totals of values, starting with 0, so the sum of values[a:b] is result[b] - result[a]
+    """
+    return np.concatenate(([0], np.cumsum(values)))
+
+
+def window_percentiles(days, values, window_days, window, q):
+    """
+    Compute a percentile of the samples in each window.
+    :param days: The day of each sample, rounded down and sorted
+    :param values: The value of each sample, in the same order
+    :param window_days: The days to aggregate
+    :param window: The width of the window, in days
+    :param q: The percentile, between 0 and 100
+    :return: The percentile for each of window_days; every window must hold at least one sample
+    """
+    half = math.floor(window / 2)
+    lo = np.searchsorted(days, window_days - half, side='left')
+    hi = np.searchsorted(days, window_days + half, side='right')
+    return np.array([np.percentile(values[a:b], q) for a, b in zip(lo, hi)])
+
+
+def window_aggregate(x, y, window, agg="mean"):
+    """
+    Aggregate a series with a sliding window over days.
+    :param x: The day of each sample, sorted
+    :param y: The value of each sample, in the same order
+    :param window: The width of the window, in days
+    :param agg: A value accepted by parse_aggregate
+    :return: The days that have samples in their window, and for each of them the number of samples, the aggregate
+    and the standard deviation; samples whose x is NaN or infinite have no day and are left out
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # flooring NaN to an integer gives the smallest int64, and the buckets would then span every day since
+    finite = np.isfinite(x)
+    x, y = x[finite], y[finite]
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    days = np.floor(x).astype(np.int64)
+    buckets = DayBuckets()
+    buckets.add(days, y)
+    window_days, counts, values, std = buckets.window(window, int(days.max()))
+    q = aggregate_percentile(agg)
+    if q is not None:
+        values = window_percentiles(days, y, window_days, window, q)
+    return window_days, counts, values, std
@@ -0,0 +1,349 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows; the peak RSS is then not recorded
+    resource = None
+
+"""
+Times each stage of SeatReader on generated datasets of several sizes, and compares the results with a baseline.
+
+Each dataset is made once with generator.py, with a fixed seed, and kept in the data directory. Every scale runs in a
+fresh process, so its peak RSS is its own. The stages run once for the timings, then once more under tracemalloc for the
+peak memory of each stage, since tracemalloc slows Python code down. The cold start of a run that only saves a CSV
+file is timed separately, in fresh interpreters, since that is what a cron job pays on every call.
+"""
+
+"""
+The datasets: the number of rows and of SUIs of each scale. The number of SUIs stays small, so the PDF takes about as
+long at every scale and the other stages show how they grow with the rows.
+"""
+SCALES = {
+    "small": {"rows": 10_000, "suis": 10},
+    "medium": {"rows": 100_000, "suis": 10},
+    "large": {"rows": 1_000_000, "suis": 10},
+}
+"""
+The stages of SeatReader.run, in order.
+"""
+STAGES = ["read_table", "get_vars", "get_sui_list", "check_args", "get_data", "condense_data", "save_csv_file",
+          "show_graph"]
+"""
+The variables graphed, the seed and end date the datasets are generated with, and the version of the results file.
+"""
+GRAPH_VARS = ["clinical.hr", "clinical.hrv", "clinical.qtc"]
+SEED = 0
+END_DATE = "2022-06-01"
+RESULTS_VERSION = 1
+"""
+A stage is a regression when it is slower than its baseline by more than the tolerance, and by more than MIN_SECONDS or
+MIN_BYTES, so that the noise of very short stages is not reported.
+"""
+DEFAULT_TOLERANCE = 0.2
+MIN_SECONDS = 0.05
+MIN_BYTES = 1 << 20
+"""
+A run of main.py that only saves a CSV file of the small dataset should finish within this many seconds, imports
+included; the median of COLD_START_RUNS runs is kept.
+"""
+COLD_START_TARGET_S = 0.5
+COLD_START_RUNS = 5
+
+
+def generate_dataset(data_dir, scale):
+    """
+    Generate the csv file of a scale with generator.py, unless it was already generated.
+    :param data_dir: The directory of the datasets
+    :param scale: The name of the scale
+    :return: The path of the csv file
+    """
+    size = SCALES[scale]
+    path = os.path.abspath(os.path.join(data_dir, scale + "-" + str(size["rows"]) + "-" + str(size["suis"]) + ".csv"))
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generator.py")
+        subprocess.run([sys.executable, generator, path, "--rows", str(size["rows"]), "--suis", str(size["suis"]),
+                        "--seed", str(SEED), "--end-date", END_DATE, "-y"], check=True, stdout=subprocess.DEVNULL)
+    return path
+
+
+def max_rss():
+    """
+    :return: The peak resident set size of this process in bytes, or None if it is not known
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_stages(argv, stages, trace):
+    """
+    Run the stages of a SeatReader one at a time, timing each.
+    :param argv: The command line arguments of the SeatReader
+    :param stages: The stages to run, in the order of STAGES
+    :param trace: When true, measure the peak memory allocated in each stage with tracemalloc instead of the times
+    :return: For each stage, its wall and CPU time in seconds, or its peak traced memory in bytes
+    """
+    from main import SeatReader
+
+    results = {}
+    reader = SeatReader(argv, run=False)
+    if trace:
+        tracemalloc.start()
+    for stage in stages:
+        if trace:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+        wall, cpu = time.perf_counter(), time.process_time()
+        getattr(reader, stage)()
+        if trace:
+            results[stage] = {"peak_bytes": tracemalloc.get_traced_memory()[1] - start}
+        else:
+            results[stage] = {"seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu}
+    if trace:
+        tracemalloc.stop()
+    return results
+
+
+def benchmark_scale(filename, repeat, memory, pdf_backend, skip_pdf):
+    """
+    Benchmark every stage on one dataset. Runs in a fresh process for each scale.
+    :param filename: The csv file
+    :param repeat: The number of timed runs; the median time of each stage is kept
+    :param memory: When true, the stages also run once under tracemalloc
+    :param pdf_backend: The --pdf-backend of the PDF
+    :param skip_pdf: When true, no PDF is saved, and show_graph is not run
+    :return: The results of the scale
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+
+    runs = []
+    peaks = None
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        # the raster backend writes its temporary images to the working directory
+        os.chdir(directory)
+        argv = [filename, "-s", "*", "-v"] + GRAPH_VARS + ["--no-input", "1", "--no-cache",
+                                                           "--save-csv", os.path.join(directory, "out.csv"),
+                                                           "--pdf-backend", pdf_backend]
+        if skip_pdf:
+            argv += ["--no-graph"]
+        else:
+            argv += ["--save", os.path.join(directory, "out.pdf")]
+        # without --save, show_graph would open an interactive figure for every series
+        stages = [stage for stage in STAGES if not (skip_pdf and stage == "show_graph")]
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            for _ in range(repeat):
+                runs.append(run_stages(argv, stages, False))
+            if memory:
+                peaks = run_stages(argv, stages, True)
+        output_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    results = {}
+    for stage in stages:
+        results[stage] = {
+            "seconds": float(np.median([run[stage]["seconds"] for run in runs])),
+            "cpu_seconds": float(np.median([run[stage]["cpu_seconds"] for run in runs])),
+        }
+        if peaks is not None:
+            results[stage]["peak_bytes"] = peaks[stage]["peak_bytes"]
+    return {
+        "file_bytes": os.path.getsize(filename),
+        "output_bytes": output_bytes,
+        "max_rss_bytes": max_rss(),
+        "total_seconds": sum(stage["seconds"] for stage in results.values()),
+        "stages": results,
+    }
+
+
+def cold_start(filename, runs):
+    """
+    Time runs of main.py that only save a CSV file, and imports of main.py alone, each in a fresh interpreter.
+    :param filename: The csv file; its cache is written by a first run that is not timed, as a cron job would find it
+    :param runs: The number of timed runs of each
+    :return: The median wall times, in seconds, and the target of the CSV-only run
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as output_dir:
+        commands = {
+            "import_seconds": [sys.executable, "-c", "import main"],
+            "csv_only_seconds": [sys.executable, os.path.join(directory, "main.py"), filename, "-s", "*", "-v"] +
+                                GRAPH_VARS + ["--no-input", "1", "--no-graph", "--save-csv",
+                                              os.path.join(output_dir, "out.csv")],
+        }
+        subprocess.run(commands["csv_only_seconds"], check=True, cwd=directory, stdout=subprocess.DEVNULL)
+        result = {}
+        for key, command in commands.items():
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(command, check=True, cwd=directory, stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            result[key] = float(np.median(times))
+    result["target_seconds"] = COLD_START_TARGET_S
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline, stage by stage, and print what changed.
+    :param results: The results of this run
+    :param baseline: The results of the baseline run
+    :param tolerance: The relative slowdown, or growth in memory, above which a stage is a regression
+    :return: The regressions, as strings
+    """
+    regressions = []
+    print("scale/stage                        baseline       now    change")
+    for scale, result in results["scales"].items():
+        if scale not in baseline.get("scales", {}):
+            print(scale + ": not in the baseline")
+            continue
+        old_stages = baseline["scales"][scale]["stages"]
+        for stage, values in result["stages"].items():
+            if stage not in old_stages:
+                continue
+            for key, unit, minimum in (("seconds", "s", MIN_SECONDS), ("peak_bytes", "B", MIN_BYTES)):
+                if key not in values or key not in old_stages[stage]:
+                    continue
+                old, new = old_stages[stage][key], values[key]
+                change = (new - old) / old if old else 0.0
+                flag = ""
+                if new - old > minimum and change > tolerance:
+                    flag = "  REGRESSION"
+                    regressions.append(scale + "/" + stage + " " + key + ": " + format_value(old, unit) + " -> " +
+                                       format_value(new, unit))
+                print((scale + "/" + stage + " " + key).ljust(32) + format_value(old, unit).rjust(10) +
+                      format_value(new, unit).rjust(10) + ("%+.0f%%" % (change * 100)).rjust(10) + flag)
+    if "cold_start" in results and "cold_start" in baseline:
+        for key in ("import_seconds", "csv_only_seconds"):
+            old, new = baseline["cold_start"][key], results["cold_start"][key]
+            change = (new - old) / old if old else 0.0
+            flag = ""
+            if new - old > MIN_SECONDS and change > tolerance:
+                flag = "  REGRESSION"
+                regressions.append("cold start " + key + ": " + format_value(old, "s") + " -> " +
+                                   format_value(new, "s"))
+            print(("cold start " + key).ljust(32) + format_value(old, "s").rjust(10) +
+                  format_value(new, "s").rjust(10) + ("%+.0f%%" % (change * 100)).rjust(10) + flag)
+    return regressions
+
+
+def format_value(value, unit):
+    if unit == "B":
+        return str(round(value / (1 << 20), 1)) + "MB"
+    return str(round(value, 3)) + unit
+
+
+def main(argv=None):
+    """
+    Benchmark SeatReader as asked on the command line.
+    :param argv: The command line arguments, or None to use sys.argv
+    :return: The exit status; 1 if a regression was found against the baseline, or the cold start is over its target
+    """
+    parser = argparse.ArgumentParser(description="Times each stage of SeatReader on generated datasets.")
+    parser.add_argument("output_file", help="The JSON file to write the results to.")
+    parser.add_argument("--scales", nargs='+', choices=list(SCALES), default=list(SCALES),
+                        help="The datasets to run on (default: all)")
+    parser.add_argument("--data-dir", default="benchmark_data", help="The directory where the generated datasets are "
+                                                                     "kept between runs")
+    parser.add_argument("--repeat", type=int, default=1, help="The number of timed runs of each scale; the median is "
+                                                              "kept")
+    parser.add_argument("--no-memory", action="store_true", help="Do not measure the memory of each stage with "
+                                                                 "tracemalloc")
+    parser.add_argument("--pdf-backend", choices=["raster", "vector"], default="raster",
+                        help="The --pdf-backend used by show_graph")
+    parser.add_argument("--skip-pdf", action="store_true", help="Do not save a PDF, and leave out show_graph")
+    parser.add_argument("--no-cold-start", action="store_true", help="Do not time the cold start of a run that only "
+                                                                     "saves a CSV file")
+    parser.add_argument("--compare", metavar="BASELINE", help="A results file to compare with; the exit status is 1 "
+                                                              "if a stage or the cold start got slower, or a stage "
+                                                              "uses more memory")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="With --compare, the relative change above which a stage is a regression (default "
+                             "0.2)")
+    arguments = parser.parse_args(argv)
+    if arguments.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("version") != RESULTS_VERSION:
+            parser.error(arguments.compare + " is not a results file of this version")
+
+    results = {
+        "version": RESULTS_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scales": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for scale in arguments.scales:
+        filename = generate_dataset(arguments.data_dir, scale)
+        print("Running " + scale + " (" + str(SCALES[scale]["rows"]) + " rows)...")
+        pool = context.Pool(1)
+        try:
+            result = pool.apply(benchmark_scale, (filename, arguments.repeat, not arguments.no_memory,
+                                                  arguments.pdf_backend, arguments.skip_pdf))
+        finally:
+            # let the worker exit by itself, so it cleans up after itself
+            pool.close()
+            pool.join()
+        results["scales"][scale] = dict(SCALES[scale], **result)
+        for stage, values in result["stages"].items():
+            print("  " + stage.ljust(16) + format_value(values["seconds"], "s").rjust(10) +
+                  (format_value(values["peak_bytes"], "B").rjust(10) if "peak_bytes" in values else ""))
+        if result["max_rss_bytes"] is not None:
+            print("  peak RSS".ljust(18) + format_value(result["max_rss_bytes"], "B").rjust(10))
+
+    over_target = False
+    if not arguments.no_cold_start:
+        print("Timing the cold start of a CSV-only run...")
+        results["cold_start"] = cold_start(generate_dataset(arguments.data_dir, "small"), COLD_START_RUNS)
+        over_target = results["cold_start"]["csv_only_seconds"] > COLD_START_TARGET_S
+        print("  import main".ljust(18) + format_value(results["cold_start"]["import_seconds"], "s").rjust(10))
+        print("  CSV-only run".ljust(18) + format_value(results["cold_start"]["csv_only_seconds"], "s").rjust(10) +
+              ("  OVER THE " if over_target else "  within the ") + format_value(COLD_START_TARGET_S, "s") + " target")
+
+    with open(arguments.output_file, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if baseline is None:
+        return 1 if over_target else 0
+    print()
+    regressions = compare(results, baseline, arguments.tolerance)
+    if over_target:
+        regressions.append("cold start csv_only_seconds: " + format_value(results["cold_start"]["csv_only_seconds"],
+                                                                         "s") +
+                           " is over the " + format_value(COLD_START_TARGET_S, "s") + " target")
+    if regressions:
+        print("\n" + str(len(regressions)) + " regression" + ("s" if len(regressions) > 1 else "") + ":")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
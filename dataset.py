@@ -0,0 +1,254 @@
+import numpy as np
+
+from aggregation import DayBuckets, completeness, window_aggregate
+from seat_table import TIMESTAMP_VARS
+import table_cache
+
+"""
+A library API over the seat .csv files: a SeatDataset is loaded once and keeps its columns in memory, and each call to
+aggregate answers one query against them, without reading the files again or asking anything on standard input.
+
+    dataset = SeatDataset.load("data.csv")
+    result = dataset.aggregate(["*"], ["clinical.hr"], window=3)
+    result.x["1234_5"]["clinical.hr"], result.y["1234_5"]["clinical.hr"]
+
+The command line program (main.py) is a wrapper over the same calls.
+"""
+
+
+class Aggregates:
+    """
+    The result of a query: for each SUI and variable, the lists that SeatReader graphs. Before condense, x and y are the
+    samples; after it, x and y hold one aggregate per day, std its standard deviation and missing the share of the
+    samples in the day's window that are missing, times the aggregate.
+    """
+    def __init__(self, suis, variables):
+        """
+        The SUI's and variables of the query, in order.
+        """
+        self.suis = list(suis)
+        self.vars = list(variables)
+        """
+        The series of the query, by SUI, then by variable.
+        """
+        self.x = {sui: {var: [] for var in variables} for sui in suis}
+        self.y = {sui: {var: [] for var in variables} for sui in suis}
+        self.std = {sui: {var: [] for var in variables} for sui in suis}
+        self.missing = {sui: {var: [] for var in variables} for sui in suis}
+        """
+        The values of each series against the duration of the samples.
+        """
+        self.duration_x = {sui: {var: [] for var in variables} for sui in suis}
+        self.duration_y = {sui: {var: [] for var in variables} for sui in suis}
+        """
+        The number of samples of each series on each day, with a value and without one, counted by samples.
+        """
+        self.present_days = {sui: {var: DayBuckets() for var in variables} for sui in suis}
+        self.missing_days = {sui: {var: DayBuckets() for var in variables} for sui in suis}
+        """
+        The durations of the samples of each SUI, and of all of them under 'Combined'.
+        """
+        self.general_durations = {"Combined": []}
+        for sui in suis:
+            self.general_durations[sui] = []
+
+    def to_dict(self):
+        """
+        :return: The condensed series as plain lists, by SUI then variable, for JSON
+        """
+        return {sui: {var: {"day": self.x[sui][var], "value": self.y[sui][var], "std": self.std[sui][var],
+                            "missing": self.missing[sui][var]} for var in self.vars} for sui in self.suis}
+
+    def completeness(self):
+        """
+        :return: How complete each series is, by SUI then variable, as aggregation.completeness reports it
+        """
+        return {sui: {var: completeness(self.present_days[sui][var], self.missing_days[sui][var])
+                      for var in self.vars} for sui in self.suis}
+
+
+class SeatDataset:
+    """
+    The contents of one or more seat .csv files, loaded once for any number of queries.
+    """
+    def __init__(self, table, filenames=()):
+        """
+        The column-oriented table of the files, and their names.
+        """
+        self.table = table
+        self.filenames = list(filenames)
+        """
+        The rows of each SUI, and the horizontal axis values of each variable, computed on first use.
+        """
+        self.sui_rows = None
+        self.x_columns = {}
+
+    @classmethod
+    def load(cls, paths, identifying_var="clinical.sui", use_cache=True, rebuild_cache=False, jobs=1):
+        """
+        Read seat .csv files, or map them in from their caches.
+        :param paths: A path or a list of paths: .csv files, glob patterns or directories of .csv files
+        :param identifying_var: The variable that is unique for each user
+        :param use_cache: When true, the parsed files are read from and saved to a cache next to them
+        :param rebuild_cache: When true, the caches are rewritten even if they are up to date
+        :param jobs: The number of processes parsing several files
+        :return: The SeatDataset
+        """
+        filenames = table_cache.find_input_files([paths] if isinstance(paths, str) else paths)
+        return cls(table_cache.read_tables(filenames, identifying_var, use_cache, rebuild_cache, jobs), filenames)
+
+    @property
+    def vars(self):
+        return list(self.table.vars)
+
+    @property
+    def sui_list(self):
+        return list(self.table.sui_list)
+
+    def sui_prefix(self):
+        """
+        :return: The common prefix among every SUI, which may be left out of the SUI's of a query
+        """
+        prefix = self.table.sui_list[0] if len(self.table.sui_list) else ""
+        for sui in self.table.sui_list:
+            while sui[:len(prefix)] != prefix:
+                prefix = prefix[:-1]
+        return prefix
+
+    def resolve_suis(self, suis):
+        """
+        Expand the SUI's of a query: "*" or "all" stand for every SUI, and a SUI that is not found is tried with the
+        common prefix.
+        :param suis: The SUI's as given
+        :return: The SUI's
+        """
+        resolved = []
+        for sui in suis:
+            if sui in ("*", "all"):
+                return self.sui_list
+            if sui not in self.table.sui_list:
+                sui = self.sui_prefix() + sui
+            resolved.append(sui)
+        return resolved
+
+    def sui_starts(self, x):
+        """
+        :param x: The variable on the horizontal axis
+        :return: The earliest value of x for each SUI, or an empty dict if x is not a column other than the SUI
+        """
+        if x in self.table.vars and x != self.table.identifying_var:
+            return self.table.sui_minimum(x)
+        return {}
+
+    def x_column(self, x):
+        """
+        :param x: The variable on the horizontal axis
+        :return: Its value in every row; timestamps are in days after the first sample of the row's SUI
+        """
+        if x not in self.x_columns:
+            values = self.table.column(x)
+            if x in TIMESTAMP_VARS:
+                starts = self.sui_starts(x)
+                starts = np.array([starts.get(sui, 0) for sui in self.table.sui_list], dtype=np.int64)
+                values = (values - starts[self.table.sui_codes]) / (60 * 60 * 24)
+            self.x_columns[x] = values
+        return self.x_columns[x]
+
+    def samples(self, suis, variables, x="clinical.timestamp", min_duration=3, hrv_min_duration=60):
+        """
+        Collect the samples of each SUI and variable, sorted by x.
+        :param suis: The SUI's, as resolved by resolve_suis; those not in the files have empty series
+        :param variables: The variables
+        :param x: The variable on the horizontal axis
+        :param min_duration: Samples with a duration less than this, in seconds, are left out
+        :param hrv_min_duration: Samples of clinical.hrv with a duration less than this are left out
+        :return: The Aggregates, with the samples in x and y
+        """
+        table = self.table
+        result = Aggregates(suis, variables)
+        duration = table.column('clinical.duration')
+        x_values = self.x_column(x)
+        if self.sui_rows is None:
+            self.sui_rows = table.sui_rows()
+
+        for sui in dict.fromkeys(suis):
+            if sui not in table.sui_list:
+                continue
+            rows = self.sui_rows[table.sui_list.index(sui)]
+            rows = rows[duration[rows] >= min_duration]
+            result.general_durations["Combined"].extend(duration[rows].tolist())
+            result.general_durations[sui].extend(duration[rows].tolist())
+            for var in variables:
+                var_rows = rows
+                if var == 'clinical.hrv':
+                    var_rows = rows[duration[rows] >= hrv_min_duration]
+                valid = table.valid[var][var_rows]
+                present = var_rows[valid]
+                x_present = x_values[present]
+                result.present_days[sui][var].count(whole_days(x_present))
+                result.missing_days[sui][var].count(whole_days(x_values[var_rows[~valid]]))
+                if len(present) > 0:
+                    y = table.column(var)[present]
+                    d = duration[present]
+                    order = np.lexsort((y, x_present))
+                    result.x[sui][var] = x_present[order].tolist()
+                    result.y[sui][var] = y[order].tolist()
+                    order = np.lexsort((y, d))
+                    result.duration_x[sui][var] = d[order].tolist()
+                    result.duration_y[sui][var] = y[order].tolist()
+        return result
+
+    @staticmethod
+    def condense(result, window=1, agg="mean", show_missing=False):
+        """
+        Replace the samples of each series by one aggregate per day, over a sliding window of days.
+        :param result: The Aggregates from samples; it is updated in place
+        :param window: For each day, values within this number of days are included
+        :param agg: How the values in each window are combined: mean, median or p<q> for the q-th percentile
+        :param show_missing: When true, the missing share of each day's window is filled in; otherwise it is 0
+        :return: The Aggregates
+        """
+        for sui in result.suis:
+            for var in result.vars:
+                if len(result.x[sui][var]) == 0:
+                    continue
+                days, counts, values, std = window_aggregate(result.x[sui][var], result.y[sui][var], window, agg)
+                count_missing = np.zeros(len(days), dtype=np.int64)
+                if show_missing:
+                    count_missing = result.missing_days[sui][var].window_counts(days, window)
+                result.x[sui][var] = days.tolist()
+                result.y[sui][var] = values.tolist()
+                result.std[sui][var] = std.tolist()
+                result.missing[sui][var] = (count_missing / (count_missing + counts) * values).tolist()
+        return result
+
+    def aggregate(self, suis, variables, x="clinical.timestamp", window=1, min_duration=3, hrv_min_duration=60,
+                  agg="mean", show_missing=False):
+        """
+        Answer one query: the per-day aggregates of each SUI and variable.
+        :param suis: The SUI's; "*" stands for every SUI, and the common prefix may be left out
+        :param variables: The variables
+        :param x: The variable on the horizontal axis
+        :param window: For each day, values within this number of days are included
+        :param min_duration: Samples with a duration less than this, in seconds, are left out
+        :param hrv_min_duration: Samples of clinical.hrv with a duration less than this are left out
+        :param agg: How the values in each window are combined: mean, median or p<q> for the q-th percentile
+        :param show_missing: When true, the missing share of each day's window is filled in
+        :return: The Aggregates
+        :raises ValueError: if a variable is not in the files
+        """
+        for var in list(variables) + [x]:
+            if var not in self.table.vars:
+                raise ValueError("Variable " + var + " not found in input file.")
+        result = self.samples(self.resolve_suis(suis), variables, x, min_duration, hrv_min_duration)
+        return self.condense(result, window, agg, show_missing)
+
+
+def whole_days(x):
+    """
+    :param x: Values of the horizontal axis
+    :return: The values rounded down to whole days, leaving out those that are NaN, infinite or not numbers
+    """
+    if not np.issubdtype(x.dtype, np.number):
+        return np.zeros(0, dtype=np.int64)
+    return np.floor(x[np.isfinite(x)])
@@ -0,0 +1,342 @@
+import argparse
+import contextlib
+import csv
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import json_to_ecg_csv
+
+"""
+Beat detection on the "ecg" channel of seat recordings, in the spirit of Pan and Tompkins: the signal is band-passed,
+differentiated, squared and integrated into an energy envelope, and R-peaks are the envelope maxima that stand above an
+adaptive threshold and are the largest within a refractory period. Every step is an array operation over the whole
+recording.
+
+Run as a script, it reads JSON recordings (or binary waveform files from json_to_ecg_csv --format binary) and writes
+one CSV row per recording with its SUI and timestamp, so the results can be joined to the seat .csv export.
+"""
+
+"""
+The pass band of the filter, in Hz. Most of the energy of the QRS complex is in this band. The R-peak is then placed on
+the signal filtered with the wider REFINE_BAND_HZ, which keeps the shape of the QRS complex but not the baseline wander.
+"""
+BAND_HZ = (5.0, 15.0)
+REFINE_BAND_HZ = (0.5, 40.0)
+"""
+The width of the integration window, the refractory period after a beat and the half-width of the window searched for
+the R-peak around an envelope maximum, in seconds.
+"""
+INTEGRATION_S = 0.15
+REFRACTORY_S = 0.25
+SEARCH_S = 0.075
+"""
+The adaptive threshold: this fraction of the largest envelope value within THRESHOLD_WINDOW_S / 2 seconds.
+"""
+THRESHOLD_FRACTION = 0.3
+THRESHOLD_WINDOW_S = 4.0
+"""
+The noise floor: a candidate must also rise above this multiple of the median of the envelope, which is set by the
+noise between the beats. A recording where fewer than MIN_ABOVE_FLOOR of the candidates do has no beats, since the
+threshold above only picked the largest bumps of noise.
+"""
+NOISE_FLOOR = 4.0
+MIN_ABOVE_FLOOR = 0.5
+"""
+The length of the mirror image added at each end of the signal before filtering, in seconds, so that the circular
+Fourier transform does not join one end of the recording to the other.
+"""
+EDGE_S = 1.0
+"""
+RR intervals outside this range, in milliseconds, are treated as missed or extra beats and left out of HR and HRV.
+"""
+RR_RANGE_MS = (300.0, 2000.0)
+"""
+The columns of the summary CSV file written by main, and of the per-beat CSV file.
+"""
+SUMMARY_COLUMNS = ["clinical.sui", "clinical.timestamp", "file", "beats.count", "beats.hr", "beats.hrv_sdnn",
+                   "beats.hrv_rmssd", "beats.r_peak_loc"]
+BEAT_COLUMNS = ["clinical.sui", "clinical.timestamp", "beat", "r_peak_loc", "rr", "hr"]
+
+
+class Beats:
+    """
+    The beats found in one recording.
+    """
+    def __init__(self, r_peaks, rate):
+        """
+        The sample index of each R-peak, and the sample rate in Hz.
+        """
+        self.r_peaks = r_peaks
+        self.rate = rate
+        """
+        The time between consecutive R-peaks in milliseconds, the instantaneous heart rate of each interval in beats
+        per minute, and a mask of the intervals within RR_RANGE_MS.
+        """
+        self.rr = np.diff(r_peaks) * (1000 / rate)
+        self.hr = 60000 / self.rr if len(self.rr) else np.zeros(0)
+        self.normal = (self.rr >= RR_RANGE_MS[0]) & (self.rr <= RR_RANGE_MS[1])
+
+    @property
+    def r_peak_ms(self):
+        return self.r_peaks * (1000 / self.rate)
+
+    def mean_hr(self):
+        """
+        Returns:
+            float: the mean heart rate in beats per minute, from the normal intervals, or NaN without any.
+        """
+        rr = self.rr[self.normal]
+        return 60000 / rr.mean() if len(rr) else np.nan
+
+    def sdnn(self):
+        """
+        Returns:
+            float: the standard deviation of the normal intervals in milliseconds, or NaN with fewer than two.
+        """
+        rr = self.rr[self.normal]
+        return rr.std(ddof=1) if len(rr) > 1 else np.nan
+
+    def rmssd(self):
+        """
+        Returns:
+            float: the root mean square of the differences between consecutive normal intervals in milliseconds, or NaN
+            without any such pair.
+        """
+        both = self.normal[1:] & self.normal[:-1]
+        differences = np.diff(self.rr)[both]
+        return np.sqrt(np.mean(differences ** 2)) if len(differences) else np.nan
+
+
+def bandpass(signal, rate, band=BAND_HZ):
+    """
+    Keep the frequencies of a signal within a band, by zeroing the others in its Fourier transform. The signal is
+    mirrored at both ends first, by EDGE_S seconds, so the step between its two ends does not ring into the result.
+
+    Args:
+        signal (numpy.ndarray): the samples.
+        rate (float): the sample rate in Hz.
+        band (tuple): the lowest and highest frequencies kept, in Hz.
+    Returns:
+        numpy.ndarray: the filtered signal.
+    """
+    edge = min(int(EDGE_S * rate), len(signal) - 1)
+    padded = np.pad(signal, edge, mode='reflect') if edge > 0 else signal
+    spectrum = np.fft.rfft(padded)
+    frequencies = np.fft.rfftfreq(len(padded), 1 / rate)
+    spectrum[(frequencies < band[0]) | (frequencies > band[1])] = 0
+    return np.fft.irfft(spectrum, len(padded))[edge:edge + len(signal)]
+
+
+def energy_envelope(filtered, rate):
+    """
+    Differentiate, square and integrate a band-passed ECG over a centred window of INTEGRATION_S seconds.
+
+    Args:
+        filtered (numpy.ndarray): the band-passed signal.
+        rate (float): the sample rate in Hz.
+    Returns:
+        numpy.ndarray: the envelope, one value per sample.
+    """
+    energy = np.gradient(filtered) ** 2
+    width = max(int(INTEGRATION_S * rate), 1)
+    total = np.concatenate(([0], np.cumsum(energy)))
+    index = np.arange(len(energy))
+    lo = np.clip(index - width // 2, 0, len(energy))
+    hi = np.clip(index + width - width // 2, 0, len(energy))
+    return (total[hi] - total[lo]) / width
+
+
+def running_max(values, half):
+    """
+    The largest value within half samples on each side of every sample, in linear time (van Herk / Gil-Werman).
+
+    Args:
+        values (numpy.ndarray): the samples.
+        half (int): the half-width of the window.
+    Returns:
+        numpy.ndarray: the running maximum, one value per sample.
+    """
+    width = 2 * half + 1
+    blocks = -(-(len(values) + 2 * half) // width)
+    padded = np.full(blocks * width, -np.inf)
+    padded[half:half + len(values)] = values
+    padded = padded.reshape(blocks, width)
+    # within each block, the maximum up to and from each position
+    forward = np.maximum.accumulate(padded, axis=1).reshape(-1)
+    backward = np.maximum.accumulate(padded[:, ::-1], axis=1)[:, ::-1].reshape(-1)
+    # the window of sample i is padded[i:i + width], which spans at most two blocks
+    index = np.arange(len(values))
+    return np.maximum(backward[index], forward[index + width - 1])
+
+
+def detect_beats(ecg, rate=1000 / json_to_ecg_csv.SAMPLE_PERIOD_MS):
+    """
+    Find the R-peaks of an ECG.
+
+    Args:
+        ecg (numpy.ndarray): the samples of the "ecg" channel.
+        rate (float): the sample rate in Hz.
+    Returns:
+        Beats: the R-peaks and the intervals between them.
+    """
+    ecg = np.nan_to_num(np.asarray(ecg, dtype=np.float64))
+    if len(ecg) < 3:
+        return Beats(np.zeros(0, dtype=np.int64), rate)
+    ecg = ecg - ecg.mean()
+    filtered = bandpass(ecg, rate)
+    envelope = energy_envelope(filtered, rate)
+
+    # candidates are the largest envelope value within a refractory period on each side, above a fraction of the
+    # largest value nearby, so the threshold follows changes in amplitude over the recording
+    local_max = running_max(envelope, int(REFRACTORY_S * rate))
+    threshold = THRESHOLD_FRACTION * running_max(envelope, int(THRESHOLD_WINDOW_S * rate / 2))
+    candidates = np.flatnonzero((envelope == local_max) & (envelope > threshold) & (envelope > 0))
+    # a flat top gives several equal maxima; keep the first of each run
+    if len(candidates):
+        candidates = candidates[np.concatenate(([True], np.diff(candidates) > int(REFRACTORY_S * rate)))]
+    # a peak at either end cannot be searched on both sides, and may be a beat cut in half
+    search = int(SEARCH_S * rate)
+    candidates = candidates[(candidates >= search) & (candidates < len(ecg) - search)]
+    # noise alone still has envelope maxima above the adaptive threshold, but they hardly rise above its median
+    above_floor = envelope[candidates] > NOISE_FLOOR * np.median(envelope)
+    if not len(candidates) or np.mean(above_floor) < MIN_ABOVE_FLOOR:
+        return Beats(np.zeros(0, dtype=np.int64), rate)
+    candidates = candidates[above_floor]
+
+    # the R-peak is the largest deflection near the envelope maximum; the narrow band of the filter rings around it
+    filtered = bandpass(ecg, rate, REFINE_BAND_HZ)
+    window = np.clip(candidates[:, None] + np.arange(-search, search + 1), 0, len(ecg) - 1)
+    r_peaks = window[np.arange(len(candidates)), np.argmax(np.abs(filtered[window]), axis=1)]
+    return Beats(np.unique(r_peaks), rate)
+
+
+def recording_field(fields, name):
+    """
+    Look up a field of a recording by its name in the seat .csv export, such as "clinical.sui", whether the recording
+    stores it flat, nested or without its group.
+
+    Returns:
+        the value, or "" if the recording does not have it.
+    """
+    if name in fields:
+        return fields[name]
+    group, _, key = name.partition(".")
+    if isinstance(fields.get(group), dict) and key in fields[group]:
+        return fields[group][key]
+    return fields.get(key, "")
+
+
+def read_ecg(filename):
+    """
+    Read the "ecg" channel of a recording.
+
+    Args:
+        filename (str): a JSON recording, or a binary waveform file from json_to_ecg_csv.
+    Returns:
+        tuple: the fields of the recording and the ECG samples, or None if the channel could not be decoded.
+    """
+    with open(filename, "rb") as f:
+        binary = f.read(len(json_to_ecg_csv.BINARY_MAGIC)) == json_to_ecg_csv.BINARY_MAGIC
+    if binary:
+        header, samples = json_to_ecg_csv.read_binary(filename)
+        ecg = samples[:, header["channels"].index("ecg")]
+        return header["source"], None if np.isnan(ecg).all() else np.array(ecg)
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        recording = json_to_ecg_csv.Recording(data)
+        if "ecg" not in recording.readers:
+            return recording.fields, None
+        return recording.fields, np.array(recording.readers["ecg"].read(recording.rows))
+
+
+def analyze_file(filename):
+    """
+    Find the beats of one recording. Runs in worker processes.
+
+    Returns:
+        tuple: the fields of the recording, and its Beats or the reason there are none.
+    """
+    try:
+        fields, ecg = read_ecg(filename)
+    except (OSError, ValueError, KeyError) as e:
+        return {}, type(e).__name__ + ": " + str(e)
+    if ecg is None:
+        return fields, "the ecg channel could not be decoded"
+    return fields, detect_beats(ecg)
+
+
+def format_number(value):
+    """
+    Returns:
+        str: the number rounded to 3 decimals, or "" for NaN, like an empty cell of the seat .csv export.
+    """
+    return "" if np.isnan(value) else str(round(float(value), 3))
+
+
+def main(argv=None):
+    """
+    Find the beats of JSON recordings, as asked on the command line.
+
+    Args:
+        argv (list): the command line arguments, or None to use sys.argv.
+    Returns:
+        int: the exit status; 1 if any recording could not be analysed.
+    """
+    parser = argparse.ArgumentParser(description="Finds R-peaks, heart rate and HRV in seat recordings.")
+    parser.add_argument("recordings", nargs='+', help="JSON recordings or binary waveform files, or directories of "
+                                                      "them.")
+    parser.add_argument("output_file", help="The CSV file to write, with one row per recording.")
+    parser.add_argument("--beats-csv", help="Also write a CSV file with one row per beat.")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes analysing recordings; 0 uses "
+                                                              "every CPU")
+    arguments = parser.parse_args(argv)
+
+    filenames = []
+    for path in arguments.recordings:
+        if os.path.isdir(path):
+            filenames += sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if os.path.splitext(name)[1].lower() in (".json", ".bin"))
+        else:
+            filenames.append(path)
+    jobs = arguments.jobs if arguments.jobs > 0 else os.cpu_count()
+    if jobs == 1 or len(filenames) <= 1:
+        results = [analyze_file(filename) for filename in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as executor:
+            results = list(executor.map(analyze_file, filenames))
+
+    failed = 0
+    # the SUI, timestamp and file name come from outside, so they are quoted by csv.writer when they need it
+    with contextlib.ExitStack() as files:
+        summary = csv.writer(files.enter_context(open(arguments.output_file, "w", newline="")), lineterminator="\n")
+        summary.writerow(SUMMARY_COLUMNS)
+        beat_rows = None
+        if arguments.beats_csv:
+            beat_rows = csv.writer(files.enter_context(open(arguments.beats_csv, "w", newline="")),
+                                   lineterminator="\n")
+            beat_rows.writerow(BEAT_COLUMNS)
+        for filename, (fields, beats) in zip(filenames, results):
+            sui = str(recording_field(fields, "clinical.sui"))
+            timestamp = str(recording_field(fields, "clinical.timestamp"))
+            if isinstance(beats, str):
+                print("Could not analyse " + filename + ": " + beats)
+                failed += 1
+                summary.writerow([sui, timestamp, filename, "", "", "", "", ""])
+                continue
+            peaks = beats.r_peak_ms
+            summary.writerow([sui, timestamp, filename, str(len(peaks)), format_number(beats.mean_hr()),
+                              format_number(beats.sdnn()), format_number(beats.rmssd()),
+                              " ".join(format_number(peak) for peak in peaks)])
+            if beat_rows is not None:
+                rr = np.concatenate(([np.nan], beats.rr))
+                hr = np.concatenate(([np.nan], beats.hr))
+                beat_rows.writerows([sui, timestamp, str(i), format_number(peaks[i]), format_number(rr[i]),
+                                     format_number(hr[i])] for i in range(len(peaks)))
+    print("Analysed " + str(len(filenames) - failed) + " of " + str(len(filenames)) + " recordings.")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
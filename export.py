@@ -0,0 +1,156 @@
+import contextlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+"""
+Export of the per-day aggregates: for each SUI and day, the value of every variable, as a CSV file, a NumPy .npz file,
+JSON Lines or an SQLite table.
+
+The rows are built as one matrix, SUI by day by variable, and are written sorted by SUI, in the order given, then by
+day. A variable without a value on a day is empty in the CSV file, NaN in the .npz file and null in JSON Lines and
+SQLite.
+"""
+
+"""
+The number of rows formatted and written at a time.
+"""
+BLOCK_ROWS = 10_000
+"""
+The name of the table in the SQLite file, and of its index on SUI and day.
+"""
+SQLITE_TABLE = "daily"
+SQLITE_INDEX = "daily_sui_day"
+"""
+The columns of the completeness table after the SUI, from aggregation.completeness.
+"""
+COMPLETENESS_COLUMNS = ["variable", "samples", "present", "missing", "percent_complete", "days", "days_with_value"]
+
+
+def daily_matrix(suis, variables, x, y):
+    """
+    Arrange the per-day series of several SUI's and variables into one row per SUI and day.
+    :param suis: The SUI's, in the order of the rows
+    :param variables: The variables, in the order of the columns
+    :param x: The days of each series, by SUI then variable, as in Aggregates.x after condense
+    :param y: The value of each day, by SUI then variable
+    :return: For each row, the index of its SUI in suis and its day, and the values of the rows, with NaN where a
+    variable has no value on the day
+    """
+    sui_index = []
+    days = []
+    blocks = []
+    for i, sui in enumerate(suis):
+        series_days = [np.asarray(x[sui][var]) for var in variables]
+        present = [d for d in series_days if len(d)]
+        if not present:
+            continue
+        # np.unique would do, but its first call imports numpy.ma, which takes longer than the rest of a small export
+        sui_days = np.sort(np.concatenate(present))
+        sui_days = sui_days[np.concatenate(([True], sui_days[1:] != sui_days[:-1]))]
+        values = np.full((len(sui_days), len(variables)), np.nan)
+        for j, var in enumerate(variables):
+            if len(series_days[j]):
+                values[np.searchsorted(sui_days, series_days[j]), j] = y[sui][var]
+        sui_index.append(np.full(len(sui_days), i, dtype=np.int64))
+        days.append(sui_days)
+        blocks.append(values)
+    if not blocks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, len(variables)))
+    return np.concatenate(sui_index), np.concatenate(days), np.concatenate(blocks)
+
+
+def write_csv(filename, suis, variables, sui_index, days, values, sui_var="clinical.sui"):
+    """
+    Write the rows of daily_matrix to a CSV file.
+    :return: None
+    """
+    with open(filename, "w") as f:
+        f.write(",".join([sui_var, "day"] + list(variables)) + "\n")
+        for start in range(0, len(days), BLOCK_ROWS):
+            stop = start + BLOCK_ROWS
+            rows = zip(sui_index[start:stop].tolist(), days[start:stop].tolist(), values[start:stop].tolist())
+            # a missing value is NaN, which is formatted as "nan"; no other number contains it
+            f.write("".join([suis[i] + "," + str(day) + "," + ",".join(map(str, row)).replace("nan", "") + "\n"
+                             for i, day, row in rows]))
+
+
+def write_npz(filename, suis, variables, sui_index, days, values):
+    """
+    Save the rows of daily_matrix to a NumPy .npz file with the arrays suis, variables, sui (the index in suis of each
+    row), day and values (one column per variable).
+    :return: None
+    """
+    np.savez(filename, suis=np.asarray(suis, dtype=str), variables=np.asarray(variables, dtype=str), sui=sui_index,
+             day=days, values=values)
+
+
+def value_rows(values):
+    """
+    :return: The values as lists, with None where they are NaN
+    """
+    # NaN is the only value not equal to itself
+    return [[None if value != value else value for value in row] for row in values.tolist()]
+
+
+def write_jsonl(filename, suis, variables, sui_index, days, values, sui_var="clinical.sui"):
+    """
+    Write the rows of daily_matrix as JSON Lines: one object per line, with the SUI, the day and every variable.
+    :return: None
+    """
+    # the keys and SUI's are encoded once; the numbers are formatted as json.dumps formats them
+    sui_keys = ["{" + json.dumps(sui_var) + ": " + json.dumps(sui) + ", \"day\": " for sui in suis]
+    keys = [", " + json.dumps(var) + ": " for var in variables]
+    with open(filename, "w") as f:
+        for start in range(0, len(days), BLOCK_ROWS):
+            stop = start + BLOCK_ROWS
+            rows = zip(sui_index[start:stop].tolist(), days[start:stop].tolist(), values[start:stop].tolist())
+            f.write("".join([sui_keys[i] + str(day) + "".join([key + ("null" if value != value else str(value))
+                                                               for key, value in zip(keys, row)]) + "}\n"
+                             for i, day, row in rows]))
+
+
+def write_sqlite(filename, suis, variables, sui_index, days, values, sui_var="clinical.sui"):
+    """
+    Write the rows of daily_matrix to an SQLite file, replacing it, as a table with a column for the SUI, the day and
+    every variable, indexed on the SUI and day.
+    :return: None
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    day_type = "INTEGER" if np.issubdtype(days.dtype, np.integer) else "REAL"
+    columns = [quote(sui_var) + " TEXT NOT NULL", "day " + day_type + " NOT NULL"]
+    columns += [quote(var) + " REAL" for var in variables]
+    with contextlib.closing(sqlite3.connect(filename)) as db:
+        db.execute("CREATE TABLE " + SQLITE_TABLE + " (" + ", ".join(columns) + ")")
+        insert = "INSERT INTO " + SQLITE_TABLE + " VALUES (" + ", ".join(["?"] * (len(variables) + 2)) + ")"
+        for start in range(0, len(days), BLOCK_ROWS):
+            stop = start + BLOCK_ROWS
+            rows = zip(sui_index[start:stop].tolist(), days[start:stop].tolist(), value_rows(values[start:stop]))
+            db.executemany(insert, ([suis[i], day] + row for i, day, row in rows))
+        db.execute("CREATE INDEX " + SQLITE_INDEX + " ON " + SQLITE_TABLE + " (" + quote(sui_var) + ", day)")
+        db.commit()
+
+
+def write_completeness(filename, table, sui_var="clinical.sui"):
+    """
+    Write a completeness table to a CSV file, one row per SUI and variable.
+    :param table: How complete each series is, by SUI then variable, as Aggregates.completeness returns it
+    :return: None
+    """
+    with open(filename, "w") as f:
+        f.write(",".join([sui_var] + COMPLETENESS_COLUMNS) + "\n")
+        for sui, series in table.items():
+            for var, row in series.items():
+                percent = "" if row["percent_complete"] is None else "%.1f" % row["percent_complete"]
+                f.write(",".join([sui, var, str(row["samples"]), str(row["present"]), str(row["missing"]), percent,
+                                  str(row["days"]), str(row["days_with_value"])]) + "\n")
+
+
+def quote(name):
+    """
+    :return: The name as an SQL identifier
+    """
+    return '"' + name.replace('"', '""') + '"'
@@ -1,80 +1,16 @@
 import argparse
+import base64
+import collections
 import datetime
+import functools
+import json
 import os
 import sys
-import random
-import time
-
-
-class User:
-    def __init__(self, sui, start_date, records=None):
-        if records is None:
-            records = []
-        self.sui = sui
-        self.start_date = start_date
-        # trials last 90 days
-        self.end_date = self.start_date + (90 * 24 * 60 * 60)
-        self.records = records
-
-
-class Record:
-    def __init__(self, sui, timestamp, duration, hr, hrv, qtc, qrs, spo2, dbp, sbp, pwv, sv, co, cardiac_index,
-                 sv_index, ptt, pat, seat_weight, r_peak_loc, respiration_rate, ecg_elec_imped, ppg_ir_dc,
-                 ppg_ir_pulsatile, ppg_red_dc, ppg_red_pulsatile, bcg_rms, q_amp, q_loc, r_amp, r_loc, s_amp, s_loc,
-                 t_peak_amp, t_peak_loc, t_end_amp, t_end_loc, h_amp, h_loc, i_amp, i_loc, j_amp, j_loc, ir_min_tan_amp,
-                 ir_min_tan_loc, ir_peak_amp, ir_peak_loc, red_min_tan_amp, red_min_tan_loc, red_peak_amp,
-                 red_peak_loc, channel_format):
-        self.sui = sui
-        self.timestamp = timestamp
-        self.duration = duration
-        self.hr = hr
-        self.hrv = hrv
-        self.qtc = qtc
-        self.qrs = qrs
-        self.spo2 = spo2
-        self.dbp = dbp
-        self.sbp = sbp
-        self.pwv = pwv
-        self.sv = sv
-        self.co = co
-        self.cardiac_index = cardiac_index
-        self.sv_index = sv_index
-        self.ptt = ptt
-        self.pat = pat
-        self.seat_weight = seat_weight
-        self.r_peak_loc = r_peak_loc
-        self.respiration_rate = respiration_rate
-        self.ecg_elec_imped = ecg_elec_imped
-        self.ppg_ir_dc = ppg_ir_dc
-        self.ppg_ir_pulsatile = ppg_ir_pulsatile
-        self.ppg_red_dc = ppg_red_dc
-        self.ppg_red_pulsatile = ppg_red_pulsatile
-        self.bcg_rms = bcg_rms
-        self.q_amp = q_amp
-        self.q_loc = q_loc
-        self.r_amp = r_amp
-        self.r_loc = r_loc
-        self.s_amp = s_amp
-        self.s_loc = s_loc
-        self.t_peak_amp = t_peak_amp
-        self.t_peak_loc = t_peak_loc
-        self.t_end_amp = t_end_amp
-        self.t_end_loc = t_end_loc
-        self.h_amp = h_amp
-        self.h_loc = h_loc
-        self.i_amp = i_amp
-        self.i_loc = i_loc
-        self.j_amp = j_amp
-        self.j_loc = j_loc
-        self.ir_min_tan_amp = ir_min_tan_amp
-        self.ir_min_tan_loc = ir_min_tan_loc
-        self.ir_peak_amp = ir_peak_amp
-        self.ir_peak_loc = ir_peak_loc
-        self.red_min_tan_amp = red_min_tan_amp
-        self.red_min_tan_loc = red_min_tan_loc
-        self.red_peak_amp = red_peak_amp
-        self.red_peak_loc = red_peak_loc
-        self.channel_format = channel_format
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import json_to_ecg_csv
 
 
 def query_yes_no(question):
@@ -89,218 +25,402 @@ def query_yes_no(question):
             sys.stdout.write("Please respond with 'yes' or 'no' (or 'y' or 'n').\n")
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Parses a csv file from the seats experiment.')
+"""
+The columns of the generated file, in the order SeatReader expects them.
+"""
+HEADERS = "clinical.sui	clinical.timestamp	clinical.duration	clinical.hr	clinical.hrv	clinical.qtc	" \
+          "clinical.qrs	clinical.spo2	clinical.dbp	clinical.sbp	clinical.pwv	clinical.sv	clinical.co	" \
+          "clinical.cardiac_index	clinical.sv_index	clinical.ptt	clinical.pat	clinical.seat_weight	" \
+          "clinical.r_peak_loc	clinical.respiration_rate	clinical.ecg_elec_imped	low_level.ppg_ir_dc	" \
+          "low_level.ppg_ir_pulsatile	low_level.ppg_red_dc	low_level.ppg_red_pulsatile	low_level.bcg_rms	" \
+          "ecg.q_amp	ecg.q_loc	ecg.r_amp	ecg.r_loc	ecg.s_amp	ecg.s_loc	ecg.t_peak_amp	ecg.t_peak_loc	" \
+          "ecg.t_end_amp	ecg.t_end_loc	bcg.h_amp	bcg.h_loc	bcg.i_amp	bcg.i_loc	bcg.j_amp	bcg.j_loc	" \
+          "ppg.ir_min_tan_amp	ppg.ir_min_tan_loc	ppg.ir_peak_amp	ppg.ir_peak_loc	ppg.red_min_tan_amp	" \
+          "ppg.red_min_tan_loc	ppg.red_peak_amp	ppg.red_peak_loc	channel_format".split('\t')
+"""
+The chance that each group of columns is missing from a row. The columns of a group are missing together.
+"""
+MISSING_RATES = {
+    "qtc": 0.2, "qrs": 0.2, "spo2": 0.01, "ptt": 0.2, "pat": 0.2, "low_level": 0.9, "ecg": 0.02, "bcg": 0.5,
+    "ppg": 0.6,
+}
+"""
+Trials last 90 days, and start within the year before the end date.
+"""
+TRIAL_DAYS = 90
+START_DAYS = 365
+"""
+Number of rows generated at a time; each chunk has its own random stream, so the file does not depend on --jobs.
+"""
+CHUNK_ROWS = 100_000
+"""
+The number of chunks submitted to the worker processes and not yet written, per worker. The text of a chunk is kept
+until it is written, so this bounds the memory of the parent whatever the number of rows.
+"""
+CHUNKS_PER_JOB = 2
+"""
+The number of decimals of generated fractional values.
+"""
+DECIMALS = 4
+
+
+def int_values(low, high):
+    return [str(i) for i in range(low, high + 1)]
+
+
+def float_values(low, high):
+    step = 10 ** -DECIMALS
+    return [str(round(low + i * step, DECIMALS)) for i in range(int(round((high - low) / step)))]
+
+
+@functools.lru_cache(maxsize=None)
+def column_values():
+    """
+    The text each column can take, as ranges like those of the original generator, and the group of columns it is
+    missing with. A missing value is an empty cell, the last of the values of every column.
+
+    :return: A list with, for each column after the SUI and timestamp, its group (None if it is never missing) and its
+    possible values as an object array
+    """
+    columns = [
+        (None, int_values(30, 300)),  # duration
+        (None, int_values(40, 130)),  # hr
+        (None, int_values(0, 100)),  # hrv
+        ("qtc", float_values(0.4, 0.6)),
+        ("qrs", float_values(0.05, 0.1)),
+        ("spo2", int_values(90, 100)),
+        ("spo2", int_values(60, 80)),  # dbp
+        ("spo2", int_values(120, 140)),  # sbp
+        ("spo2", float_values(0, 0.5)),  # pwv
+        ("spo2", float_values(0, 0.5)),  # sv
+        ("spo2", float_values(0, 0.5)),  # co
+        (None, [""]),  # cardiac_index
+        (None, [""]),  # sv_index
+        ("ptt", float_values(0, 0.5)),
+        ("pat", float_values(0, 0.5)),
+        (None, int_values(80, 150)),  # seat_weight
+        (None, ["List (" + x + ")" for x in int_values(30, 250)]),  # r_peak_loc
+        (None, [""]),  # respiration_rate
+        (None, [""]),  # ecg_elec_imped
+        ("low_level", int_values(400, 600)),
+        ("low_level", float_values(0.4, 1.4)),
+        ("low_level", int_values(50, 600)),
+        ("low_level", float_values(0, 0.3)),
+        ("low_level", float_values(0.5, 1.5)),
+        ("ecg", int_values(-5, 15)),
+        ("ecg", int_values(-45, -25)),
+        ("ecg", int_values(70, 150)),
+        ("ecg", ["0"]),
+        ("ecg", int_values(-50, -10)),
+        ("ecg", int_values(40, 70)),
+        ("ecg", int_values(-20, -10)),
+        ("ecg", int_values(80, 250)),
+        ("ecg", int_values(-10, 10)),
+        ("ecg", int_values(300, 600)),
+        ("bcg", float_values(0, 1)),
+        ("bcg", int_values(70, 150)),
+        ("bcg", float_values(-1, 0)),
+        ("bcg", int_values(100, 150)),
+        ("bcg", float_values(0, 1)),
+        ("bcg", int_values(150, 300)),
+        ("ppg", float_values(0, 1)),
+        ("ppg", int_values(100, 300)),
+        ("ppg", float_values(0, 1)),
+        ("ppg", int_values(100, 300)),
+        ("ppg", float_values(0, 1)),
+        ("ppg", int_values(100, 300)),
+        ("ppg", float_values(0, 1)),
+        ("ppg", int_values(100, 300)),
+        (None, ["<" + x + "000f" for x in int_values(10, 30)]),  # channel_format
+    ]
+    return [(group, np.array(values + [""], dtype=object)) for group, values in columns]
+
+
+def make_users(seed, count, end_date):
+    """
+    Generate the SUIs of a file: a random 4-digit prefix with distinct numbers, each with a random start date.
+
+    :param seed: The numpy.random.SeedSequence of the users
+    :param count: The number of SUIs
+    :param end_date: The last start date, as a datetime.date
+    :return: The SUIs and their start dates as numpy datetime64 seconds
+    """
+    rng = np.random.default_rng(seed)
+    prefix = str(rng.integers(1000, 10000)) + "_"
+    suis = [prefix + str(i) for i in rng.choice(max(100, count), count, replace=False)]
+    end = np.datetime64(end_date, 's')
+    starts = end - rng.integers(0, START_DAYS * 24 * 60 * 60 + 1, count)
+    return suis, starts
+
+
+def format_timestamps(timestamps):
+    """
+    :param timestamps: The timestamps as numpy datetime64 seconds
+    :return: The timestamps as a list of "%Y-%m-%d %H:%M:%S" strings
+    """
+    # "YYYY-MM-DDTHH:MM:SS", with the T replaced in place by a space
+    text = np.datetime_as_string(timestamps, unit='s')
+    text.view(np.uint32).reshape(len(text), -1)[:, 10] = ord(' ')
+    return text.tolist()
+
+
+def generate_chunk(seed, rows, suis, starts, missing_rates):
+    """
+    Generate rows of the file. Runs in worker processes.
+
+    :param seed: The numpy.random.SeedSequence of the chunk
+    :param rows: The number of rows
+    :param suis: The SUIs, from make_users
+    :param starts: Their start dates, from make_users
+    :param missing_rates: The chance that each group of columns is missing, by group
+    :return: The rows as text
+    """
+    rng = np.random.default_rng(seed)
+    user = rng.integers(0, len(suis), rows)
+    timestamps = starts[user] + rng.integers(0, TRIAL_DAYS * 24 * 60 * 60 + 1, rows)
+    columns = [np.array(suis, dtype=object)[user].tolist(), format_timestamps(timestamps)]
+
+    missing = {group: rng.random(rows) < rate for group, rate in missing_rates.items()}
+    for group, values in column_values():
+        index = rng.integers(0, len(values) - 1, rows)
+        if group is not None:
+            index[missing[group]] = len(values) - 1
+        columns.append(values[index].tolist())
+    return "\n".join(map(",".join, zip(*columns))) + "\n"
+
+
+def output_files(output_file, shards):
+    """
+    :return: The path of each shard: output_file itself, or output_file with the shard number before its extension
+    """
+    if shards == 1:
+        return [output_file]
+    stem, extension = os.path.splitext(output_file)
+    return [stem + "-" + str(i).zfill(5) + extension for i in range(shards)]
+
+
+def split_lines(text, count):
+    """
+    :return: The first count lines of text, and the rest of it
+    """
+    position = 0
+    for _ in range(count):
+        position = text.index("\n", position) + 1
+    return text[:position], text[position:]
+
+
+def map_bounded(executor, function, *iterables, window):
+    """
+    Like executor.map, but submit the calls as their results are used, so that at most window of them are pending.
+    :param executor: The ProcessPoolExecutor
+    :param function: The function to call
+    :param iterables: The arguments of each call
+    :param window: The largest number of calls submitted whose result has not been used yet
+    :return: An iterator over the results, in order
+    """
+    futures = collections.deque()
+    for arguments in zip(*iterables):
+        if len(futures) == window:
+            yield futures.popleft().result()
+        futures.append(executor.submit(function, *arguments))
+    while futures:
+        yield futures.popleft().result()
+
+
+def beat_waves(peaks, waves, samples):
+    """
+    Add up one wave per beat, as a sum of Gaussians, vectorized over the beats.
+
+    :param peaks: The sample of each R-peak
+    :param waves: The (amplitude, delay after the R-peak in samples, width in samples) of each Gaussian
+    :param samples: The length of the signal
+    :return: The signal as a float64 array
+    """
+    reach = max(abs(delay) + 4 * width for _, delay, width in waves)
+    offsets = np.arange(-reach, reach + 1)
+    shape = sum(amplitude * np.exp(-((offsets - delay) / width) ** 2) for amplitude, delay, width in waves)
+    index = (peaks[:, None] + offsets).ravel()
+    inside = (index >= 0) & (index < samples)
+    return np.bincount(index[inside], weights=np.tile(shape, len(peaks))[inside], minlength=samples)
+
+
+def generate_recording(seed, filename, sui, timestamp, duration, morphology):
+    """
+    Write a JSON recording like those of the seats, with a float32 channel per lead. Runs in worker processes.
+
+    :param seed: The numpy.random.SeedSequence of the recording
+    :param filename: The file to write
+    :param sui: The SUI of the recording
+    :param timestamp: Its timestamp, as "%Y-%m-%d %H:%M:%S"
+    :param duration: Its length in seconds
+    :param morphology: If True, the ECG has P, QRS and T waves at the R-peaks listed in clinical.r_peak_loc; if False,
+    every channel is noise and there are no R-peaks
+    :return: The number of R-peaks
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(duration * 1000 / json_to_ecg_csv.SAMPLE_PERIOD_MS)
+    seconds = np.arange(samples) * (json_to_ecg_csv.SAMPLE_PERIOD_MS / 1000)
+    breathing = np.sin(2 * np.pi * rng.uniform(0.2, 0.33) * seconds + rng.uniform(0, 2 * np.pi))
+
+    hr = rng.uniform(55, 95)
+    peaks = np.zeros(0, dtype=np.int64)
+    if morphology:
+        # RR intervals in samples that vary with breathing, as sinus arrhythmia does, and at random
+        beats = int(duration * hr / 60 * 1.2) + 2
+        rr = 60000 / hr / json_to_ecg_csv.SAMPLE_PERIOD_MS * (1 + 0.05 * rng.standard_normal(beats))
+        peaks = (rng.uniform(100, 800) + np.cumsum(rr)).astype(np.int64)
+        peaks = peaks[peaks < samples - 500]
+        peaks += (0.03 * rr[:len(peaks)] * breathing[peaks]).astype(np.int64)
+
+    channels = {
+        "ecg": 0.1 * breathing + 0.02 * rng.standard_normal(samples) + beat_waves(
+            peaks, [(0.15, -160, 20), (-0.1, -25, 8), (1.0, 0, 8), (-0.25, 25, 9), (0.3, 260, 45)], samples),
+    }
+    pulse = beat_waves(peaks, [(1.0, 280, 60), (0.4, 450, 50)], samples)
+    for lead, dc, gain in (("ppg_ir", 500, 5), ("ppg_red", 300, 2)):
+        channels[lead] = dc * (1 + 0.01 * breathing) + gain * pulse + 0.05 * rng.standard_normal(samples)
+    weight = rng.uniform(60, 120)
+    for lead, share in (("weight_br", 0.3), ("weight_fr", 0.2), ("weight_bl", 0.3)):
+        channels[lead] = weight * share + 0.2 * breathing + 0.05 * rng.standard_normal(samples)
+    for lead in ("bcg_br", "bcg_fr", "bcg_bl", "bcg_fl"):
+        channels[lead] = rng.uniform(0.5, 1.5) * beat_waves(
+            peaks, [(-0.03, 180, 15), (0.06, 230, 15), (-0.04, 290, 20)], samples) + \
+            0.005 * rng.standard_normal(samples)
+
+    clinical = {"sui": sui, "timestamp": timestamp, "duration": duration,
+                "hr": round(60 / np.diff(peaks).mean() * 1000 / json_to_ecg_csv.SAMPLE_PERIOD_MS, 1)
+                if len(peaks) > 1 else None,
+                "r_peak_loc": (peaks * json_to_ecg_csv.SAMPLE_PERIOD_MS).tolist()}
+    # the channels are written one at a time, as base64 with escaped line breaks, to not hold the whole JSON text
+    with open(filename + ".tmp", "wb") as f:
+        f.write(b'{"clinical": ' + json.dumps(clinical).encode() + b', "channel_format": "<' + str(samples).encode() +
+                b'f", "channels": {')
+        for i, lead in enumerate(json_to_ecg_csv.LEADS):
+            text = base64.encodebytes(channels[lead].astype("<f4").tobytes()).replace(b"\n", b"\\n")
+            f.write((b", " if i else b"") + b'"' + lead.encode() + b'": "' + text + b'"')
+        f.write(b"}}")
+    os.replace(filename + ".tmp", filename)
+    return len(peaks)
 
-    parser.add_argument("output_file", help="The output file to write to.")
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a random csv file like those of the seats experiment, '
+                                                 'or JSON recordings of their channels with --json.')
+
+    parser.add_argument("output_file", help="The output file to write to. With --shards, the number of each shard is "
+                                            "added before the extension. With --json and --recordings, the directory "
+                                            "to write the recordings to.")
+    parser.add_argument("--rows", type=int, help="The number of rows; by default, between 10000 and 15000")
+    parser.add_argument("--suis", type=int, help="The number of SUIs; by default, between 10 and 20")
+    parser.add_argument("--seed", type=int, help="The seed of the random values; the same seed, options and end date "
+                                                 "give the same file")
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, default=datetime.date.today(),
+                        help="The date, as YYYY-MM-DD, by which every trial has started; defaults to today")
+    parser.add_argument("--missing", action="append", default=[], metavar="GROUP=RATE",
+                        help="The chance that a group of columns is missing from a row, for the groups " +
+                             ", ".join(MISSING_RATES) + "; may be given several times")
+    parser.add_argument("--shards", type=int, default=1, help="The number of files to split the rows into, each "
+                                                              "with the header and an even share of the rows")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes generating rows; 0 uses every "
+                                                            "CPU")
+    parser.add_argument("-y", "--yes", action="store_true", help="Overwrite the output files without asking")
+    parser.add_argument("--json", action="store_true", help="Write JSON recordings of the seat channels, as read by "
+                                                            "json_to_ecg_csv.py, instead of a csv file")
+    parser.add_argument("--recordings", type=int, default=1, help="With --json, the number of recordings")
+    parser.add_argument("--duration", type=float, default=60, help="With --json, the length of each recording in "
+                                                                   "seconds")
+    parser.add_argument("--noise-ecg", action="store_true", help="With --json, make every channel noise instead of "
+                                                                 "drawing beats at the R-peaks of clinical.r_peak_loc")
 
     args = parser.parse_args()
 
-    # check if the output file exists and is writable
-    if os.path.exists(args.output_file):
+    missing_rates = dict(MISSING_RATES)
+    for option in args.missing:
+        group, _, rate = option.partition("=")
+        if group not in MISSING_RATES:
+            parser.error("unknown group " + group + " in --missing; use one of " + ", ".join(MISSING_RATES))
+        try:
+            missing_rates[group] = float(rate)
+        except ValueError:
+            parser.error("--missing " + option + " is not GROUP=RATE")
+        if not 0 <= missing_rates[group] <= 1:
+            parser.error("the rate in --missing " + option + " must be between 0 and 1")
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.json and (args.rows is not None or args.missing or args.shards != 1):
+        parser.error("--rows, --missing and --shards do not apply to --json")
+    if args.recordings < 1 or args.duration <= 0:
+        parser.error("--recordings and --duration must be positive")
+
+    # check if the output files exist
+    if not args.json:
+        filenames = output_files(args.output_file, args.shards)
+    elif args.recordings == 1:
+        filenames = [args.output_file]
+    else:
+        os.makedirs(args.output_file, exist_ok=True)
+        filenames = [os.path.join(args.output_file, "recording-" + str(i).zfill(5) + ".json")
+                     for i in range(args.recordings)]
+    if not args.yes and any(os.path.exists(filename) for filename in filenames):
         # ask to overwrite if the file exists
         if not query_yes_no("Output file already exists. Overwrite?"):
             exit(1)
-    # if not os.access(args.output_file, os.W_OK):
-    #     print("Output file is not writable.")
-    #     exit(1)
 
-    headers = "clinical.sui	clinical.timestamp	clinical.duration	clinical.hr	clinical.hrv	clinical.qtc	" \
-              "clinical.qrs	clinical.spo2	clinical.dbp	clinical.sbp	clinical.pwv	clinical.sv	clinical.co	" \
-              "clinical.cardiac_index	clinical.sv_index	clinical.ptt	clinical.pat	clinical.seat_weight	" \
-              "clinical.r_peak_loc	clinical.respiration_rate	clinical.ecg_elec_imped	low_level.ppg_ir_dc	" \
-              "low_level.ppg_ir_pulsatile	low_level.ppg_red_dc	low_level.ppg_red_pulsatile	low_level.bcg_rms	" \
-              "ecg.q_amp	ecg.q_loc	ecg.r_amp	ecg.r_loc	ecg.s_amp	ecg.s_loc	ecg.t_peak_amp	ecg.t_peak_loc	" \
-              "ecg.t_end_amp	ecg.t_end_loc	bcg.h_amp	bcg.h_loc	bcg.i_amp	bcg.i_loc	bcg.j_amp	bcg.j_loc	" \
-              "ppg.ir_min_tan_amp	ppg.ir_min_tan_loc	ppg.ir_peak_amp	ppg.ir_peak_loc	ppg.red_min_tan_amp	" \
-              "ppg.red_min_tan_loc	ppg.red_peak_amp	ppg.red_peak_loc	channel_format".split('\t')
-
-    user_list = []
-
-    # generate a random 4-digit number
-    prefix = str(random.randint(1000, 9999)) + "_"
-
-    # generate 10-20 random SUIs by combing the prefix with a random 2-digit number
-    # and a random start date as Unix timestamp within the past year
-    time_one_year_ago = int(round(time.time())) - 60 * 60 * 24 * 365
-    time_now = int(round(time.time()))
-    for i in range(random.randint(10, 20)):
-        sui = prefix + str(random.randint(0, 99))
-        start_date = random.randint(time_one_year_ago, time_now)
-        user_list.append(User(sui, start_date))
-
-    # write the output file
-    with open(args.output_file, 'w') as f:
-        f.write(','.join(headers) + '\n')
-
-        # write 10_000 to 15_000 random records
-        for i in range(random.randint(10000, 15000)):
-            # pick a random user from the list
-            user = random.choice(user_list)
-            sui = user.sui
-
-            # generate a random timestamp within the user's start date and end date
-            start_date = user.start_date
-            end_date = user.start_date + 60 * 60 * 24 * 90
-            timestamp = random.randint(start_date, end_date)
-
-            # convert timestamp to readable date
-            timestamp = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-
-            # generate a random duration between 30 and 300 seconds
-            duration = random.randint(30, 300)
-
-            # generate a random heart rate between 40 and 130 bpm
-            hr = random.randint(40, 130)
-
-            # generate a random heart rate variability between 0 and 100 bpm
-            hrv = random.randint(0, 100)
-
-            # generate a random QTc between 0.4 and 0.6, with a 20% chance of being missing
-            qtc = random.random() * 0.2 + 0.4 if random.random() > 0.2 else ""
-
-            # generate a random QRS duration between 0.05 and 0.1, with a 20% chance of being missing
-            qrs = random.random() * 0.05 + 0.05 if random.random() > 0.2 else ""
-
-            has_spo2 = random.random() > 0.01
-
-            spo2 = ""
-            dbp = ""
-            sbp = ""
-            pwv = ""
-            sv = ""
-            co = ""
-
-            if has_spo2:
-                # generate a random SPO2 between 90 and 100%, with a 99% chance of being missing
-                spo2 = random.randint(90, 100)
-
-                # generate a random DBP between 60 and 80 mmHg, with a 99% chance of being missing
-                dbp = random.randint(60, 80)
-
-                # generate a random SBP between 120 and 140 mmHg, with a 99% chance of being missing
-                sbp = random.randint(120, 140)
-
-                # generate a random PWV between 0 and 0.5, with a 99% chance of being missing
-                pwv = random.random() * 0.5
-
-                # generate a random SV between 0 and 0.5, with a 99% chance of being missing
-                sv = random.random() * 0.5
-
-                # generate a random CO between 0 and 0.5, with a 99% chance of being missing
-                co = random.random() * 0.5
-
-            cardiac_index = ""
-            sv_index = ""
-
-            # generate a random PTT between 0 and 0.5, with an 80% chance of being missing
-            ptt = random.random() * 0.5 if random.random() > 0.2 else ""
-
-            # generate a random PAT between 0 and 0.5, with an 80% chance of being missing
-            pat = random.random() * 0.5 if random.random() > 0.2 else ""
-
-            # generate a random seat weight between 80 and 150 kg
-            seat_weight = random.randint(80, 150)
-
-            r_peak_loc = "List (" + str(random.randint(30, 250)) + ")"
-
-            respiration_rate = ""
-            ecg_elec_imped = ""
-
-            has_low_level = random.random() < 0.10
-
-            low_level_ppg_ir_dc = ""
-            low_level_ppg_ir_pulsatile = ""
-            low_level_ppg_red_dc = ""
-            low_level_ppg_red_pulsatile = ""
-            low_level_bcg_rms = ""
-
-            if has_low_level:
-                low_level_ppg_ir_dc = random.randint(400, 600)
-                low_level_ppg_ir_pulsatile = random.random() * 1 + 0.4
-                low_level_ppg_red_dc = random.randint(50, 600)
-                low_level_ppg_red_pulsatile = random.random() * 0.3
-                low_level_bcg_rms = random.random() + 0.5
-
-            has_ecg = random.random() > 0.02
-
-            ecg_q_amp = ""
-            ecg_q_loc = ""
-            ecg_r_amp = ""
-            ecg_r_loc = ""
-            ecg_s_amp = ""
-            ecg_s_loc = ""
-            ecg_t_peak_amp = ""
-            ecg_t_peak_loc = ""
-            ecg_t_end_amp = ""
-            ecg_t_end_loc = ""
-
-            if has_ecg:
-                ecg_q_amp = random.randint(-5, 15)
-                ecg_q_loc = random.randint(-45, -25)
-                ecg_r_amp = random.randint(70, 150)
-                ecg_r_loc = 0
-                ecg_s_amp = random.randint(-50, -10)
-                ecg_s_loc = random.randint(40, 70)
-                ecg_t_peak_amp = random.randint(-20, -10)
-                ecg_t_peak_loc = random.randint(80, 250)
-                ecg_t_end_amp = random.randint(-10, 10)
-                ecg_t_end_loc = random.randint(300, 600)
-
-            has_bcg = random.random() > 0.5
-
-            bcg_h_amp = ""
-            bcg_h_loc = ""
-            bcg_i_amp = ""
-            bcg_i_loc = ""
-            bcg_j_amp = ""
-            bcg_j_loc = ""
-
-            if has_bcg:
-                bcg_h_amp = random.random()
-                bcg_h_loc = random.randint(70, 150)
-                bcg_i_amp = random.random() * -1
-                bcg_i_loc = random.randint(100, 150)
-                bcg_j_amp = random.random()
-                bcg_j_loc = random.randint(150, 300)
-
-            has_ppg = random.random() > 0.6
-
-            ppg_ir_min_amp = ""
-            ppg_ir_min_loc = ""
-            ppg_ir_peak_amp = ""
-            ppg_ir_peak_loc = ""
-            ppg_ir_red_min_amp = ""
-            ppg_ir_red_min_loc = ""
-            ppg_ir_red_peak_amp = ""
-            ppg_ir_red_peak_loc = ""
-
-            if has_ppg:
-                ppg_ir_min_amp = random.random()
-                ppg_ir_min_loc = random.randint(100, 300)
-                ppg_ir_peak_amp = random.random()
-                ppg_ir_peak_loc = random.randint(100, 300)
-                ppg_ir_red_min_amp = random.random()
-                ppg_ir_red_min_loc = random.randint(100, 300)
-                ppg_ir_red_peak_amp = random.random()
-                ppg_ir_red_peak_loc = random.randint(100, 300)
-
-            channel_format = "<" + str(random.randint(10, 30)) + "000f"
-
-            # create a new row in the CSV file
-            f.write(sui + "," + str(timestamp) + "," + str(duration) + "," + str(hr) + "," + str(hrv) + "," +
-                    str(qtc) + "," + str(qrs) + "," + str(spo2) + "," + str(dbp) + "," + str(sbp) + "," + str(pwv) +
-                    "," + str(sv) + "," + str(co) + "," + str(cardiac_index) + "," + str(sv_index) + "," + str(ptt) +
-                    "," + str(pat) + "," + str(seat_weight) + "," + r_peak_loc + "," + str(respiration_rate) + "," +
-                    str(ecg_elec_imped) + "," + str(low_level_ppg_ir_dc) + "," + str(low_level_ppg_ir_pulsatile) + "," +
-                    str(low_level_ppg_red_dc) + "," + str(low_level_ppg_red_pulsatile) + "," + str(low_level_bcg_rms) +
-                    "," + str(ecg_q_amp) + "," + str(ecg_q_loc) + "," + str(ecg_r_amp) + "," + str(ecg_r_loc) + "," +
-                    str(ecg_s_amp) + "," + str(ecg_s_loc) + "," + str(ecg_t_peak_amp) + "," + str(ecg_t_peak_loc) + "," +
-                    str(ecg_t_end_amp) + "," + str(ecg_t_end_loc) + "," + str(bcg_h_amp) + "," + str(bcg_h_loc) + "," +
-                    str(bcg_i_amp) + "," + str(bcg_i_loc) + "," + str(bcg_j_amp) + "," + str(bcg_j_loc) + "," +
-                    str(ppg_ir_min_amp) + "," + str(ppg_ir_min_loc) + "," + str(ppg_ir_peak_amp) + "," +
-                    str(ppg_ir_peak_loc) + "," + str(ppg_ir_red_min_amp) + "," + str(ppg_ir_red_min_loc) + "," +
-                    str(ppg_ir_red_peak_amp) + "," + str(ppg_ir_red_peak_loc) + "," + str(channel_format) + "\n")
+    seed = np.random.SeedSequence(args.seed)
+    user_seed, size_seed, chunk_seed = seed.spawn(3)
+    sizes = np.random.default_rng(size_seed)
+    rows = args.rows if args.rows is not None else int(sizes.integers(10000, 15001))
+    suis, starts = make_users(user_seed, args.suis if args.suis is not None else int(sizes.integers(10, 21)),
+                              args.end_date)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+
+    if args.json:
+        user = sizes.integers(0, len(suis), len(filenames))
+        timestamps = format_timestamps(starts[user] + sizes.integers(0, TRIAL_DAYS * 24 * 60 * 60 + 1, len(user)))
+        arguments = (chunk_seed.spawn(len(filenames)), filenames, [suis[i] for i in user], timestamps,
+                     [args.duration] * len(filenames), [not args.noise_ecg] * len(filenames))
+        if jobs == 1 or len(filenames) == 1:
+            peaks = list(map(generate_recording, *arguments))
+        else:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as executor:
+                peaks = list(executor.map(generate_recording, *arguments))
+        print("Wrote " + str(len(filenames)) + " recording" + ("s" if len(filenames) > 1 else "") + " of " +
+              str(args.duration) + " s with " + str(sum(peaks)) + " R-peaks.")
+        return
+
+    # the chunks do not depend on the shards, so that the shards hold the same rows as a single file would; a chunk
+    # that spans the end of a shard is split between it and the next
+    chunks = [min(CHUNK_ROWS, rows - start) for start in range(0, rows, CHUNK_ROWS)]
+    seeds = chunk_seed.spawn(len(chunks))
+    shard_rows = [(i + 1) * rows // args.shards - i * rows // args.shards for i in range(args.shards)]
+    executor = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(chunks) > 1 else None
+    generate = functools.partial(map_bounded, executor, window=CHUNKS_PER_JOB * jobs) if executor else map
+    try:
+        text = generate(generate_chunk, seeds, chunks, [suis] * len(chunks), [starts] * len(chunks),
+                        [missing_rates] * len(chunks))
+        chunk_text = zip(chunks, text)
+        pending_rows, pending = 0, ""
+        for filename, count in zip(filenames, shard_rows):
+            # write the output file
+            with open(filename, 'w') as f:
+                f.write(','.join(HEADERS) + '\n')
+                while count > 0:
+                    if pending_rows == 0:
+                        pending_rows, pending = next(chunk_text)
+                    if pending_rows > count:
+                        head, pending = split_lines(pending, count)
+                        f.write(head)
+                        pending_rows -= count
+                        count = 0
+                    else:
+                        f.write(pending)
+                        count -= pending_rows
+                        pending_rows = 0
+    finally:
+        if executor:
+            executor.shutdown()
+    print("Wrote " + str(rows) + " rows for " + str(len(suis)) + " SUIs to " + str(len(filenames)) + " file" +
+          ("s" if len(filenames) > 1 else "") + ".")
 
 
 if __name__ == '__main__':
@@ -1,11 +1,115 @@
-import sys
+import argparse
+import binascii
+import mmap
+import os
+import re
 import struct
 import base64
 import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+
+"""
+Generate CSV file from JSON data. First argument is the JSON file, second is the output file. With --format binary, the
+channels are written as a binary waveform file instead, which read_binary maps back into memory without parsing it.
+
+With --batch, the first argument is a directory of JSON files or a text file listing one per line, and the second is the
+directory to write to. The files are converted in a process pool, files whose output is newer than them are skipped,
+and a summary of the batch is written to summary.json in the output directory.
+
+Recordings are read from a memory map of the JSON file, and the base64 string of each channel is decoded a slice at a
+time as the output is written, so memory does not grow with the length of the recording.
+
+With --pyramid, the minimum and maximum of every 10, 100 and 1000 samples of each channel are written next to the
+output, so a plot of a long recording can read, through read_pyramid and envelope, only the bins it has pixels for.
+"""
+
+"""
+The channels written to the CSV file, in column order, and its header line.
+"""
+LEADS = ["ecg", "ppg_ir", "ppg_red", "weight_br", "weight_fr", "weight_bl", "bcg_br", "bcg_fr", "bcg_bl", "bcg_fl"]
+CSV_HEADER = "10 leads sampled @1.0ms, 1,\n"
+"""
+Number of rows formatted and written at a time.
+"""
+WRITE_BLOCK_ROWS = 100_000
+"""
+The time between two samples, in milliseconds.
+"""
+SAMPLE_PERIOD_MS = 1.0
+
+"""
+Number of bytes of base64 text decoded at a time.
+"""
+DECODE_BLOCK = 1 << 20
+"""
+Every byte that is not part of the base64 alphabet; base64.decodebytes ignores them.
+"""
+NOT_BASE64 = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+JSON_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+JSON_SCALAR = re.compile(rb'[^,}\]\s]+')
+JSON_NESTED = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+WHITESPACE = re.compile(rb'\s*')
+
+"""
+The extension of the output files of each format, in batch mode.
+"""
+OUTPUT_EXTENSIONS = {"csv": ".csv", "binary": ".bin"}
+BATCH_SUMMARY = "summary.json"
+
+"""
+Layout of a binary waveform file: BINARY_MAGIC, the length of the JSON header as a little-endian uint32, the JSON header
+padded with spaces so the samples start on a BINARY_ALIGNMENT boundary, then the samples as little-endian float32, one
+row of len(LEADS) channels per sample. Channels that could not be decoded hold NaN.
+"""
+BINARY_MAGIC = b"SEATECG1"
+BINARY_VERSION = 1
+BINARY_DTYPE = "<f4"
+BINARY_ALIGNMENT = 64
+
+"""
+Layout of a pyramid file, written next to a converted recording with --pyramid: PYRAMID_MAGIC, the length of the JSON
+header as a little-endian uint32, the JSON header padded like that of a binary waveform file, then each level in turn.
+A level holds the minimum and maximum of every PYRAMID_FACTORS[level] samples of each channel as float32, with the
+minimums then the maximums of one channel after the other, so the bins of a channel are contiguous.
+"""
+PYRAMID_MAGIC = b"SEATPYR1"
+PYRAMID_FACTORS = (10, 100, 1000)
+PYRAMID_SUFFIX = ".pyramid"
+
+"""
+The kind of numpy type of each `struct` type code that a channel format may use: signed, unsigned or float.
 """
-Generate CSV file from JSON data. First argument is the JSON file, second is the output file.
+STRUCT_KINDS = {
+    'b': 'i', 'B': 'u', 'h': 'i', 'H': 'u', 'i': 'i', 'I': 'u', 'l': 'i', 'L': 'u', 'q': 'i', 'Q': 'u', 'n': 'i',
+    'N': 'u', 'e': 'f', 'f': 'f', 'd': 'f',
+}
 """
+The numpy byte order of each `struct` byte order character.
+"""
+STRUCT_BYTE_ORDERS = {'<': '<', '>': '>', '!': '>', '=': '=', '@': '='}
+
+
+def channel_dtype(fmt):
+    """
+    Convert a channel format to a numpy type.
+
+    Args:
+        fmt (str): `struct` format of one channel: an optional byte order, a count and a single type code, such as
+            "<12000f"
+    Returns:
+        numpy.dtype: the type of one sample
+    Raises:
+        ValueError: if the format is not made of a single type code
+    """
+    prefix = fmt[0] if fmt[:1] in STRUCT_BYTE_ORDERS else '@'
+    count, code = fmt[len(fmt) - len(fmt.lstrip('<>!=@')):-1], fmt[-1:]
+    if code not in STRUCT_KINDS or not (count.isdigit() or count == ''):
+        raise ValueError("unsupported channel format " + repr(fmt))
+    # struct.calcsize gives the size of the type with the byte order's standard or native sizes
+    return np.dtype(STRUCT_BYTE_ORDERS[prefix] + STRUCT_KINDS[code] + str(struct.calcsize(prefix + code)))
 
 
 def decode_channel(channel_data, fmt):
@@ -15,35 +119,42 @@ def decode_channel(channel_data, fmt):
     Args:
         channel_data (str): base64 channel data
         fmt (str): format for `struct` package
+    Returns:
+        numpy.ndarray: the samples, typed and ordered as `fmt` says
+    Raises:
+        ValueError: if the data cannot be decoded or its length does not match the format
     """
     if isinstance(channel_data, str):
         channel_data = channel_data.encode('utf-8')
+    dtype = channel_dtype(fmt)
     b64_decoded = base64.decodebytes(channel_data)
-    try:
-        return struct.unpack(fmt, b64_decoded)
-    except:
-        return "BUSTED"
+    if len(b64_decoded) != struct.calcsize(fmt):
+        raise ValueError("expected " + str(struct.calcsize(fmt)) + " bytes for format " + repr(fmt) + ", found " +
+                         str(len(b64_decoded)))
+    return np.frombuffer(b64_decoded, dtype=dtype)
 
 
 def decode_channels(channels, fmt):
     """
-    Update the r_dict in-place (without generating a copy) to encode the data lists as base64 packed binary strings.
+    Decode the base64 packed binary strings of every channel into numpy arrays.
 
     Args:
         channels (dict): Channel waveforms, packed as base64.
         fmt (str): struct format for channel data.
     Returns:
-        dict: channel waveform as tuples of floats.
+        tuple: a dict of the channel waveforms as numpy arrays, and a dict of the error message of each channel that
+        could not be decoded; those channels are left out of the first dict.
     """
     ret = {}
+    errors = {}
 
     for ch in channels:
         try:
             ret[ch] = decode_channel(channels[ch], fmt)
-        except:
-            ret[ch] = "BUSTED"
+        except (ValueError, TypeError, struct.error) as e:
+            errors[ch] = str(e)
 
-    return ret
+    return ret, errors
 
 
 def unpack_rit_json(json_as_bytes):
@@ -55,24 +166,765 @@ def unpack_rit_json(json_as_bytes):
         dict: Dictionary holding clinical data.
     """
     rit_data = json.loads(json_as_bytes)
-    rit_data['channels'] = decode_channels(rit_data['channels'], rit_data['channel_format'])
+    rit_data['channels'], rit_data['channel_errors'] = decode_channels(rit_data['channels'], rit_data['channel_format'])
     return rit_data
 
 
+def format_block(channels, start):
+    """
+    Format rows of the CSV file.
+
+    Args:
+        channels (dict): the samples of each channel for the rows, as numpy arrays.
+        start (int): index of the first row.
+    Returns:
+        str: the rows, each ending with ",\\n". A channel that is missing or shorter than the rows has empty cells.
+    """
+    rows = max((len(channels[x]) for x in LEADS if x in channels), default=0)
+    columns = [map(str, range(start, start + rows))]
+    for x in LEADS:
+        values = format_values(channels[x]) if x in channels else []
+        columns.append(values + [""] * (rows - len(values)))
+    return ",\n".join(map(",".join, zip(*columns))) + ",\n"
+
+
+def format_values(values):
+    """
+    Convert samples to text the way str() converts the numbers from struct.unpack. Sensor samples repeat a lot, so
+    each distinct value is converted once.
+
+    Args:
+        values (numpy.ndarray): samples of one channel.
+    Returns:
+        list: the text of each sample.
+    """
+    # compare the bits rather than the values, so that 0.0 and -0.0 (and NaNs) keep their own text
+    bits = values.view('u' + str(values.dtype.itemsize))
+    uniques, inverse = np.unique(bits, return_inverse=True)
+    # tolist gives the same Python numbers, and so the same text, as struct.unpack did
+    text = np.array([str(v) for v in uniques.view(values.dtype).tolist()], dtype=object)
+    return text[inverse.reshape(-1)].tolist()
+
+
+def array_blocks(channels, block_rows=WRITE_BLOCK_ROWS):
+    """
+    Split decoded channels into blocks of rows, for write_csv and write_binary.
+
+    Args:
+        channels (dict): Channel waveforms as numpy arrays.
+        block_rows (int): number of rows per block.
+    Returns:
+        generator: for each block, a dict of the samples of each channel.
+    """
+    rows = max((len(channels[x]) for x in LEADS if x in channels), default=0)
+    for start in range(0, rows, block_rows):
+        yield {x: channels[x][start:start + block_rows] for x in LEADS if x in channels}
+
+
+def write_csv(file, blocks):
+    """
+    Write channels to a CSV file with one row per sample, a block of rows at a time.
+
+    Args:
+        file: the CSV file, open for writing text.
+        blocks: for each block of rows in order, a dict of the samples of each channel, as from array_blocks or
+            Recording.blocks.
+    """
+    file.write(CSV_HEADER)
+    start = 0
+    for block in blocks:
+        text = format_block(block, start)
+        file.write(text)
+        start += max((len(values) for values in block.values()), default=0)
+
+
+def write_binary(file, blocks, rows, metadata):
+    """
+    Write channels to a binary waveform file, a block of rows at a time.
+
+    Args:
+        file: the output file, open for writing bytes.
+        blocks: for each block of rows in order, a dict of the samples of each channel, as from array_blocks or
+            Recording.blocks.
+        rows (int): the total number of rows of the blocks.
+        metadata (dict): information about the recording stored in the header, such as its SUI and channel format.
+    """
+    header = {
+        "version": BINARY_VERSION,
+        "sample_rate_hz": 1000 / SAMPLE_PERIOD_MS,
+        "channels": LEADS,
+        "rows": rows,
+        "dtype": BINARY_DTYPE,
+        "source": metadata,
+    }
+    header = json.dumps(header).encode('utf-8')
+    prefix = len(BINARY_MAGIC) + 4
+    header += b" " * (-(prefix + len(header)) % BINARY_ALIGNMENT)
+    file.write(BINARY_MAGIC + struct.pack("<I", len(header)) + header)
+    for channels in blocks:
+        block_rows = max((len(values) for values in channels.values()), default=0)
+        block = np.full((block_rows, len(LEADS)), np.nan, dtype=BINARY_DTYPE)
+        for column, x in enumerate(LEADS):
+            if x in channels:
+                block[:len(channels[x]), column] = channels[x]
+        file.write(block.tobytes())
+
+
+def read_binary(filename):
+    """
+    Map a binary waveform file into memory.
+
+    Args:
+        filename (str): path of the file written by write_binary.
+    Returns:
+        tuple: the header as a dict, and the samples as a read-only numpy.memmap with one row per sample and one
+        column per channel in header["channels"].
+    Raises:
+        ValueError: if the file is not a binary waveform file.
+    """
+    with open(filename, "rb") as f:
+        prefix = f.read(len(BINARY_MAGIC) + 4)
+        if len(prefix) < len(BINARY_MAGIC) + 4 or prefix[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+            raise ValueError(filename + " is not a binary waveform file")
+        length = struct.unpack("<I", prefix[len(BINARY_MAGIC):])[0]
+        header = json.loads(f.read(length))
+    if header.get("version") != BINARY_VERSION:
+        raise ValueError(filename + " has unsupported version " + str(header.get("version")))
+    shape = (header["rows"], len(header["channels"]))
+    if header["rows"] == 0:
+        return header, np.zeros(shape, dtype=header["dtype"])
+    return header, np.memmap(filename, dtype=header["dtype"], mode='r', offset=len(prefix) + length, shape=shape)
+
+
+class PyramidWriter:
+    """
+    Write the min/max pyramid of a recording as its blocks of rows go by.
+    """
+    def __init__(self, file, rows, factors=PYRAMID_FACTORS):
+        """
+        Writes the header of a pyramid file.
+
+        Args:
+            file: the output file, open for writing bytes.
+            rows (int): the total number of rows of the recording.
+            factors (tuple): the number of samples per bin of each level, each a multiple of the one before.
+        """
+        self.file = file
+        self.factors = factors
+        """
+        The number of samples of the recording added so far.
+        """
+        self.start = 0
+        itemsize = np.dtype(BINARY_DTYPE).itemsize
+        levels = []
+        offset = 0
+        for factor in factors:
+            level_rows = -(-rows // factor)
+            levels.append({"factor": factor, "rows": level_rows, "offset": offset})
+            offset += len(LEADS) * 2 * level_rows * itemsize
+        header = {
+            "version": BINARY_VERSION,
+            "sample_rate_hz": 1000 / SAMPLE_PERIOD_MS,
+            "channels": LEADS,
+            "rows": rows,
+            "dtype": BINARY_DTYPE,
+            "levels": levels,
+        }
+        header = json.dumps(header).encode('utf-8')
+        prefix = len(PYRAMID_MAGIC) + 4
+        header += b" " * (-(prefix + len(header)) % BINARY_ALIGNMENT)
+        file.write(PYRAMID_MAGIC + struct.pack("<I", len(header)) + header)
+        """
+        The position in the file of each level, and the size of the file once every level is written.
+        """
+        self.positions = [prefix + len(header) + level["offset"] for level in levels]
+        self.levels = levels
+        self.size = prefix + len(header) + offset
+        file.truncate(self.size)
+
+    def add(self, channels):
+        """
+        Add the next block of rows. Every block but the last must have a multiple of the largest factor of rows.
+
+        Args:
+            channels (dict): the samples of each channel for the rows, as from Recording.blocks.
+        """
+        block_rows = max((len(values) for values in channels.values()), default=0)
+        if block_rows == 0:
+            return
+        block = np.full((len(LEADS), block_rows), np.nan, dtype=BINARY_DTYPE)
+        for row, x in enumerate(LEADS):
+            if x in channels:
+                block[row, :len(channels[x])] = channels[x]
+        # each level is reduced from the one below it, starting from the samples
+        lows, highs, previous = block, block, 1
+        itemsize = block.itemsize
+        for factor, level, position in zip(self.factors, self.levels, self.positions):
+            bins = np.arange(0, lows.shape[1], factor // previous)
+            lows = np.minimum.reduceat(lows, bins, axis=1)
+            highs = np.maximum.reduceat(highs, bins, axis=1)
+            first = self.start // factor
+            for row in range(len(LEADS)):
+                for side, values in enumerate((lows, highs)):
+                    self.file.seek(position + ((row * 2 + side) * level["rows"] + first) * itemsize)
+                    self.file.write(values[row].tobytes())
+            previous = factor
+        self.start += block_rows
+
+
+def pyramid_blocks(blocks, writer):
+    """
+    Pass blocks of rows through to a writer of the converted recording, adding each to a pyramid on the way.
+
+    Returns:
+        generator: the blocks, unchanged.
+    """
+    for block in blocks:
+        writer.add(block)
+        yield block
+
+
+def read_pyramid(filename):
+    """
+    Map a pyramid file into memory.
+
+    Args:
+        filename (str): path of the file written by PyramidWriter.
+    Returns:
+        tuple: the header as a dict, and for each level, from the finest, a read-only numpy.memmap with one row per
+        channel in header["channels"], one row for the minimums and one for the maximums, and one column per bin.
+    Raises:
+        ValueError: if the file is not a pyramid file.
+    """
+    with open(filename, "rb") as f:
+        prefix = f.read(len(PYRAMID_MAGIC) + 4)
+        if len(prefix) < len(PYRAMID_MAGIC) + 4 or prefix[:len(PYRAMID_MAGIC)] != PYRAMID_MAGIC:
+            raise ValueError(filename + " is not a pyramid file")
+        length = struct.unpack("<I", prefix[len(PYRAMID_MAGIC):])[0]
+        header = json.loads(f.read(length))
+    if header.get("version") != BINARY_VERSION:
+        raise ValueError(filename + " has unsupported version " + str(header.get("version")))
+    levels = []
+    for level in header["levels"]:
+        shape = (len(header["channels"]), 2, level["rows"])
+        if level["rows"] == 0:
+            levels.append(np.zeros(shape, dtype=header["dtype"]))
+        else:
+            levels.append(np.memmap(filename, dtype=header["dtype"], mode='r', shape=shape,
+                                    offset=len(prefix) + length + level["offset"]))
+    return header, levels
+
+
+def envelope(pyramid, channel, start, stop, pixels, samples=None):
+    """
+    Get the min/max envelope of a channel over a range of samples at the resolution of a plot, from the coarsest level
+    of a pyramid that still has a bin per pixel.
+
+    Args:
+        pyramid (tuple): the header and levels from read_pyramid.
+        channel (str): the name of the channel.
+        start (int): the first sample of the range.
+        stop (int): the sample after the range.
+        pixels (int): the width of the plot in pixels.
+        samples (numpy.ndarray): the samples from read_binary, used instead of the finest level when it has fewer bins
+            than pixels; optional.
+    Returns:
+        tuple: the first sample of each bin, and the minimum and maximum of each bin, as numpy arrays.
+    """
+    header, levels = pyramid
+    column = header["channels"].index(channel)
+    start, stop = max(start, 0), min(stop, header["rows"])
+    chosen = None
+    for level, values in zip(header["levels"], levels):
+        if (stop - start) // level["factor"] >= pixels or chosen is None:
+            chosen = (level["factor"], values)
+    factor, values = chosen
+    if samples is not None and (stop - start) // factor < pixels:
+        raw = np.asarray(samples[start:stop, column])
+        return np.arange(start, stop), raw, raw
+    first, last = start // factor, -(-stop // factor)
+    return np.arange(first, last) * factor, np.asarray(values[column, 0, first:last]), \
+        np.asarray(values[column, 1, first:last])
+
+
 def read_json(filename):
     with open(filename, "rb") as f:
         return unpack_rit_json(f.read())
 
 
-rit_datas = read_json(sys.argv[1])
+def clean_base64(text):
+    """
+    Remove what base64.decodebytes would ignore from base64 text taken from a JSON string, including the escaped line
+    breaks that base64.encodebytes adds.
+    """
+    text = text.replace(b"\\n", b"")
+    if b"\\r" in text:
+        text = text.replace(b"\\r", b"")
+    # deleting the backslash of an escaped slash leaves the slash
+    return text.translate(None, NOT_BASE64)
+
+
+class ChannelReader:
+    """
+    Decodes the base64 string of one channel, from a memory-mapped JSON file, a slice at a time.
+    """
+    def __init__(self, data, start, stop, dtype):
+        """
+        The memory-mapped file, the position of the next byte of the channel's string and the position after it.
+        """
+        self.data = data
+        self.position = start
+        self.stop = stop
+        self.dtype = dtype
+        """
+        Cleaned base64 text that did not make a whole group of 4 characters, and decoded bytes that did not make a
+        whole sample.
+        """
+        self.text = b""
+        self.decoded = b""
+
+    def read(self, count):
+        """
+        Decode the next samples of the channel.
+
+        Args:
+            count (int): the number of samples to decode.
+        Returns:
+            numpy.ndarray: the samples; fewer than count at the end of the channel.
+        """
+        size = count * self.dtype.itemsize
+        parts = [self.decoded]
+        decoded = len(self.decoded)
+        while decoded < size and self.position < self.stop:
+            end = min(self.position + DECODE_BLOCK, self.stop)
+            if self.data[end - 1] == ord("\\") and end < self.stop:
+                # keep an escape sequence in one slice
+                end += 1
+            text = self.text + clean_base64(self.data[self.position:end])
+            self.position = end
+            whole = len(text) - len(text) % 4
+            self.text = text[whole:]
+            parts.append(binascii.a2b_base64(text[:whole]))
+            decoded += len(parts[-1])
+        buffer = b"".join(parts)
+        size = min(size, len(buffer) - len(buffer) % self.dtype.itemsize)
+        self.decoded = buffer[size:]
+        return np.frombuffer(buffer[:size], dtype=self.dtype)
+
+
+class ArrayReader:
+    """
+    Gives the samples of a channel that is already decoded, a slice at a time, like ChannelReader.
+    """
+    def __init__(self, values):
+        self.values = values
+        self.position = 0
+
+    def read(self, count):
+        values = self.values[self.position:self.position + count]
+        self.position += len(values)
+        return values
+
+
+class Recording:
+    """
+    A JSON recording read from a memory map: its fields, and a reader for each channel that can be decoded.
+    """
+    def __init__(self, data):
+        """
+        The fields of the recording other than its channels, and the error of each channel that cannot be decoded.
+        """
+        self.fields, spans = scan_recording(data)
+        self.channel_errors = {}
+        """
+        The reader of each channel that can be decoded, and the number of samples of each of them.
+        """
+        self.readers = {}
+        self.rows = 0
+
+        fmt = self.fields["channel_format"]
+        for ch, span in spans.items():
+            try:
+                if isinstance(span, str):
+                    raise ValueError(span)
+                start, stop = span
+                length = decoded_length(data, start, stop)
+                if length is None:
+                    # the string uses escapes that only a JSON parser undoes
+                    reader = ArrayReader(decode_channel(json.loads(data[start - 1:stop + 1]), fmt))
+                else:
+                    dtype = channel_dtype(fmt)
+                    if length != struct.calcsize(fmt):
+                        raise ValueError("expected " + str(struct.calcsize(fmt)) + " bytes for format " + repr(fmt) +
+                                         ", found " + str(length))
+                    reader = ChannelReader(data, start, stop, dtype)
+            except (ValueError, TypeError, struct.error) as e:
+                self.channel_errors[ch] = str(e)
+                continue
+            self.readers[ch] = reader
+        if self.readers:
+            self.rows = struct.calcsize(fmt) // channel_dtype(fmt).itemsize
+
+    def blocks(self, block_rows=WRITE_BLOCK_ROWS):
+        """
+        Decode the channels a block of rows at a time, for write_csv and write_binary.
+
+        Args:
+            block_rows (int): number of rows per block.
+        Returns:
+            generator: for each block, a dict of the samples of each channel that can be decoded.
+        """
+        for start in range(0, self.rows, block_rows):
+            yield {ch: reader.read(min(block_rows, self.rows - start)) for ch, reader in self.readers.items()}
+
+
+def decoded_length(data, start, stop):
+    """
+    Find the number of bytes a base64 string in a JSON file decodes to, without decoding it.
+
+    Args:
+        data: the memory-mapped file.
+        start (int): the position of the first character of the string.
+        stop (int): the position after its last character.
+    Returns:
+        int: the number of bytes, or None if the string uses JSON escapes other than line breaks and slashes.
+    """
+    length = 0
+    tail = b""
+    position = start
+    while position < stop:
+        end = min(position + DECODE_BLOCK, stop)
+        if data[end - 1] == ord("\\") and end < stop:
+            end += 1
+        text = data[position:end]
+        if re.search(rb"\\[^nr/]", text):
+            return None
+        # each escaped line break leaves its letter once the backslashes are deleted
+        length += len(text.translate(None, NOT_BASE64)) - text.count(b"\\n") - text.count(b"\\r")
+        # the padding is in the last characters; start them after a whole escape sequence
+        last = max(len(text) - 16, 0)
+        if last > 0 and text[last - 1] == ord("\\"):
+            last += 1
+        tail = (tail + clean_base64(text[last:]))[-2:]
+        position = end
+    return length // 4 * 3 - tail.count(b"=")
+
+
+def scan_recording(data):
+    """
+    Find the fields of a JSON recording and where the string of each channel is, without parsing those strings.
+
+    Args:
+        data: the memory-mapped JSON file.
+    Returns:
+        tuple: a dict of the fields other than the channels, and a dict of the (start, stop) position of the string
+        of each channel, or an error message for a channel that is not a string.
+    Raises:
+        ValueError: if the file is not a JSON object.
+    """
+    fields = {}
+    spans = {}
+    position = expect(data, skip_whitespace(data, 0), b"{")
+    while True:
+        position = skip_whitespace(data, position)
+        if data[position:position + 1] == b"}":
+            return fields, spans
+        key, position = read_string(data, position)
+        position = skip_whitespace(data, expect(data, skip_whitespace(data, position), b":"))
+        if key == "channels" and data[position:position + 1] == b"{":
+            position = scan_channels(data, position, spans)
+        else:
+            end = value_end(data, position)
+            fields[key] = json.loads(data[position:end])
+            position = end
+        position = skip_whitespace(data, position)
+        if data[position:position + 1] == b",":
+            position += 1
+
+
+def scan_channels(data, position, spans):
+    """
+    Find where the string of each channel is, in the "channels" object of a JSON recording.
+
+    Returns:
+        int: the position after the object.
+    """
+    position = expect(data, position, b"{")
+    while True:
+        position = skip_whitespace(data, position)
+        if data[position:position + 1] == b"}":
+            return position + 1
+        key, position = read_string(data, position)
+        position = skip_whitespace(data, expect(data, skip_whitespace(data, position), b":"))
+        if data[position:position + 1] == b'"':
+            spans[key] = (position + 1, string_end(data, position) - 1)
+            position = string_end(data, position)
+        else:
+            end = value_end(data, position)
+            spans[key] = "expected a base64 string, found " + data[position:end][:20].decode('utf-8', 'replace')
+            position = end
+        position = skip_whitespace(data, position)
+        if data[position:position + 1] == b",":
+            position += 1
+
+
+def skip_whitespace(data, position):
+    return WHITESPACE.match(data, position).end()
+
+
+def expect(data, position, token):
+    """
+    Returns:
+        int: the position after token, which must be at position.
+    """
+    if data[position:position + len(token)] != token:
+        raise ValueError("expected " + token.decode() + " at byte " + str(position))
+    return position + len(token)
+
+
+def string_end(data, position):
+    """
+    Returns:
+        int: the position after the JSON string that starts at position. Uses find rather than a regular expression,
+        so that long channel strings are skipped quickly.
+    """
+    end = position + 1
+    while True:
+        quote = data.find(b'"', end)
+        if quote < 0:
+            raise ValueError("unterminated string at byte " + str(position))
+        backslash = quote
+        while data[backslash - 1] == ord("\\"):
+            backslash -= 1
+        if (quote - backslash) % 2 == 0:
+            return quote + 1
+        end = quote + 1
+
+
+def read_string(data, position):
+    """
+    Returns:
+        tuple: the JSON string at position, decoded, and the position after it.
+    """
+    if data[position:position + 1] != b'"':
+        raise ValueError("expected a string at byte " + str(position))
+    end = string_end(data, position)
+    return json.loads(data[position:end]), end
+
+
+def value_end(data, position):
+    """
+    Returns:
+        int: the position after the JSON value that starts at position.
+    """
+    first = data[position:position + 1]
+    if first == b'"':
+        return string_end(data, position)
+    if first not in (b"{", b"["):
+        match = JSON_SCALAR.match(data, position)
+        if match is None:
+            raise ValueError("expected a value at byte " + str(position))
+        return match.end()
+    depth = 0
+    for match in JSON_NESTED.finditer(data, position):
+        token = match.group()
+        if token in (b"{", b"["):
+            depth += 1
+        elif token in (b"}", b"]"):
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    raise ValueError("unterminated value at byte " + str(position))
+
+
+def convert_file(json_file, output_file, fmt="csv", pyramid=False):
+    """
+    Convert one JSON recording, decoding its channels a block of rows at a time as the output is written. The output
+    is written next to its final path and renamed into place, so an interrupted conversion does not leave an output
+    that looks complete.
+
+    Args:
+        json_file (str): path of the JSON recording.
+        output_file (str): path of the file to write.
+        fmt (str): "csv" or "binary".
+        pyramid (bool): when True, the min/max pyramid of the channels is also written to output_file + PYRAMID_SUFFIX.
+    Returns:
+        dict: the number of samples converted and the error of each channel that could not be decoded.
+    """
+    pyramid_file = output_file + PYRAMID_SUFFIX
+    with open(json_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        recording = Recording(data)
+        blocks = recording.blocks()
+        if pyramid:
+            pyramid_out = open(pyramid_file + ".tmp", "wb")
+            blocks = pyramid_blocks(blocks, PyramidWriter(pyramid_out, recording.rows))
+        try:
+            if fmt == "binary":
+                metadata = dict(recording.fields, file=json_file, channel_errors=recording.channel_errors)
+                with open(output_file + ".tmp", "wb") as file:
+                    write_binary(file, blocks, recording.rows, metadata)
+            else:
+                with open(output_file + ".tmp", "w") as file:
+                    write_csv(file, blocks)
+        finally:
+            if pyramid:
+                pyramid_out.close()
+    if pyramid:
+        os.replace(pyramid_file + ".tmp", pyramid_file)
+    os.replace(output_file + ".tmp", output_file)
+    return {"samples": recording.rows, "channel_errors": recording.channel_errors}
+
+
+def batch_inputs(source):
+    """
+    List the JSON recordings of a batch.
+
+    Args:
+        source (str): a directory, whose .json files are converted, or a text file with the path of one recording per
+            line; relative paths are relative to the text file.
+    Returns:
+        list: the paths of the recordings.
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source) if name.lower().endswith(".json"))
+    with open(source, "r") as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(os.path.dirname(source), line) for line in lines if line and not line.startswith("#")]
+
+
+def is_up_to_date(json_file, output_file, pyramid=False):
+    """
+    Returns:
+        bool: True if the output, and its pyramid when asked for, exist and are newer than the recording.
+    """
+    outputs = [output_file, output_file + PYRAMID_SUFFIX] if pyramid else [output_file]
+    return all(os.path.exists(x) and os.path.getmtime(x) >= os.path.getmtime(json_file) for x in outputs)
+
+
+def convert_batch_file(json_file, output_file, fmt, pyramid=False):
+    """
+    Convert one recording of a batch, reporting a failure instead of raising it. Runs in worker processes.
+
+    Returns:
+        dict: the result of convert_file with the recording, its output, the time taken and the error, if any.
+    """
+    start = time.perf_counter()
+    result = {"file": json_file, "output": output_file, "samples": 0, "channel_errors": {}, "error": None}
+    try:
+        result.update(convert_file(json_file, output_file, fmt, pyramid))
+    except Exception as e:
+        result["error"] = type(e).__name__ + ": " + str(e)
+        for partial in (output_file + ".tmp", output_file + PYRAMID_SUFFIX + ".tmp"):
+            if os.path.exists(partial):
+                os.remove(partial)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def convert_batch(json_files, output_dir, fmt="csv", jobs=1, force=False, pyramid=False):
+    """
+    Convert many JSON recordings, in a process pool.
+
+    Args:
+        json_files (list): paths of the recordings.
+        output_dir (str): directory to write the outputs to, named after the recordings.
+        fmt (str): "csv" or "binary".
+        jobs (int): number of worker processes.
+        force (bool): when True, recordings are converted even if their output is up to date.
+        pyramid (bool): when True, the min/max pyramid of each recording is written next to its output.
+    Returns:
+        dict: the summary of the batch: counts of converted, skipped and failed files, the time taken, the
+        throughput, and the result of each file.
+    """
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    pending = []
+    outputs = {}
+    for json_file in json_files:
+        name = os.path.splitext(os.path.basename(json_file))[0] + OUTPUT_EXTENSIONS[fmt]
+        output_file = os.path.join(output_dir, name)
+        if output_file in outputs:
+            results.append({"file": json_file, "output": output_file, "status": "failed",
+                            "error": "same output file as " + outputs[output_file]})
+            continue
+        outputs[output_file] = json_file
+        if not os.path.exists(json_file):
+            results.append({"file": json_file, "output": output_file, "status": "failed", "error": "file not found"})
+        elif not force and is_up_to_date(json_file, output_file, pyramid):
+            results.append({"file": json_file, "output": output_file, "status": "skipped"})
+        else:
+            pending.append((json_file, output_file, fmt, pyramid))
+
+    if jobs == 1 or len(pending) <= 1:
+        converted = [convert_batch_file(*args) for args in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as executor:
+            converted = list(executor.map(convert_batch_file, *zip(*pending)))
+    for result in converted:
+        result["status"] = "failed" if result["error"] else "converted"
+        if result["error"]:
+            print("Could not convert " + result["file"] + ": " + result["error"])
+        for channel, error in result["channel_errors"].items():
+            print("Could not decode channel " + channel + " of " + result["file"] + ": " + error)
+        results.append(result)
+
+    seconds = time.perf_counter() - start
+    done = [result for result in results if result["status"] == "converted"]
+    samples = sum(result["samples"] for result in done)
+    return {
+        "converted": len(done),
+        "skipped": sum(result["status"] == "skipped" for result in results),
+        "failed": sum(result["status"] == "failed" for result in results),
+        "seconds": seconds,
+        "files_per_second": len(done) / seconds if seconds else 0,
+        "samples_per_second": samples / seconds if seconds else 0,
+        "files": results,
+    }
+
+
+def main(argv=None):
+    """
+    Convert a JSON recording, or a batch of them, as asked on the command line.
+
+    Args:
+        argv (list): the command line arguments, or None to use sys.argv.
+    Returns:
+        int: the exit status; 1 if any file failed to convert.
+    """
+    parser = argparse.ArgumentParser(description="Converts a seat JSON recording to a file of its ECG channels.")
+    parser.add_argument("json_file", help="The JSON recording to convert; with --batch, a directory of recordings or "
+                                          "a text file listing one per line.")
+    parser.add_argument("output_file", help="The file to write; with --batch, the directory to write to.")
+    parser.add_argument("--format", choices=["csv", "binary"], default="csv",
+                        help="csv writes one line of text per sample; binary writes float32 samples after a JSON "
+                             "header, which can be read back with read_binary")
+    parser.add_argument("--pyramid", action="store_true",
+                        help="Also write the minimums and maximums of every 10, 100 and 1000 samples next to the "
+                             "output, for plotting long recordings; see read_pyramid")
+    parser.add_argument("--batch", action="store_true", help="Convert every recording of a directory or list")
+    parser.add_argument("--jobs", type=int, default=1, help="With --batch, the number of processes converting "
+                                                              "recordings; 0 uses every CPU")
+    parser.add_argument("--force", action="store_true", help="With --batch, convert recordings even if their output "
+                                                             "is up to date")
+    arguments = parser.parse_args(argv)
+
+    if not arguments.batch:
+        result = convert_file(arguments.json_file, arguments.output_file, arguments.format, arguments.pyramid)
+        for channel, error in result["channel_errors"].items():
+            print("Could not decode channel " + channel + ": " + error)
+        return 0
+
+    jobs = arguments.jobs if arguments.jobs > 0 else os.cpu_count()
+    summary = convert_batch(batch_inputs(arguments.json_file), arguments.output_file, arguments.format, jobs,
+                            arguments.force, arguments.pyramid)
+    with open(os.path.join(arguments.output_file, BATCH_SUMMARY), "w") as f:
+        json.dump(summary, f, indent=2)
+    print("Converted " + str(summary["converted"]) + ", skipped " + str(summary["skipped"]) + ", failed " +
+          str(summary["failed"]) + " in " + str(round(summary["seconds"], 1)) + " s (" +
+          str(round(summary["samples_per_second"])) + " samples/s).")
+    return 1 if summary["failed"] else 0
+
 
-with open(sys.argv[2], "w") as file:
-    file.write("10 leads sampled @1.0ms, 1,\n")
-    i = 0
-    while i < len(rit_datas["channels"]["ecg"]):
-        s = str(i)
-        for x in ["ecg", "ppg_ir", "ppg_red", "weight_br", "weight_fr", "weight_bl", "bcg_br", "bcg_fr",
-                  "bcg_bl", "bcg_fl"]:
-            s += "," + str(rit_datas["channels"][x][i])
-        file.write(s + ",\n")
-        i += 1
+if __name__ == '__main__':
+    raise SystemExit(main())
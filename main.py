@@ -1,18 +1,21 @@
 import argparse
-import datetime
-import math
+import multiprocessing
 import os
+import time
 
-import matplotlib.pyplot as plt
 import io
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
 
-import img2pdf
-from PyPDF2 import PdfFileWriter, PdfFileReader
-from tqdm import tqdm
+from aggregation import parse_aggregate, aggregate_name
+from dataset import SeatDataset
+import export
+import table_cache
+from streaming import StreamScan, StreamAggregator, load_state, save_state
+from profiling import StageProfiler
 
-import textwrap
+# matplotlib, tqdm and the PDF packages are imported by the stages that use them, so a run that only saves a CSV file,
+# or prints the help, does not load them
 
 labels = {
     "clinical.sui": "subject unique identifier",
@@ -73,15 +76,17 @@ class SeatReader:
     """
     A class that contains logic for reading the .csv files and creating a graph.
     """
-    def __init__(self):
+    def __init__(self, argv=None, run=True):
         """
         Initialize attributes and call high-level methods.
+        :param argv: The command line arguments, or None to use sys.argv
+        :param run: When false, only the arguments are read; the stages can then be called one at a time, as run does
         """
 
         """
-        The name of the input file.
+        The names of the input files.
         """
-        self.filename = None
+        self.filenames = []
 
         """
         The list of unique SUI's in the input file, found using the 'clinical.sui' column.
@@ -129,6 +134,10 @@ class SeatReader:
         For each day, values within this number of days will be included in the average
         """
         self.avg_window_size = 1
+        """
+        How the values in each window are combined: mean, median or p<q> for the q-th percentile
+        """
+        self.aggregate = "mean"
 
         """
         When true, the program will crash instead of asking for input via stdin.
@@ -146,7 +155,74 @@ class SeatReader:
         If not None, specifies the name of the CSV where the averages should be saved
         """
         self.save_csv = None
+        """
+        If not None, specify the names of the NumPy .npz, JSON Lines and SQLite files where the averages should be saved
+        """
+        self.save_npz = None
+        self.save_jsonl = None
+        self.save_sqlite = None
+        """
+        If not None, specifies the name of the CSV where the completeness of each SUI and variable should be saved
+        """
+        self.save_completeness = None
+        """
+        When true, the graphs are neither shown nor saved, and the plotting packages are not loaded.
+        """
+        self.no_graph = False
+        """
+        When true, the parsed input file is read from and saved to a cache next to it.
+        """
+        self.use_cache = True
+        """
+        When true, the cache is rewritten even if it is up to date.
+        """
+        self.rebuild_cache = False
+        """
+        The number of worker processes used to render the images of the PDF.
+        """
+        self.jobs = 1
+        """
+        How the PDF is made: "raster" saves each graph as an image and combines the images, "vector" draws the graphs
+        straight into the PDF.
+        """
+        self.pdf_backend = "raster"
+        """
+        When true, the input file is read a chunk at a time into per-day totals instead of being loaded whole.
+        """
+        self.stream = False
+        """
+        If not None, the program keeps running and refreshes the saved files whenever lines are appended to the input
+        file, checking every this many seconds.
+        """
+        self.watch = None
+        """
+        If not None, each stage of run is measured, and a report is printed at the end.
+        """
+        self.profiler = None
+        """
+        If not None, instead of graphing, the program serves queries over HTTP on this port; see server.py.
+        """
+        self.serve = None
+
+        """
+        The input files loaded by read_table, and their column-oriented contents.
+        """
+        self.dataset = None
+        self.table = None
+        """
+        In --stream mode, the per-day totals and samples of every series, filled by get_data.
+        """
+        self.stream_state = None
+
+        """
+        The SUI's given on the command line, before they are resolved by check_args.
+        """
+        self.requested_suis = []
 
+        """
+        The series of the graphed SUI's and variables, from self.dataset; the attributes below refer to its lists.
+        """
+        self.aggregates = None
         """
         The list of data points for each variable for each SUI.
         """
@@ -167,47 +243,125 @@ class SeatReader:
         """
         self.missing_data = {}
 
-        self.get_args()
-        self.get_vars()
-        self.get_sui_list()
-        self.check_args()
-        self.get_data()
-        self.condense_data()
-        self.save_csv_file()
-        self.show_graph()
-
-    def interpret_var(self, val, var_type):
-        """
-        Most variables should be interpreted as floats, but timestamps should be converted to datetime objects.
-        :param val: The value to convert
-        :param var_type: The name of the column
-        :return: The value converted to the appropriate type
-        """
-        if var_type == "clinical.timestamp":
-            return datetime.datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-        elif var_type == "clinical.sui":
-            return val
-        else:
-            return float(val)
+        self.get_args(argv)
+        if run:
+            self.run()
+
+    def run(self):
+        """
+        Read the input files, then graph and save the data as the arguments ask, or serve them with --serve.
+        :return: None
+        """
+        if self.serve is not None:
+            from server import serve
+            serve(self.filenames, self.serve, identifying_var=self.identifying_var, use_cache=self.use_cache,
+                  jobs=self.jobs, labels=labels)
+            return
+        for stage in (self.read_table, self.get_vars, self.get_sui_list, self.check_args, self.get_data,
+                      self.condense_data, self.save_csv_file, self.show_graph):
+            if self.profiler is None:
+                stage()
+            else:
+                self.profiler.run(stage.__name__, stage, lambda: self.stage_counts(stage.__name__))
+        if self.profiler is not None:
+            self.print_profile()
+        if self.watch is not None:
+            self.watch_file()
+
+    def stage_counts(self, stage):
+        """
+        Count what a stage did, for --profile.
+        :param stage: The name of the stage
+        :return: A dict with the rows the stage processed, the figures it rendered and the bytes it wrote, where they
+        apply
+        """
+        counts = {}
+        if stage in ("read_table", "get_data"):
+            if not self.stream:
+                counts["rows"] = len(self.table)
+            elif stage == "read_table":
+                # only the lines appended since the saved state are read
+                counts["rows"] = self.table.last_rows
+            else:
+                counts["rows"] = self.stream_state.last_rows
+        elif stage == "save_csv_file" and self.export_files():
+            counts["bytes"] = sum(os.path.getsize(filename) for filename in self.export_files())
+        elif stage == "show_graph" and not self.no_graph:
+            counts["figures"] = 1 + 2 * len(self.user_sui_list) * len(self.graph_vars)
+            if self.save_pdf is not None:
+                counts["bytes"] = os.path.getsize(self.save_pdf)
+        return counts
+
+    def print_profile(self):
+        """
+        Print the time taken by each stage, and save the cProfile statistics of the slowest one if asked to.
+        :return: None
+        """
+        print("\nProfile:")
+        for line in self.profiler.report():
+            print(line)
+        slowest = self.profiler.dump()
+        if slowest is not None:
+            print("\nThe cProfile statistics of the slowest stage, " + slowest[0] + ", were saved to " +
+                  self.profiler.dump_file + ":")
+            for line in slowest[1]:
+                print(line)
+
+    def watch_file(self):
+        """
+        Refresh the saved files whenever lines are appended to the input file, until interrupted. Only the new lines
+        are read.
+        :return: None
+        """
+        print("\nWatching " + self.filenames[0] + " for new lines. Press Ctrl+C to stop.")
+        try:
+            while True:
+                time.sleep(self.watch)
+                end = self.table.end
+                self.read_table()
+                if self.table.end == end:
+                    continue
+                self.get_vars()
+                self.get_sui_list()
+                if self.requested_suis:
+                    self.user_sui_list = list(self.requested_suis)
+                self.check_args()
+                self.get_data()
+                self.condense_data()
+                self.save_csv_file()
+                if self.save_pdf is not None:
+                    self.show_graph()
+        except KeyboardInterrupt:
+            pass
+
+    def read_table(self):
+        """
+        Read the input files into a column-oriented table, each in a single pass, or map them in from their caches.
+        Several files are read in parallel and merged. In --stream mode, only scan the file for its variables and SUI's.
+        :return: None; results are stored in self.table
+        """
+        if self.stream:
+            if self.table is None:
+                state = None
+                if self.use_cache and not self.rebuild_cache:
+                    state = load_state(self.filenames[0], self.identifying_var)
+                if state is None:
+                    state = StreamScan(self.filenames[0], self.identifying_var), None
+                self.table, self.stream_state = state
+            # only the lines appended since the saved state are read
+            self.table.update(self.independent_var)
+            return
+        self.dataset = SeatDataset(table_cache.read_tables(self.filenames, self.identifying_var, self.use_cache,
+                                                           self.rebuild_cache, self.jobs), self.filenames)
+        self.table = self.dataset.table
 
     def get_sui_list(self):
         """
         Get the list of unique SUI's from the input file, along with the earliest recorded date for each.
         :return: None; results are stored in self.sui_list and self.sui_starts
         """
-        self.sui_list = []
-        self.sui_starts = {}
-        with open(self.filename, 'r') as f:
-            for line_str in f:
-                line = line_str.split(',')
-                if line[0] == "clinical.sui":
-                    continue
-                sui = line[self.vars.index(self.identifying_var)]
-                date = self.interpret_var(line[self.vars.index(self.independent_var)], self.independent_var)
-                if sui not in self.sui_list and sui != "clinical.sui":
-                    self.sui_list.append(sui)
-                    self.sui_starts[sui] = date
-                self.sui_starts[sui] = min(self.sui_starts[sui], date)
+        self.sui_list = list(self.table.sui_list)
+        self.get_sui_starts()
 
         if len(self.sui_list) == 0:
             print("No SUI's found in input file. Check that it is the expected format.")
@@ -219,113 +373,156 @@ class SeatReader:
                 if len(self.sui_prefix) == 0:
                     break
 
+    def get_sui_starts(self):
+        """
+        Get the earliest value of the independent variable for each SUI.
+        :return: None; results are stored in self.sui_starts
+        """
+        self.sui_starts = {}
+        if self.independent_var in self.table.vars and self.independent_var != self.identifying_var:
+            self.sui_starts = self.table.sui_minimum(self.independent_var)
+
     def get_vars(self):
         """
         Get the list of variables from the input file.
         :return: None; results are stored in self.vars
         """
-        self.vars = []
-        # get the list of variables from the first line of the input csv file
-        with open(self.filename, 'r') as f:
-            for line in f:
-                self.vars = line.split(',')
-                break
+        self.vars = list(self.table.vars)
 
     def save_csv_file(self):
-        if self.save_csv is not None:
-            with open(self.save_csv, "w") as f:
-                f.write(','.join(['clinical.sui', 'day'] + self.graph_vars))
-                f.write('\n')
-                for sui in self.user_sui_list:
-                    days = {}
-                    for var in self.graph_vars:
-                        for sample in range(len(self.xAxis[sui][var])):
-                            if self.xAxis[sui][var][sample] not in days:
-                                days[self.xAxis[sui][var][sample]] = {}
-                                for var2 in self.graph_vars:
-                                    days[self.xAxis[sui][var][sample]][var2] = ""
-                            days[self.xAxis[sui][var][sample]][var] = str(self.yAxis[sui][var][sample])
-                    for day in days:
-                        f.write(','.join([sui, str(day)] + [days[day][v] for v in self.graph_vars]))
-                        f.write('\n')
+        """
+        Save the averages to the CSV file and to the other export files asked for, one row per SUI and day, sorted by
+        day, and the completeness of each series.
+        :return: None
+        """
+        writers = [(self.save_csv, export.write_csv), (self.save_npz, export.write_npz),
+                   (self.save_jsonl, export.write_jsonl), (self.save_sqlite, export.write_sqlite)]
+        writers = [(filename, writer) for filename, writer in writers if filename is not None]
+        if writers:
+            sui_index, days, values = export.daily_matrix(self.user_sui_list, self.graph_vars, self.xAxis, self.yAxis)
+            for filename, writer in writers:
+                writer(filename, self.user_sui_list, self.graph_vars, sui_index, days, values)
+        if self.save_completeness is not None:
+            export.write_completeness(self.save_completeness, self.completeness())
+
+    def completeness(self):
+        """
+        :return: How complete each graphed series is, by SUI then variable, as aggregation.completeness reports it
+        """
+        if not self.stream:
+            return self.aggregates.completeness()
+        return {sui: {var: self.stream_state.completeness(sui, var) for var in self.graph_vars}
+                for sui in self.user_sui_list}
+
+    def export_files(self):
+        """
+        :return: The names of the files written by save_csv_file
+        """
+        return [filename for filename in (self.save_csv, self.save_npz, self.save_jsonl, self.save_sqlite,
+                                          self.save_completeness) if filename is not None]
+
+    def series_figures(self, sui, var):
+        """
+        Collect what is needed to draw the figures of one SUI and variable.
+        :param sui: The SUI
+        :param var: The variable
+        :return: The SeriesFigures
+        """
+        from rendering import SeriesFigures
+
+        return SeriesFigures(sui, labels.get(var, var), labels.get(self.independent_var, self.independent_var),
+                             self.xAxis[sui][var], self.yAxis[sui][var], self.std[sui][var],
+                             self.missing_data[sui][var], self.durationXAxis[sui][var], self.durationYAxis[sui][var])
 
     def show_graph(self):
         """
         Create the graph and show it or save as images.
         :return: None
         """
-        plt.figure()
-        fig, ax = plt.subplots()
-        images_paths = []
-        plt.boxplot([self.general_durations[sui] for sui in self.user_sui_list] + [self.general_durations['Combined']],
-                    labels=self.user_sui_list + ['Combined'])
+        if self.no_graph:
+            return
+        import matplotlib
+        from tqdm import tqdm
+
+        if self.save_pdf is not None:
+            # saving never needs a display, so a headless run does not depend on the default GUI backend
+            matplotlib.use("Agg")
+
+        durations = [self.general_durations[sui] for sui in self.user_sui_list] + [self.general_durations['Combined']]
+        names = self.user_sui_list + ['Combined']
         if self.save_pdf is None:
+            import matplotlib.pyplot as plt
+            from rendering import draw_durations, draw_bars, draw_duration_scatter
+
+            fig = plt.figure()
+            draw_durations(fig, durations, names)
             plt.show()
-        else:
-            plt.gca().legend().set_visible(False)
-            path = "temp_durations.jpg"
-            fig.set_size_inches(8, 10)
-            plt.title("Sample Duration")
-            plt.savefig(path, dpi=300, transparent=False)
-            images_paths.append(path)
-            plt.clf()
-        for sui in tqdm(self.user_sui_list, desc='Create images for SUIs'):
-            for var in self.graph_vars:
-                var_name = var
-                if var in labels:
-                    var_name = labels[var]
-                plt.bar(self.xAxis[sui][var], self.yAxis[sui][var], label=sui + " " + var_name,
-                        yerr=self.std[sui][var], color='blue')
-                plt.bar(self.xAxis[sui][var], self.missing_data[sui][var],
-                        label=sui + " " + var_name + " percentage missing", color='red')
-                if self.independent_var in labels:
-                    plt.xlabel(labels[self.independent_var])
-                else:
-                    plt.xlabel(self.independent_var)
-                plt.ylabel(var_name)
-                plt.legend()
-                if self.save_pdf is None:
+            for sui in tqdm(self.user_sui_list, desc='Create images for SUIs'):
+                for var in self.graph_vars:
+                    series = self.series_figures(sui, var)
+                    fig = plt.figure()
+                    draw_bars(fig, series)
                     plt.show()
-                else:
-                    plt.gca().legend().set_visible(False)
-                    path = "temp_" + sui + "_" + var + ".jpg"
-                    fig.set_size_inches(8, 10)
-                    plt.title(sui + ": " + var_name)
-                    plt.savefig(path, dpi=300, transparent=False)
-                    images_paths.append(path)
-                    plt.clf()
-                plt.scatter(self.durationXAxis[sui][var], self.durationYAxis[sui][var], label=sui + " " + var_name + " vs duration")
-                plt.xlabel('duration (s)')
-                plt.ylabel(var_name)
-                if self.save_pdf is None:
+                    fig = plt.figure()
+                    draw_duration_scatter(fig, series)
                     plt.show()
-                else:
-                    plt.gca().legend().set_visible(False)
-                    path = "temp_duration_" + sui + "_" + var + ".jpg"
-                    fig.set_size_inches(8, 10)
-                    plt.title(sui + ": " + var_name)
-                    plt.savefig(path, dpi=300, transparent=False)
-                    images_paths.append(path)
-                    plt.clf()
-        # create PDF
-        if self.save_pdf is not None:
-            pics = ["temp_durations.jpg"]
-            for sui in self.user_sui_list:
-                for var in self.graph_vars:
-                    pics.append("temp_" + sui + "_" + var + ".jpg")
-                    pics.append("temp_duration_" + sui + "_" + var + ".jpg")
-            with open(self.save_pdf + ".tmp", "wb") as f:
-                f.write(img2pdf.convert(pics))
-            for sui in self.user_sui_list:
-                for var in self.graph_vars:
-                    os.remove("temp_" + sui + "_" + var + ".jpg")
-                    os.remove("temp_duration_" + sui + "_" + var + ".jpg")
-            os.remove("temp_durations.jpg")
-
-            # create information page
-            packet = io.BytesIO()
-            can = canvas.Canvas(packet, pagesize=letter)
-            text = textwrap.wrap("For each patient, there are " + str(len(self.graph_vars)) +
+        elif self.pdf_backend == "vector":
+            from rendering import save_vector_pdf
+
+            all_series = [self.series_figures(sui, var) for sui in self.user_sui_list for var in self.graph_vars]
+            progress = tqdm(total=len(all_series), desc='Create pages for SUIs')
+            save_vector_pdf(self.save_pdf, self.information_text(), durations, names, all_series, self.outline(),
+                            progress)
+            progress.close()
+        else:
+            from rendering import save_durations
+
+            images_paths = [save_durations("temp_durations.jpg", durations, names)]
+            images_paths += self.save_images()
+            self.create_pdf(images_paths)
+
+    def save_images(self):
+        """
+        Save the bar chart and the duration scatter plot of every SUI and variable as images, using self.jobs worker
+        processes.
+        :return: The paths of the images, in page order
+        """
+        from tqdm import tqdm
+        from rendering import save_series
+
+        all_series = []
+        for sui in self.user_sui_list:
+            for var in self.graph_vars:
+                series = self.series_figures(sui, var)
+                series.bar_path = "temp_" + sui + "_" + var + ".jpg"
+                series.duration_path = "temp_duration_" + sui + "_" + var + ".jpg"
+                all_series.append(series)
+
+        images_paths = []
+        progress = tqdm(total=len(all_series), desc='Create images for SUIs')
+        if self.jobs == 1:
+            for series in all_series:
+                images_paths += save_series(series)
+                progress.update()
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                # map returns the results in submission order, so the page order does not depend on the workers
+                for paths in executor.map(save_series, all_series):
+                    images_paths += paths
+                    progress.update()
+        progress.close()
+        return images_paths
+
+    def information_text(self):
+        """
+        Write the text of the information page at the start of the PDF.
+        :return: The lines of the page
+        """
+        aggregate_text = ""
+        if self.aggregate != "mean":
+            aggregate_text = " Instead of the average, each bar in this document shows the " + \
+                             aggregate_name(self.aggregate) + " of the values in its window."
+        return textwrap.wrap("For each patient, there are " + str(len(self.graph_vars)) +
  " graphs: " + ', '.join(self.graph_vars) + """\n\nSamples were taken when the patient used the
 seat, sometimes multiple times a
 day, sometimes just once, sometimes none at all. For each day, the data was averaged with an n-day
@@ -333,84 +530,101 @@ sliding window - there is at most one bar per day, and the bar represents an ave
 n-day window centered on the day the bar is labeled. For example, with n=3, the bar at day 6 would
 include values from days 5, 6, and 7. In this calculation the timestamp for each sample is rounded down
 to the nearest day, so there are no partial days. N can be adjusted with the avg-window-size argument.
-The value of N in this document is """ + str(self.avg_window_size) + """.
+The value of N in this document is """ + str(self.avg_window_size) + """.""" + aggregate_text + """
 The top of the blue bar indicates the mean value for the day. The black line on each bar indicates the
 standard deviation for the mean.\n\nHRV measurements are only counted if the sample duration is greater than
 """ + str(self.hrv_min_duration) + """ seconds, and no data is counted for samples less than """ +
-                                 str(self.min_duration) + """ seconds. A scatter plot is also provided for each
+                             str(self.min_duration) + """ seconds. A scatter plot is also provided for each
 variable for each patient of the value of that variable vs the duration of the sample. The second page contains
 a boxplot of the duration of the samples (greater than """ + str(self.min_duration) + """s) for each patient
 and for all sample durations combined: The box extends from the first quartile (Q1) to the third quartile (Q3) of the
 data, with a line at the median. The whiskers extend from the box by 1.5x the inter-quartile range (IQR). Flier points
 are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_plot for reference.""")
-            for i in range(len(text)):
-                can.drawString(60, 700-20*i, text[i])
-            can.save()
-
-            # move to the beginning of the StringIO buffer
-            packet.seek(0)
-
-            # create a new PDF with Reportlab
-            new_pdf = PdfFileReader(packet)
-
-            # add bookmarks and information page
-            writer = PdfFileWriter()
-            writer.add_page(new_pdf.getPage(0))
-            reader = PdfFileReader(open(self.save_pdf + ".tmp", 'rb'), strict=False)
-            for page in range(reader.numPages):
-                writer.addPage(reader.getPage(page))
-            writer.addBookmark(
-                title='information',
-                pagenum=0,
-                parent=None,
-                color=None,
-                bold=True,
-                italic=False,
-                fit='/Fit',
-            )
-            writer.addBookmark(
-                title='sample duration boxplots',
-                pagenum=1,
+
+    def outline(self):
+        """
+        List the bookmarks of the PDF: the information page, the boxplot page, then each SUI with its variables.
+        :return: A list of (title, page index, children), with children in the same form
+        """
+        outline = [('information', 0, []), ('sample duration boxplots', 1, [])]
+        for sui in range(len(self.user_sui_list)):
+            outline.append(('SUI ' + self.user_sui_list[sui], len(self.graph_vars) * 2 * sui + 2,
+                            [(self.graph_vars[var], len(self.graph_vars) * 2 * sui + var * 2 + 2, [])
+                             for var in range(len(self.graph_vars))]))
+        return outline
+
+    def create_pdf(self, images_paths):
+        """
+        Combine the images into the PDF, with an information page and bookmarks, and delete the images.
+        :param images_paths: The paths of the images, in page order
+        :return: None
+        """
+        import img2pdf
+        from PyPDF2 import PdfFileWriter, PdfFileReader
+        from reportlab.pdfgen import canvas
+        from reportlab.lib.pagesizes import letter
+
+        with open(self.save_pdf + ".tmp", "wb") as f:
+            f.write(img2pdf.convert(images_paths))
+        for path in images_paths:
+            os.remove(path)
+
+        # create information page
+        packet = io.BytesIO()
+        can = canvas.Canvas(packet, pagesize=letter)
+        text = self.information_text()
+        for i in range(len(text)):
+            can.drawString(60, 700-20*i, text[i])
+        can.save()
+
+        # move to the beginning of the StringIO buffer
+        packet.seek(0)
+
+        # create a new PDF with Reportlab
+        new_pdf = PdfFileReader(packet)
+
+        # add bookmarks and information page
+        writer = PdfFileWriter()
+        writer.add_page(new_pdf.getPage(0))
+        reader = PdfFileReader(open(self.save_pdf + ".tmp", 'rb'), strict=False)
+        for page in range(reader.numPages):
+            writer.addPage(reader.getPage(page))
+        for title, pagenum, children in self.outline():
+            bk = writer.addBookmark(
+                title=title,
+                pagenum=pagenum,
                 parent=None,
                 color=None,
                 bold=True,
                 italic=False,
                 fit='/Fit',
             )
-            for sui in range(len(self.user_sui_list)):
-                bk = writer.addBookmark(
-                    title='SUI ' + self.user_sui_list[sui],
-                    pagenum=len(self.graph_vars) * 2 * sui + 2,
-                    parent=None,
+            for child_title, child_pagenum, _ in children:
+                writer.addBookmark(
+                    title=child_title,
+                    pagenum=child_pagenum,
+                    parent=bk,
                     color=None,
                     bold=True,
                     italic=False,
                     fit='/Fit',
                 )
-                for var in range(len(self.graph_vars)):
-                    writer.addBookmark(
-                        title=self.graph_vars[var],
-                        pagenum=len(self.graph_vars) * 2 * sui + var * 2 + 2,
-                        parent=bk,
-                        color=None,
-                        bold=True,
-                        italic=False,
-                        fit='/Fit',
-                    )
-            output = open(self.save_pdf, 'wb')
-            writer.write(output)
-            output.close()
-
-            os.remove(self.save_pdf + ".tmp")
-
-    def get_args(self):
+        output = open(self.save_pdf, 'wb')
+        writer.write(output)
+        output.close()
+
+        os.remove(self.save_pdf + ".tmp")
+
+    def get_args(self, argv=None):
         """
         Get the command line arguments.
+        :param argv: The arguments, or None to use sys.argv
         :return: None; results are stored in self
         """
         parser = argparse.ArgumentParser(description='Parses a csv file from the seats experiment.')
 
-        parser.add_argument("input_file", help="The input file to parse.")
+        parser.add_argument("input_file", nargs='+', help="The input file(s) to parse: .csv files, glob patterns or "
+                                                          "directories of .csv files.")
         parser.add_argument("-s", "--sui", help="The SUI(s) to graph.", nargs='+')
         parser.add_argument("-v", "--vars", help="The variable(s) to graph.", nargs='+')
         parser.add_argument("-x", help="The variable to graph on the horizontal axis.", default="clinical.timestamp")
@@ -420,16 +634,59 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
                                                "asking for standard input.")
         parser.add_argument("--save", help="Saves the resulting graphs to the specified PDF")
         parser.add_argument("--save-csv", help="Saves the resulting averages to the specified CSV")
+        parser.add_argument("--save-npz", help="Saves the resulting averages to the specified NumPy .npz file")
+        parser.add_argument("--save-jsonl", help="Saves the resulting averages to the specified JSON Lines file")
+        parser.add_argument("--save-sqlite", help="Saves the resulting averages to a table in the specified SQLite "
+                                                  "file, replacing it")
+        parser.add_argument("--save-completeness", help="Saves the number of samples, missing values and days with "
+                                                        "data of each SUI and variable to the specified CSV")
+        parser.add_argument("--no-graph", action="store_true", help="Do not show the graphs; with --save-csv, only the "
+                                                                    "CSV is written, and the plotting packages are "
+                                                                    "not loaded")
         parser.add_argument("--hrv-min-duration", type=int, default=60, help="When graphing HRV, the minimum duration "
                                                                              "to include, in seconds")
         parser.add_argument("--avg-window-size", type=int, default=1, help="For each day, values within this number of "
                                                                            "days will be included in the average")
         parser.add_argument("--min-duration", type=int, default=3, help="Samples with duration less than this value "
                                                                         "will not be included in the graph")
-
-        arguments = parser.parse_args()
-
-        self.filename = arguments.input_file
+        parser.add_argument("--no-cache", action="store_true", help="Do not read or write the cache of the parsed "
+                                                                    "input file")
+        parser.add_argument("--rebuild-cache", action="store_true", help="Parse the input file again and rewrite its "
+                                                                         "cache")
+        parser.add_argument("--jobs", type=int, default=1, help="The number of processes used to parse several "
+                                                                  "input files and to render the images saved with "
+                                                                  "--save; 0 uses every CPU")
+        parser.add_argument("--pdf-backend", choices=["raster", "vector"], default="raster",
+                            help="How the PDF saved with --save is made: raster combines 300 dpi images of the graphs, "
+                                 "vector draws them straight into the PDF without temporary files")
+        parser.add_argument("--stream", action="store_true", help="Read the input file a chunk at a time, keeping only "
+                                                                  "daily totals and a sample of each series in memory; "
+                                                                  "for files too large to load. The totals are saved "
+                                                                  "next to the file, and later runs only read the "
+                                                                  "lines appended since")
+        parser.add_argument("--watch", type=float, nargs='?', const=10, help="Keep running and refresh the files saved "
+                                                                           "with --save and --save-csv when lines are "
+                                                                           "appended to the input file, checking every "
+                                                                           "this many seconds (default 10); implies "
+                                                                           "--stream")
+        parser.add_argument("--agg", type=parse_aggregate, default="mean", help="How the values in each window are "
+                                                                              "combined: mean, median or p<q> for the "
+                                                                              "q-th percentile, e.g. p90")
+
+        parser.add_argument("--profile", action="store_true", help="Print the wall and CPU time, rows, figures and "
+                                                                   "bytes of each stage at the end of the run")
+        parser.add_argument("--profile-dump", help="Also run each stage under cProfile and save the statistics of the "
+                                                   "slowest one to this file; implies --profile")
+        parser.add_argument("--serve", type=int, nargs='?', const=8000, help="Instead of graphing, load the input "
+                                                                             "files once and answer queries over HTTP "
+                                                                             "on this port (default 8000)")
+
+        arguments = parser.parse_args(argv)
+
+        try:
+            self.filenames = table_cache.find_input_files(arguments.input_file)
+        except ValueError as e:
+            parser.error(str(e))
         self.independent_var = arguments.x
         self.no_input = arguments.no_input
         self.identifying_var = arguments.i
@@ -442,6 +699,7 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
         self.user_sui_list = arguments.sui
         if not self.user_sui_list:
             self.user_sui_list = []
+        self.requested_suis = list(self.user_sui_list)
 
         if arguments.save:
             self.save_pdf = arguments.save
@@ -449,6 +707,15 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
         if arguments.save_csv:
             self.save_csv = arguments.save_csv
 
+        self.save_npz = arguments.save_npz
+        self.save_jsonl = arguments.save_jsonl
+        self.save_sqlite = arguments.save_sqlite
+        self.save_completeness = arguments.save_completeness
+
+        self.no_graph = arguments.no_graph
+        if self.no_graph and self.save_pdf is not None:
+            parser.error("--no-graph cannot be used with --save")
+
         if arguments.hrv_min_duration:
             self.hrv_min_duration = arguments.hrv_min_duration
 
@@ -458,11 +725,38 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
         if arguments.min_duration:
             self.min_duration = arguments.min_duration
 
+        self.aggregate = arguments.agg
+        self.use_cache = not arguments.no_cache
+        self.rebuild_cache = arguments.rebuild_cache
+        self.jobs = arguments.jobs if arguments.jobs > 0 else os.cpu_count()
+        self.pdf_backend = arguments.pdf_backend
+        self.stream = arguments.stream
+        self.watch = arguments.watch
+        self.serve = arguments.serve
+        if self.serve is not None and self.stream:
+            parser.error("--serve keeps the input files in memory and cannot be used with --stream or --watch")
+        if arguments.profile or arguments.profile_dump:
+            self.profiler = StageProfiler(arguments.profile_dump)
+        if self.watch is not None:
+            if self.save_pdf is None and not self.export_files():
+                parser.error("--watch needs --save or one of the --save-* options")
+            self.stream = True
+        if self.stream and len(self.filenames) > 1:
+            parser.error("--stream and --watch read a single input file")
+        if self.stream and self.aggregate != "mean":
+            parser.error("--agg " + self.aggregate + " needs every sample and cannot be used with --stream")
+
     def get_data(self):
         """
         Get the data from the input file.
         :return: None; results are stored in self.xAxis and self.yAxis
         """
+        if not self.stream:
+            self.aggregates = self.dataset.samples(self.user_sui_list, self.graph_vars, self.independent_var,
+                                                   self.min_duration, self.hrv_min_duration)
+            self.use_aggregates()
+            return
+
         self.xAxis = {}
         self.yAxis = {}
         self.durationXAxis = {}
@@ -486,38 +780,52 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
                 self.durationYAxis[sui][var] = []
                 self.missing_data[sui][var] = []
                 self.std[sui][var] = []
+        self.get_streamed_data()
+
+    def use_aggregates(self):
+        """
+        Graph the series of self.aggregates.
+        :return: None; results are stored in self.xAxis, self.yAxis, self.std, self.missing_data, self.durationXAxis,
+        self.durationYAxis and self.general_durations
+        """
+        self.xAxis = self.aggregates.x
+        self.yAxis = self.aggregates.y
+        self.std = self.aggregates.std
+        self.missing_data = self.aggregates.missing
+        self.durationXAxis = self.aggregates.duration_x
+        self.durationYAxis = self.aggregates.duration_y
+        self.general_durations = self.aggregates.general_durations
+
+    def get_streamed_data(self):
+        """
+        Read the input file a chunk at a time into per-day totals, keeping a bounded sample of each series for the
+        boxplot and the duration scatter plots. When the totals saved by a previous run used the same options, only the
+        lines appended since are read, and the totals are saved again.
+        :return: None; results are stored in self.stream_state, self.durationXAxis, self.durationYAxis and
+        self.general_durations
+        """
+        if self.stream_state is None or not self.stream_state.can_continue(
+                self.filenames[0], self.identifying_var, self.independent_var, self.graph_vars, self.sui_starts,
+                self.min_duration, self.hrv_min_duration):
+            self.stream_state = StreamAggregator(self.vars, self.identifying_var, self.independent_var,
+                                                 self.graph_vars, self.sui_starts, self.min_duration,
+                                                 self.hrv_min_duration)
+        # SUI's that first appear in the appended lines start where the scan found them
+        self.stream_state.sui_starts.update(self.sui_starts)
+        self.stream_state.add_file(self.filenames[0], self.table.end)
+        if self.use_cache:
+            try:
+                save_state(self.filenames[0], self.table, self.stream_state)
+            except OSError as e:
+                print("Could not save the state of " + self.filenames[0] + ": " + str(e))
 
-        with open(self.filename, 'r') as f:
-            for line in f:
-                line = line.split(',')
-                sui = line[0]
-                if sui in self.user_sui_list:
-                    x_val = self.interpret_var(line[self.vars.index(self.independent_var)], self.independent_var)
-                    if self.independent_var == "clinical.timestamp":
-                        x_val = (x_val - self.sui_starts[sui]).total_seconds() / (60 * 60 * 24)
-                    if float(line[self.vars.index('clinical.duration')]) < self.min_duration:
-                        continue
-                    self.general_durations["Combined"].append(float(line[self.vars.index('clinical.duration')]))
-                    self.general_durations[sui].append(float(line[self.vars.index('clinical.duration')]))
-                    for var in self.graph_vars:
-                        if var == 'clinical.hrv' and float(line[self.vars.index('clinical.duration')]) < \
-                                self.hrv_min_duration:
-                            continue
-                        if line[self.vars.index(var)] != '':
-                            self.xAxis[sui][var].append(x_val)
-                            self.yAxis[sui][var].append(self.interpret_var(line[self.vars.index(var)], var))
-                            self.durationXAxis[sui][var].append(self.interpret_var(line[self.vars.index("clinical.duration")], var))
-                            self.durationYAxis[sui][var].append(self.interpret_var(line[self.vars.index(var)], var))
-                        else:
-                            self.missing_data[sui][var].append(x_val)
-
+        for sui in self.user_sui_list:
+            self.general_durations[sui] = self.stream_state.general_durations([sui])
+        self.general_durations["Combined"] = self.stream_state.general_durations(self.user_sui_list)
         for sui in self.user_sui_list:
             for var in self.graph_vars:
-                if len(self.xAxis[sui][var]) > 0:
-                    self.xAxis[sui][var], self.yAxis[sui][var] = \
-                        zip(*sorted(zip(self.xAxis[sui][var], self.yAxis[sui][var])))
-                    self.durationXAxis[sui][var], self.durationYAxis[sui][var] = \
-                        zip(*sorted(zip(self.durationXAxis[sui][var], self.durationYAxis[sui][var])))
+                self.durationXAxis[sui][var], self.durationYAxis[sui][var] = \
+                    self.stream_state.duration_samples(sui, var)
 
     def check_args(self):
         """
@@ -613,6 +921,7 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
                         continue
                     else:
                         break
+                self.get_sui_starts()
 
         # print the variable to graph on the horizontal axis
         print("\nVariable to graph on the horizontal axis: " + self.independent_var)
@@ -629,46 +938,21 @@ are those past the end of the whiskers. See https://en.wikipedia.org/wiki/Box_pl
             self.user_sui_list = new_sui_list
 
     def condense_data(self):
-        for sui in self.user_sui_list:
-            for var in self.graph_vars:
-                i = 0
-                new_x_axis = []
-                new_y_axis = []
-                new_std = []
-                new_missing_data = []
-
-                if len(self.xAxis[sui][var]) != 0:
-                    for day in range(math.floor(self.xAxis[sui][var][-1])+1):
-                        points = []
-
-                        for i in range(len(self.xAxis[sui][var])):
-                            if abs(day - math.floor(self.xAxis[sui][var][i])) <= self.avg_window_size / 2:
-                                points.append(self.yAxis[sui][var][i])
-
-                        if len(points) == 0:
-                            continue
-
-                        mean = sum(points) / len(points)
-                        variance = sum([((x - mean) ** 2) for x in points]) / len(points)
-                        res = variance ** 0.5
-
-                        count_missing = 0
-                        if self.show_missing:
-                            for missing_point in self.missing_data[sui][var]:
-                                if day == math.floor(missing_point):
-                                    count_missing += 1
-                        percentage_missing = count_missing / (count_missing + len(points))
-
-                        new_x_axis.append(day)
-                        new_y_axis.append(mean)
-                        new_std.append(res)
-                        new_missing_data.append(percentage_missing * mean)
+        """
+        Replace the samples of each series by one aggregate per day, over a sliding window of self.avg_window_size days.
+        :return: None; results are stored in self.xAxis, self.yAxis, self.std and self.missing_data
+        """
+        if self.stream:
+            for sui in self.user_sui_list:
+                for var in self.graph_vars:
+                    self.xAxis[sui][var], self.yAxis[sui][var], self.std[sui][var], self.missing_data[sui][var] = \
+                        self.stream_state.condense(sui, var, self.avg_window_size, self.show_missing)
+            return
 
-                self.xAxis[sui][var] = new_x_axis
-                self.yAxis[sui][var] = new_y_axis
-                self.std[sui][var] = new_std
-                self.missing_data[sui][var] = new_missing_data
+        SeatDataset.condense(self.aggregates, self.avg_window_size, self.aggregate, self.show_missing)
+        self.use_aggregates()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     s = SeatReader()
@@ -0,0 +1,103 @@
+import cProfile
+import io
+import os
+import pstats
+import time
+
+"""
+Timing of the stages of a SeatReader run, for --profile.
+
+A StageProfiler is only created when profiling is asked for; without one, SeatReader.run calls its stages directly.
+"""
+
+"""
+The number of functions of the slowest stage listed after the report, with --profile-dump.
+"""
+TOP_FUNCTIONS = 15
+
+
+def cpu_time():
+    """
+    :return: The CPU time used by this process and by its finished child processes, such as the --jobs workers, in
+    seconds
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageProfiler:
+    """
+    Measures each stage of a run and prints a report of them.
+    """
+    def __init__(self, dump_file=None):
+        """
+        :param dump_file: If not None, every stage also runs under cProfile, and the statistics of the slowest stage
+        are saved to this file
+        """
+        self.dump_file = dump_file
+        """
+        For each stage in the order they ran: its name, wall and CPU time in seconds, and the counts the caller gave.
+        """
+        self.stages = []
+        """
+        The cProfile.Profile of each stage, with --profile-dump.
+        """
+        self.profiles = {}
+
+    def run(self, name, function, counts=None):
+        """
+        Run one stage and record its measurements.
+        :param name: The name of the stage
+        :param function: The stage, called without arguments
+        :param counts: If not None, called after the stage; returns a dict with the "rows" processed, "figures"
+        rendered and "bytes" written by the stage, any of which may be missing
+        :return: None
+        """
+        profile = cProfile.Profile() if self.dump_file is not None else None
+        wall, cpu = time.perf_counter(), cpu_time()
+        if profile is not None:
+            profile.runcall(function)
+        else:
+            function()
+        record = {"stage": name, "seconds": time.perf_counter() - wall, "cpu_seconds": cpu_time() - cpu}
+        if counts is not None:
+            record.update(counts())
+        self.stages.append(record)
+        if profile is not None:
+            self.profiles[name] = profile
+
+    def report(self):
+        """
+        :return: The lines of a table of the stages, with a total
+        """
+        lines = ["stage".ljust(16) + "wall (s)".rjust(10) + "cpu (s)".rjust(10) + "rows".rjust(12) +
+                 "rows/s".rjust(12) + "figures".rjust(9) + "bytes".rjust(12)]
+        for record in self.stages:
+            rows = record.get("rows")
+            rate = rows / record["seconds"] if rows is not None and record["seconds"] > 0 else None
+            lines.append(record["stage"].ljust(16) + ("%.3f" % record["seconds"]).rjust(10) +
+                         ("%.3f" % record["cpu_seconds"]).rjust(10) + format_count(rows).rjust(12) +
+                         format_count(rate).rjust(12) + format_count(record.get("figures")).rjust(9) +
+                         format_count(record.get("bytes")).rjust(12))
+        lines.append("total".ljust(16) + ("%.3f" % sum(record["seconds"] for record in self.stages)).rjust(10) +
+                     ("%.3f" % sum(record["cpu_seconds"] for record in self.stages)).rjust(10))
+        return lines
+
+    def dump(self):
+        """
+        Save the cProfile statistics of the slowest stage to the dump file.
+        :return: The name of the slowest stage and the lines of its most expensive functions, or None if nothing was
+        profiled
+        """
+        if not self.profiles:
+            return None
+        slowest = max((record for record in self.stages if record["stage"] in self.profiles),
+                      key=lambda record: record["seconds"])["stage"]
+        self.profiles[slowest].dump_stats(self.dump_file)
+        text = io.StringIO()
+        pstats.Stats(self.profiles[slowest], stream=text).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return slowest, text.getvalue().strip().splitlines()
+
+
+def format_count(value):
+    return "-" if value is None else str(int(round(value)))
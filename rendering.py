@@ -0,0 +1,225 @@
+from matplotlib.backends.backend_pdf import PdfPages, Name
+from matplotlib.figure import Figure
+
+"""
+Drawing of the SeatViewer figures with the object-oriented matplotlib API, so that figures can be rendered in worker
+processes or straight into a vector PDF without sharing the pyplot state machine.
+"""
+
+"""
+Size of the saved figures, in inches, and their resolution.
+"""
+FIGURE_SIZE = (8, 10)
+DPI = 300
+"""
+Size of a US letter page, in points.
+"""
+LETTER = (612, 792)
+"""
+The private parts of matplotlib's PdfPages and PdfFile that add_outline uses, checked before it is called. They are
+present in matplotlib 3.5.2, as pinned in requirements.txt, up to at least 3.8.
+"""
+OUTLINE_ATTRIBUTES = ('reserveObject', 'writeObject', 'rootObject', 'pagesObject', 'pageList')
+
+
+class SeriesFigures:
+    """
+    Everything needed to draw the two figures of one (SUI, variable) pair: the bar chart of the daily values and the
+    scatter plot of the values against the duration of the samples.
+    """
+    def __init__(self, sui, var_name, x_label, x, y, std, missing, duration_x, duration_y):
+        self.sui = sui
+        self.var_name = var_name
+        self.x_label = x_label
+        self.x = x
+        self.y = y
+        self.std = std
+        self.missing = missing
+        self.duration_x = duration_x
+        self.duration_y = duration_y
+        """
+        The paths of the bar chart and scatter plot images, when they are saved.
+        """
+        self.bar_path = None
+        self.duration_path = None
+
+
+def draw_durations(fig, durations, names, title=False):
+    """
+    Draw the boxplot of the sample durations.
+    :param fig: The matplotlib Figure to draw on
+    :param durations: For each box, the list of durations
+    :param names: The label of each box
+    :param title: When true, a title is added to the figure
+    :return: None
+    """
+    ax = fig.add_subplot()
+    ax.boxplot(durations, labels=names)
+    if title:
+        ax.set_title("Sample Duration")
+
+
+def draw_bars(fig, series, legend=True, title=False):
+    """
+    Draw the bar chart of the daily values of a series, with their standard deviation and the missing data.
+    :param fig: The matplotlib Figure to draw on
+    :param series: The SeriesFigures to draw
+    :param legend: When true, a legend is added to the figure
+    :param title: When true, a title is added to the figure
+    :return: None
+    """
+    ax = fig.add_subplot()
+    ax.bar(series.x, series.y, label=series.sui + " " + series.var_name, yerr=series.std, color='blue')
+    ax.bar(series.x, series.missing, label=series.sui + " " + series.var_name + " percentage missing", color='red')
+    ax.set_xlabel(series.x_label)
+    ax.set_ylabel(series.var_name)
+    if legend:
+        ax.legend()
+    if title:
+        ax.set_title(series.sui + ": " + series.var_name)
+
+
+def draw_duration_scatter(fig, series, title=False):
+    """
+    Draw the scatter plot of the values of a series against the duration of the samples.
+    :param fig: The matplotlib Figure to draw on
+    :param series: The SeriesFigures to draw
+    :param title: When true, a title is added to the figure
+    :return: None
+    """
+    ax = fig.add_subplot()
+    ax.scatter(series.duration_x, series.duration_y, label=series.sui + " " + series.var_name + " vs duration")
+    ax.set_xlabel('duration (s)')
+    ax.set_ylabel(series.var_name)
+    if title:
+        ax.set_title(series.sui + ": " + series.var_name)
+
+
+def durations_figure(durations, names):
+    """
+    :return: A Figure with the titled boxplot of the sample durations, at the size of a saved page
+    """
+    fig = Figure(figsize=FIGURE_SIZE)
+    draw_durations(fig, durations, names, title=True)
+    return fig
+
+
+def bars_figure(series):
+    """
+    :return: A Figure with the titled bar chart of a series, at the size of a saved page
+    """
+    fig = Figure(figsize=FIGURE_SIZE)
+    draw_bars(fig, series, legend=False, title=True)
+    return fig
+
+
+def duration_scatter_figure(series):
+    """
+    :return: A Figure with the titled duration scatter plot of a series, at the size of a saved page
+    """
+    fig = Figure(figsize=FIGURE_SIZE)
+    draw_duration_scatter(fig, series, title=True)
+    return fig
+
+
+def information_figure(lines):
+    """
+    Lay out the information page like the one drawn with reportlab: a US letter page with one line every 20 points,
+    starting 700 points from the bottom.
+    :param lines: The lines of text
+    :return: The Figure
+    """
+    width, height = LETTER
+    fig = Figure(figsize=(width / 72, height / 72))
+    for i in range(len(lines)):
+        fig.text(60 / width, (700 - 20 * i) / height, lines[i], fontsize=12, va='baseline')
+    return fig
+
+
+def save_durations(path, durations, names):
+    """
+    Save the boxplot of the sample durations as an image.
+    :return: The path of the image
+    """
+    durations_figure(durations, names).savefig(path, dpi=DPI, transparent=False)
+    return path
+
+
+def save_series(series):
+    """
+    Save the bar chart and the duration scatter plot of a series as images, at series.bar_path and
+    series.duration_path. This runs in worker processes, so it only uses its argument.
+    :param series: The SeriesFigures to draw
+    :return: The paths of the two images
+    """
+    bars_figure(series).savefig(series.bar_path, dpi=DPI, transparent=False)
+    duration_scatter_figure(series).savefig(series.duration_path, dpi=DPI, transparent=False)
+    return series.bar_path, series.duration_path
+
+
+def save_vector_pdf(path, information, durations, names, all_series, outline, progress=None):
+    """
+    Draw every page straight into a multi-page vector PDF, with its outline, in a single pass.
+    :param path: The path of the PDF
+    :param information: The lines of the information page
+    :param durations: For each box of the duration boxplot, the list of durations
+    :param names: The label of each box
+    :param all_series: The SeriesFigures to draw, in page order
+    :param outline: The bookmarks, as a list of (title, page index, children) with children in the same form
+    :param progress: If not None, a tqdm progress bar updated after each series
+    :return: None
+    """
+    with PdfPages(path) as pdf:
+        pdf.savefig(information_figure(information))
+        pdf.savefig(durations_figure(durations, names))
+        for series in all_series:
+            pdf.savefig(bars_figure(series))
+            pdf.savefig(duration_scatter_figure(series))
+            if progress is not None:
+                progress.update()
+        # PdfPages has no public API for bookmarks; its PdfFile is only reachable once a page has been saved
+        pdf_file = getattr(pdf, '_file', None)
+        if all(hasattr(pdf_file, name) for name in OUTLINE_ATTRIBUTES):
+            add_outline(pdf_file, outline)
+        else:
+            print("This version of matplotlib does not allow adding bookmarks; " + path + " is saved without them.")
+
+
+def add_outline(pdf_file, outline):
+    """
+    Add bookmarks to a matplotlib PdfFile before it is finalized. The document catalog was already written when the
+    file was created, so a new catalog that also references the outline is written and used as the root instead.
+    This relies on the undocumented attributes of PdfFile listed in OUTLINE_ATTRIBUTES, which may change between
+    matplotlib versions; check them before calling it.
+    :param pdf_file: The matplotlib.backends.backend_pdf.PdfFile
+    :param outline: The bookmarks, as a list of (title, page index, children) with children in the same form
+    :return: None
+    """
+    outlines = pdf_file.reserveObject('outlines')
+    first, last, count = write_outline_items(pdf_file, outline, outlines)
+    pdf_file.writeObject(outlines, {'Type': Name('Outlines'), 'First': first, 'Last': last, 'Count': count})
+    root = pdf_file.reserveObject('root with outline')
+    pdf_file.writeObject(root, {'Type': Name('Catalog'), 'Pages': pdf_file.pagesObject, 'Outlines': outlines,
+                                'PageMode': Name('UseOutlines')})
+    pdf_file.rootObject = root
+
+
+def write_outline_items(pdf_file, items, parent):
+    """
+    Write one level of the outline, and recursively the levels below it.
+    :return: The first and last items of the level, and the number of items at and below it
+    """
+    refs = [pdf_file.reserveObject('outline item') for _ in items]
+    count = len(items)
+    for i, (title, page, children) in enumerate(items):
+        # bold titles (flag 2), like the bookmarks of the raster PDF
+        item = {'Title': title, 'Parent': parent, 'Dest': [pdf_file.pageList[page], Name('Fit')], 'F': 2}
+        if i > 0:
+            item['Prev'] = refs[i - 1]
+        if i < len(items) - 1:
+            item['Next'] = refs[i + 1]
+        if children:
+            item['First'], item['Last'], item['Count'] = write_outline_items(pdf_file, children, refs[i])
+            count += item['Count']
+        pdf_file.writeObject(refs[i], item)
+    return refs[0], refs[-1], count
@@ -0,0 +1,348 @@
+import datetime
+import itertools
+import math
+
+import numpy as np
+
+"""
+Column-oriented, in-memory representation of a seat .csv file.
+"""
+
+"""
+Columns that hold "%Y-%m-%d %H:%M:%S" timestamps. They are stored as int64 seconds since the epoch.
+"""
+TIMESTAMP_VARS = ["clinical.timestamp"]
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+"""
+Number of lines parsed at a time. Bounds the number of intermediate Python strings alive at once.
+"""
+CHUNK_ROWS = 100_000
+
+
+class SeatTable:
+    """
+    A column-oriented copy of a seat .csv file: one NumPy array per column, a validity mask for empty cells, and
+    categorical codes for the identifying variable.
+    """
+    def __init__(self, variables, columns, valid, identifying_var, sui_codes, sui_list):
+        """
+        The list of variables (column names) in file order.
+        """
+        self.vars = variables
+        """
+        The values of each column, by name. Numeric columns are float64 with NaN for empty cells, timestamp columns are
+        int64 seconds since the epoch and anything else is kept as strings.
+        """
+        self.columns = columns
+        """
+        For each column, a boolean array that is False where the cell was empty.
+        """
+        self.valid = valid
+        """
+        The name of the variable that is unique for each SUI, usually clinical.sui.
+        """
+        self.identifying_var = identifying_var
+        """
+        For each row, the index of its SUI in self.sui_list.
+        """
+        self.sui_codes = sui_codes
+        """
+        The unique SUI's, in order of first appearance.
+        """
+        self.sui_list = sui_list
+
+    def __len__(self):
+        return len(self.sui_codes)
+
+    def column(self, var):
+        """
+        Get the values of a column.
+        :param var: The name of the column
+        :return: The column as a NumPy array
+        """
+        if var == self.identifying_var:
+            return np.asarray(self.sui_list, dtype=str)[self.sui_codes]
+        return self.columns[var]
+
+    def is_numeric(self, var):
+        """
+        :param var: The name of the column
+        :return: True if the column holds floats
+        """
+        return var in self.columns and self.columns[var].dtype == np.float64
+
+    def sui_rows(self):
+        """
+        Group the row indices by SUI.
+        :return: A list with, for each SUI in self.sui_list, the indices of its rows in file order
+        """
+        order = np.argsort(self.sui_codes, kind='stable')
+        bounds = np.cumsum(np.bincount(self.sui_codes, minlength=len(self.sui_list)))
+        return np.split(order, bounds[:-1])
+
+    def sui_minimum(self, var):
+        """
+        Find the smallest value of a column for each SUI, ignoring empty cells.
+        :param var: The name of the column
+        :return: A dictionary of SUI to minimum value
+        """
+        values = self.columns[var]
+        valid = self.valid[var]
+        if values.dtype == np.float64:
+            valid = valid & ~np.isnan(values)
+            starts = np.full(len(self.sui_list), np.inf)
+        else:
+            starts = np.full(len(self.sui_list), np.iinfo(values.dtype).max, dtype=values.dtype)
+        np.minimum.at(starts, self.sui_codes[valid], values[valid])
+        counts = np.bincount(self.sui_codes[valid], minlength=len(self.sui_list))
+        return {self.sui_list[i]: starts[i].item() for i in range(len(self.sui_list)) if counts[i] > 0}
+
+    @classmethod
+    def read_csv(cls, filename, identifying_var="clinical.sui", chunk_rows=CHUNK_ROWS):
+        """
+        Read a seat .csv file in a single pass.
+        :param filename: The path of the .csv file
+        :param identifying_var: The name of the variable that is unique for each SUI
+        :param chunk_rows: The number of lines to convert at a time
+        :return: The SeatTable
+        """
+        with open(filename, 'r') as f:
+            variables = read_header(f)
+            builder = TableBuilder(variables, identifying_var)
+            for chunk in read_chunks(f, variables, chunk_rows):
+                builder.add(chunk)
+        return builder.build()
+
+
+class TableBuilder:
+    """
+    Converts chunks of rows into columns and concatenates them into a SeatTable.
+    """
+    def __init__(self, variables, identifying_var):
+        self.vars = variables
+        self.identifying_var = identifying_var
+        if identifying_var not in variables:
+            raise ValueError("Variable " + identifying_var + " not found in input file.")
+        self.columns = {var: [] for var in variables if var != identifying_var}
+        self.valid = {var: [] for var in variables}
+        self.sui_codes = []
+        self.sui_index = {}
+
+    def add(self, chunk):
+        """
+        Convert one chunk of rows and append it to the table.
+        :param chunk: A list of columns, each a tuple of strings
+        :return: None
+        """
+        for var, values in zip(self.vars, chunk):
+            if var == self.identifying_var:
+                self.sui_codes.append(encode_categories(values, self.sui_index))
+                self.valid[var].append(np.ones(len(values), dtype=bool))
+                continue
+            column, valid = convert_column(var, values)
+            self.columns[var].append(column)
+            self.valid[var].append(valid)
+
+    def build(self):
+        """
+        :return: The SeatTable holding every chunk added so far
+        """
+        columns = {}
+        valid = {}
+        for var in self.vars:
+            valid[var] = concatenate(self.valid[var], bool)
+            if var == self.identifying_var:
+                continue
+            chunks = self.columns[var]
+            if any(chunk.dtype.kind == 'U' for chunk in chunks):
+                # the column is text in at least one chunk; keep all of it as text
+                chunks = [chunk if chunk.dtype.kind == 'U' else format_column(chunk, mask)
+                          for chunk, mask in zip(chunks, self.valid[var])]
+                columns[var] = concatenate(chunks, str)
+            else:
+                columns[var] = concatenate(chunks, np.int64 if var in TIMESTAMP_VARS else np.float64)
+        sui_list = list(self.sui_index)
+        return SeatTable(self.vars, columns, valid, self.identifying_var, concatenate(self.sui_codes, np.int32),
+                         sui_list)
+
+
+def merge_tables(tables, filenames):
+    """
+    Concatenate tables read from several files into one, as if the files had been joined into a single file. The SUI
+    codes of each table are mapped onto a shared list of SUI's, in order of first appearance across the files.
+    :param tables: The SeatTables, in file order
+    :param filenames: The file each table was read from, for error messages
+    :return: The merged SeatTable
+    """
+    first = tables[0]
+    for table, filename in zip(tables[1:], filenames[1:]):
+        if set(table.vars) != set(first.vars):
+            raise ValueError("The columns of " + filename + " do not match those of " + filenames[0] + ".")
+        if table.identifying_var != first.identifying_var:
+            raise ValueError("The identifying variable of " + filename + " does not match that of " + filenames[0] +
+                             ".")
+
+    sui_index = {}
+    sui_codes = []
+    for table in tables:
+        codes = np.array([sui_index.setdefault(sui, len(sui_index)) for sui in table.sui_list], dtype=np.int32)
+        sui_codes.append(codes[table.sui_codes])
+
+    columns = {}
+    valid = {}
+    for var in first.vars:
+        valid[var] = concatenate([table.valid[var] for table in tables], bool)
+        if var == first.identifying_var:
+            continue
+        chunks = [table.columns[var] for table in tables]
+        if any(chunk.dtype.kind == 'U' for chunk in chunks):
+            # the column is text in at least one file; keep all of it as text
+            chunks = [chunk if chunk.dtype.kind == 'U' else format_column(chunk, table.valid[var])
+                      for chunk, table in zip(chunks, tables)]
+            columns[var] = concatenate(chunks, str)
+        else:
+            columns[var] = concatenate(chunks, np.int64 if var in TIMESTAMP_VARS else np.float64)
+    return SeatTable(first.vars, columns, valid, first.identifying_var, concatenate(sui_codes, np.int32),
+                     list(sui_index))
+
+
+def read_header(f):
+    """
+    Read the list of variables from the first line of an open .csv file.
+    :param f: The open file
+    :return: The list of variables
+    """
+    for line in f:
+        return line.rstrip('\r\n').split(',')
+    return []
+
+
+def read_chunks(f, variables, chunk_rows=CHUNK_ROWS):
+    """
+    Split the remaining lines of an open .csv file into columns, a chunk at a time. Blank lines and repeated header
+    lines are skipped.
+    :param f: The open file, positioned after the header
+    :param variables: The list of variables from the header
+    :param chunk_rows: The number of lines per chunk
+    :return: A generator of chunks, each a list of columns of strings
+    """
+    header = variables[0]
+    while True:
+        lines = list(itertools.islice(f, chunk_rows))
+        if not lines:
+            return
+        rows = [line.rstrip('\r\n').split(',') for line in lines]
+        rows = [row for row in rows if row[0] != header and row != ['']]
+        if not rows:
+            continue
+        widths = set(map(len, rows))
+        if widths != {len(variables)}:
+            raise ValueError("Expected " + str(len(variables)) + " fields per line, found " +
+                             ', '.join(str(w) for w in sorted(widths)) + ".")
+        yield list(zip(*rows))
+
+
+def convert_column(var, values):
+    """
+    Convert one chunk of a column from strings.
+    :param var: The name of the column
+    :param values: The cells of the column as strings
+    :return: The converted values and a mask that is False for empty cells
+    """
+    valid = np.fromiter(map(bool, values), dtype=bool, count=len(values))
+    if var in TIMESTAMP_VARS:
+        return parse_timestamps(np.array(values, dtype=str), valid), valid
+    try:
+        return np.array([float(v) if v else math.nan for v in values], dtype=np.float64), valid
+    except ValueError:
+        return np.array(values, dtype=str), valid
+
+
+def parse_timestamps(text, valid):
+    """
+    Convert timestamp strings to seconds since the epoch, a whole column at a time. Cells in the exact
+    "YYYY-MM-DD HH:MM:SS" layout are decoded from their bytes with array arithmetic; anything else falls back to
+    strptime, which also raises the usual error for malformed values.
+    :param text: The timestamps as strings
+    :param valid: A mask that is False for empty cells, which are converted to 0
+    :return: The timestamps as an int64 array
+    """
+    seconds = np.zeros(len(text), dtype=np.int64)
+    fixed = valid & (np.char.str_len(text) == 19)
+    fallback = valid & ~fixed
+    if fixed.any():
+        decoded, ok = decode_fixed_timestamps(text[fixed])
+        seconds[fixed] = np.where(ok, decoded, 0)
+        fallback[fixed] = ~ok
+    for i in np.flatnonzero(fallback):
+        delta = datetime.datetime.strptime(text[i], TIMESTAMP_FORMAT) - EPOCH
+        seconds[i] = delta.days * 24 * 60 * 60 + delta.seconds
+    return seconds
+
+
+def decode_fixed_timestamps(text):
+    """
+    Decode 19-character "YYYY-MM-DD HH:MM:SS" strings into seconds since the epoch.
+    :param text: The timestamps as a string array
+    :return: The timestamps as an int64 array and a mask that is False where a string is not a valid timestamp
+    """
+    # each character of a '<U19' array is one UCS-4 code point, so the array can be read as a matrix of integers
+    chars = np.ascontiguousarray(text, dtype='<U19').view(np.uint32).reshape(-1, 19)
+    digits = chars[:, [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]].astype(np.int64) - ord('0')
+    ok = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    ok &= (chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-')) & (chars[:, 10] == ord(' '))
+    ok &= (chars[:, 13] == ord(':')) & (chars[:, 16] == ord(':'))
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+    second = digits[:, 12] * 10 + digits[:, 13]
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_lengths = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+    ok &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+    ok &= day <= month_lengths[np.clip(month, 1, 12) - 1] + (leap & (month == 2))
+    ok &= (hour <= 23) & (minute <= 59) & (second <= 59)
+
+    # days since the epoch from the civil date, counting years from March so the leap day comes last
+    y = year - (month <= 2)
+    era = y // 400
+    year_of_era = y - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return days * 24 * 60 * 60 + hour * 60 * 60 + minute * 60 + second, ok
+
+
+def format_column(values, valid):
+    """
+    Convert a numeric column chunk back to strings, with empty strings for empty cells.
+    """
+    return np.array([str(v) if ok else '' for v, ok in zip(values.tolist(), valid.tolist())], dtype=str)
+
+
+def encode_categories(values, index):
+    """
+    Replace each value by the position of its first appearance.
+    :param values: The cells of the column as strings
+    :param index: A dictionary of value to code, updated in place with values not seen before
+    :return: The codes as an int32 array
+    """
+    uniques, first, inverse = np.unique(np.array(values, dtype=str), return_index=True, return_inverse=True)
+    codes = np.empty(len(uniques), dtype=np.int32)
+    for i in np.argsort(first, kind='stable'):
+        codes[i] = index.setdefault(str(uniques[i]), len(index))
+    return codes[inverse.reshape(-1)]
+
+
+def concatenate(chunks, dtype):
+    """
+    Concatenate column chunks, allowing for a table with no rows.
+    """
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(chunks)
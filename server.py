@@ -0,0 +1,322 @@
+import argparse
+import collections
+import io
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from aggregation import parse_aggregate
+from dataset import SeatDataset
+from rendering import SeriesFigures, bars_figure, duration_scatter_figure, durations_figure
+import table_cache
+
+"""
+A local HTTP server over a SeatDataset, for dashboards: the input files are loaded once and kept in memory, and are
+loaded again when they change.
+
+    GET /suis                  the SUI's, as a JSON list
+    GET /vars                  the variables, as a JSON list
+    GET /aggregate?...         the per-day aggregates of the SUI's and variables, as JSON
+    GET /completeness?...      the number of samples, missing values and days with data of each SUI and variable
+    GET /plot.png?...          a figure as a PNG image; /plot.pdf gives it as a PDF
+
+The queries take the options of main.py: sui and var (repeated or comma-separated; sui=* is every SUI), x, window,
+min_duration, hrv_min_duration, agg and missing=1. A plot is of one sui and var, with kind=bars (the default) or
+kind=scatter; kind=durations is the boxplot of the sample durations of the SUI's.
+"""
+
+"""
+How often, in seconds, the input files are checked for changes, and the number of responses kept in memory.
+"""
+RELOAD_CHECK_S = 2.0
+CACHE_SIZE = 256
+"""
+Resolution of the PNG plots, in dots per inch.
+"""
+PNG_DPI = 100
+PLOT_TYPES = {"png": "image/png", "pdf": "application/pdf"}
+PLOT_KINDS = ["bars", "scatter", "durations"]
+
+
+class QueryError(ValueError):
+    """
+    A request that cannot be answered; the message is sent back with a 400 status.
+    """
+
+
+class SeatServer(ThreadingHTTPServer):
+    """
+    Serves queries against a SeatDataset, each request in its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, patterns, identifying_var="clinical.sui", use_cache=True, jobs=1, labels=None):
+        """
+        Load the input files and listen on address.
+        :param address: The (host, port) to listen on
+        :param patterns: The input files: .csv files, glob patterns or directories of .csv files
+        :param identifying_var: The variable that is unique for each user
+        :param use_cache: When true, the parsed files are read from and saved to a cache next to them
+        :param jobs: The number of processes parsing several files
+        :param labels: The axis label of each variable; variables without one are labelled with their name
+        """
+        super().__init__(address, SeatRequestHandler)
+        self.patterns = list(patterns)
+        self.identifying_var = identifying_var
+        self.use_cache = use_cache
+        self.jobs = jobs
+        self.labels = labels or {}
+        """
+        The loaded dataset, the identity of the files it was loaded from, when they were last checked, and a number
+        that changes with every load, so cached responses of an older load are not used.
+        """
+        self.dataset = None
+        self.identity = None
+        self.checked = 0
+        self.version = 0
+        """
+        The most recently used responses, by version and request.
+        """
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        """
+        matplotlib figures are drawn one at a time.
+        """
+        self.render_lock = threading.Lock()
+        self.current_dataset()
+
+    def files_identity(self):
+        """
+        :return: The path, size and modification time of every input file
+        """
+        identity = []
+        for filename in table_cache.find_input_files(self.patterns):
+            stat = os.stat(filename)
+            identity.append((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns))
+        return identity
+
+    def current_dataset(self):
+        """
+        Get the dataset, loading it again if the input files changed since they were last checked.
+        :return: The SeatDataset and its version
+        """
+        with self.lock:
+            if self.dataset is None or time.monotonic() - self.checked > RELOAD_CHECK_S:
+                identity = self.files_identity()
+                if identity != self.identity:
+                    if self.dataset is not None:
+                        print("The input files changed; loading them again.")
+                    self.dataset = SeatDataset(table_cache.read_tables(
+                        [path for path, _, _ in identity], self.identifying_var, self.use_cache, False, self.jobs),
+                        [path for path, _, _ in identity])
+                    self.identity = identity
+                    self.version += 1
+                    self.cache.clear()
+                self.checked = time.monotonic()
+            return self.dataset, self.version
+
+    def cached(self, key, respond):
+        """
+        Get a response from the cache, or make it and keep it.
+        :param key: What identifies the response
+        :param respond: Called without arguments to make the response if it is not cached
+        :return: The response
+        """
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        response = respond()
+        with self.lock:
+            self.cache[key] = response
+            while len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return response
+
+
+class SeatRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers one request to a SeatServer.
+    """
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        routes = {
+            "/": self.index,
+            "/suis": self.suis,
+            "/vars": self.vars,
+            "/aggregate": self.aggregate,
+            "/completeness": self.completeness,
+            "/plot.png": lambda dataset, q: self.plot(dataset, q, "png"),
+            "/plot.pdf": lambda dataset, q: self.plot(dataset, q, "pdf"),
+        }
+        if url.path not in routes:
+            self.send(404, "application/json", json.dumps({"error": "unknown path " + url.path}).encode())
+            return
+        try:
+            dataset, version = self.server.current_dataset()
+            key = (version, url.path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+            content_type, body = self.server.cached(key, lambda: routes[url.path](dataset, query))
+            status = 200
+        except QueryError as e:
+            status, content_type, body = 400, "application/json", json.dumps({"error": str(e)}).encode()
+        except Exception as e:
+            traceback.print_exc()
+            status, content_type, body = 500, "application/json", json.dumps({"error": str(e)}).encode()
+        self.send(status, content_type, body)
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def index(self, dataset, query):
+        return "application/json", json.dumps({
+            "files": dataset.filenames,
+            "endpoints": ["/suis", "/vars", "/aggregate", "/completeness", "/plot.png", "/plot.pdf"],
+        }).encode()
+
+    def suis(self, dataset, query):
+        return "application/json", json.dumps(dataset.sui_list).encode()
+
+    def vars(self, dataset, query):
+        return "application/json", json.dumps(dataset.vars).encode()
+
+    def aggregate(self, dataset, query):
+        options, result = self.query_aggregates(dataset, query)
+        return "application/json", json.dumps(without_nan(dict(options, series=result.to_dict()))).encode()
+
+    def completeness(self, dataset, query):
+        options, result = self.query_aggregates(dataset, query)
+        return "application/json", json.dumps(dict(options, completeness=result.completeness())).encode()
+
+    def plot(self, dataset, query, fmt):
+        kind = single(query, "kind", "bars")
+        if kind not in PLOT_KINDS:
+            raise QueryError("kind must be one of " + ", ".join(PLOT_KINDS))
+        options, result = self.query_aggregates(dataset, query, kind != "durations")
+        labels = self.server.labels
+        if kind == "durations":
+            names = result.suis + ["Combined"]
+            make_figure = lambda: durations_figure([result.general_durations[sui] for sui in names], names)
+        else:
+            if len(result.suis) != 1 or len(result.vars) != 1:
+                raise QueryError("a plot is of one sui and one var")
+            sui, var = result.suis[0], result.vars[0]
+            series = SeriesFigures(sui, labels.get(var, var), labels.get(options["x"], options["x"]),
+                                   result.x[sui][var], result.y[sui][var], result.std[sui][var],
+                                   result.missing[sui][var], result.duration_x[sui][var], result.duration_y[sui][var])
+            make_figure = lambda: (bars_figure if kind == "bars" else duration_scatter_figure)(series)
+        output = io.BytesIO()
+        with self.server.render_lock:
+            make_figure().savefig(output, format=fmt, dpi=PNG_DPI)
+        return PLOT_TYPES[fmt], output.getvalue()
+
+    def query_aggregates(self, dataset, query, need_vars=True):
+        """
+        Answer the aggregate query of a request.
+        :param need_vars: When false, a query without variables gives only the durations of the samples
+        :return: The options of the query as a dict, and the Aggregates
+        """
+        suis = listed(query, "sui") or ["*"]
+        variables = listed(query, "var")
+        if not variables and need_vars:
+            raise QueryError("give at least one var")
+        options = {"x": single(query, "x", "clinical.timestamp"), "window": number(query, "window", 1),
+                   "min_duration": number(query, "min_duration", 3),
+                   "hrv_min_duration": number(query, "hrv_min_duration", 60),
+                   "agg": single(query, "agg", "mean"), "show_missing": single(query, "missing", "0") == "1"}
+        try:
+            options["agg"] = parse_aggregate(options["agg"])
+        except argparse.ArgumentTypeError as e:
+            raise QueryError(str(e))
+        unknown = [sui for sui in dataset.resolve_suis(suis) if sui not in dataset.sui_list]
+        if unknown:
+            raise QueryError("SUI " + unknown[0] + " not found in input file.")
+        try:
+            result = dataset.aggregate(suis, variables, **options)
+        except ValueError as e:
+            raise QueryError(str(e))
+        return dict(options, suis=result.suis, vars=result.vars), result
+
+    def log_message(self, format, *args):
+        print(self.address_string() + " - " + format % args)
+
+
+def without_nan(value):
+    """
+    :return: The value with NaN replaced by None in its lists and dicts, since JSON has no NaN
+    """
+    if isinstance(value, dict):
+        return {k: without_nan(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [without_nan(v) for v in value]
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def listed(query, name):
+    """
+    :return: The values of a parameter given several times or separated by commas
+    """
+    return [value for values in query.get(name, []) for value in values.split(",") if value]
+
+
+def single(query, name, default):
+    return query[name][-1] if name in query else default
+
+
+def number(query, name, default):
+    try:
+        return int(single(query, name, default))
+    except ValueError:
+        raise QueryError(name + " must be a whole number")
+
+
+def serve(patterns, port=8000, host="127.0.0.1", identifying_var="clinical.sui", use_cache=True, jobs=1,
+          labels=None):
+    """
+    Load the input files and answer requests until interrupted.
+    :return: None
+    """
+    server = SeatServer((host, port), patterns, identifying_var, use_cache, jobs, labels)
+    print("Serving " + ", ".join(server.dataset.filenames) + " on http://" + host + ":" + str(server.server_port) +
+          "/. Press Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves the aggregates and graphs of seat csv files over HTTP.")
+    parser.add_argument("input_file", nargs='+', help="The input file(s) to serve: .csv files, glob patterns or "
+                                                      "directories of .csv files.")
+    parser.add_argument("--port", type=int, default=8000, help="The port to listen on (default 8000)")
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on (default 127.0.0.1)")
+    parser.add_argument("-i", help="The variable that is unique for each user.", default="clinical.sui")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the cache of the parsed "
+                                                                "input files")
+    parser.add_argument("--jobs", type=int, default=1, help="The number of processes used to parse several input "
+                                                              "files; 0 uses every CPU")
+    arguments = parser.parse_args(argv)
+    try:
+        table_cache.find_input_files(arguments.input_file)
+    except ValueError as e:
+        parser.error(str(e))
+    from main import labels
+    serve(arguments.input_file, arguments.port, arguments.host, arguments.i, not arguments.no_cache,
+          arguments.jobs if arguments.jobs > 0 else os.cpu_count(), labels)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,561 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from aggregation import DayBuckets, completeness
+from seat_table import TIMESTAMP_VARS, read_header, read_chunks, convert_column, encode_categories
+
+"""
+Bounded-memory, append-aware reading of seat .csv files. The file is read a chunk of lines at a time and each chunk is
+folded into per-(SUI, variable, day) totals, so memory scales with days x series rather than with the number of rows.
+
+Only the totals needed by the bar charts and the saved averages are exact. The boxplot of the durations and the
+duration scatter plots need individual samples; for those, a fixed-size uniform random sample of each series is kept.
+
+Seat exports only grow, so the totals are saved in data.csv.seatstate together with the byte offset they cover. The
+next run only reads the lines appended after that offset. Only complete lines are read: a last line without its
+newline is still being written and is left for the next run. The state is a .npz file with a JSON header rather than a
+pickle, so that loading a state that someone else put next to the file never runs code.
+"""
+
+"""
+Number of lines read at a time.
+"""
+STREAM_CHUNK_ROWS = 10_000
+"""
+The largest number of samples kept for the boxplot and the scatter plot of each series.
+"""
+STREAM_SAMPLE_SIZE = 5_000
+STATE_SUFFIX = ".seatstate"
+"""
+Increment when the saved state changes, so that old states are rebuilt.
+"""
+STATE_VERSION = 2
+"""
+The number of bytes hashed at the start of a file and before the end of the part already read.
+"""
+HASH_BLOCK = 1 << 20
+
+
+class StreamScan:
+    """
+    The header of a .csv file, its SUI's and the minimum of one variable for each SUI, found without keeping the rows
+    in memory. Provides the part of the SeatTable interface used before the data is read.
+    """
+    def __init__(self, filename, identifying_var, chunk_rows=STREAM_CHUNK_ROWS):
+        self.filename = filename
+        self.identifying_var = identifying_var
+        self.chunk_rows = chunk_rows
+        """
+        The list of variables, and the code of each SUI in order of first appearance.
+        """
+        self.vars = []
+        self.sui_index = {}
+        """
+        The variable whose minimum is tracked, and its minimum for each SUI code.
+        """
+        self.var = None
+        self.minimums = {}
+        """
+        The number of bytes of the file scanned so far, and the hash of their ends from prefix_hash.
+        """
+        self.end = 0
+        self.hash = None
+        """
+        The number of rows read by the last update.
+        """
+        self.last_rows = 0
+
+    @property
+    def sui_list(self):
+        return list(self.sui_index)
+
+    def update(self, var=None):
+        """
+        Scan the lines added to the file since the last update. The file is scanned again from the start when it was
+        changed other than by appending, or when the minimum of a different variable is needed.
+        :param var: The variable whose minimum is tracked, or None to keep the current one
+        :return: None; results are stored in self
+        """
+        if var is not None and var != self.var:
+            self.var = var
+            self.end = 0
+        if self.end > 0 and (os.path.getsize(self.filename) < self.end or
+                             prefix_hash(self.filename, self.end) != self.hash):
+            self.end = 0
+        if self.end == 0:
+            self.vars = []
+            self.sui_index = {}
+            self.minimums = {}
+        end = complete_end(self.filename)
+        self.last_rows = 0
+        with open(self.filename, 'rb') as f:
+            f.seek(self.end)
+            lines = read_lines(f, end)
+            if self.end == 0:
+                self.vars = read_header(lines)
+                if self.identifying_var not in self.vars:
+                    raise ValueError("Variable " + self.identifying_var + " not found in input file.")
+            var = self.var if self.var in self.vars and self.var != self.identifying_var else None
+            for chunk in read_chunks(lines, self.vars, self.chunk_rows):
+                self.last_rows += len(chunk[0])
+                columns = dict(zip(self.vars, chunk))
+                codes = encode_categories(columns[self.identifying_var], self.sui_index)
+                if var is None:
+                    continue
+                values, valid = convert_column(var, columns[var])
+                if values.dtype.kind == 'U':
+                    continue
+                if values.dtype == np.float64:
+                    valid &= ~np.isnan(values)
+                for code in np.unique(codes[valid]).tolist():
+                    minimum = values[valid & (codes == code)].min().item()
+                    self.minimums[code] = min(self.minimums.get(code, minimum), minimum)
+        self.end = end
+        self.hash = prefix_hash(self.filename, end)
+
+    def sui_minimum(self, var):
+        """
+        Find the smallest value of a column for each SUI, ignoring empty cells. Reads the file again when a different
+        variable is asked for.
+        :param var: The name of the column
+        :return: A dictionary of SUI to minimum value
+        """
+        if var != self.var:
+            self.update(var)
+        sui_list = self.sui_list
+        return {sui_list[code]: minimum for code, minimum in self.minimums.items()}
+
+
+class Reservoir:
+    """
+    A uniform random sample of at most `size` rows out of all the rows added (Vitter's algorithm R, applied a chunk at
+    a time).
+    """
+    def __init__(self, size, width, rng):
+        self.size = size
+        self.rng = rng
+        """
+        The number of rows added so far, and the sampled rows.
+        """
+        self.seen = 0
+        self.rows = np.zeros((0, width))
+
+    def add(self, rows):
+        """
+        Offer rows to the sample.
+        :param rows: A 2D array with one row per sample
+        :return: None
+        """
+        fill = min(max(self.size - len(self.rows), 0), len(rows))
+        if fill:
+            self.rows = np.concatenate((self.rows, rows[:fill]))
+            self.seen += fill
+            rows = rows[fill:]
+        if len(rows) == 0:
+            return
+        # row i of the chunk is the (seen + i + 1)-th row overall and replaces a random slot with probability
+        # size / (seen + i + 1)
+        slots = (self.rng.random(len(rows)) * (self.seen + np.arange(1, len(rows) + 1))).astype(np.int64)
+        chosen = slots < self.size
+        slots, rows = slots[chosen], rows[chosen]
+        # when a slot is chosen more than once in the chunk, the last row wins
+        slots, last = np.unique(slots[::-1], return_index=True)
+        self.rows[slots] = rows[::-1][last]
+        self.seen += len(chosen)
+
+
+def combine_samples(reservoirs, size, rng):
+    """
+    Draw a uniform sample of the union of several reservoirs: the number of rows taken from each is hypergeometric in
+    the number of rows it has seen, and those rows are a random subset of its sample.
+    :param reservoirs: The Reservoirs to combine
+    :param size: The largest number of rows to return
+    :param rng: The numpy Generator to draw with
+    :return: The sampled rows; every row of every reservoir, in order, if they have seen at most size rows together
+    """
+    seen = [reservoir.seen for reservoir in reservoirs]
+    if sum(seen) <= size:
+        return np.concatenate([reservoir.rows for reservoir in reservoirs])
+    counts = rng.multivariate_hypergeometric(seen, size)
+    return np.concatenate([reservoir.rows[rng.choice(len(reservoir.rows), count, replace=False)]
+                           for reservoir, count in zip(reservoirs, counts)])
+
+
+class SeriesState:
+    """
+    The streamed state of one (SUI, variable) series.
+    """
+    def __init__(self, rng):
+        """
+        Per-day totals of the values, and per-day counts of the samples where the value is missing.
+        """
+        self.present = DayBuckets()
+        self.missing = DayBuckets()
+        """
+        A sample of (duration, value) pairs for the scatter plot.
+        """
+        self.sample = Reservoir(STREAM_SAMPLE_SIZE, 2, rng)
+
+
+class StreamAggregator:
+    """
+    Folds chunks of rows into per-(SUI, variable, day) totals, applying the same selection as SeatReader.get_data.
+    Every SUI is kept, so that a later run can graph other SUI's from the same state.
+    """
+    def __init__(self, variables, identifying_var, independent_var, graph_vars, sui_starts, min_duration,
+                 hrv_min_duration, seed=0):
+        self.vars = variables
+        self.identifying_var = identifying_var
+        self.independent_var = independent_var
+        self.graph_vars = list(graph_vars)
+        self.sui_starts = dict(sui_starts)
+        self.min_duration = min_duration
+        self.hrv_min_duration = hrv_min_duration
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        """
+        The state of each series, by SUI then variable, and a sample of the durations of each SUI.
+        """
+        self.series = {}
+        self.durations = {}
+        """
+        The number of rows folded so far, the number of bytes of the file they came from and the hash of their ends
+        from prefix_hash.
+        """
+        self.rows = 0
+        self.end = 0
+        self.hash = None
+        """
+        The number of rows folded by the last call to add_file.
+        """
+        self.last_rows = 0
+
+    def can_continue(self, filename, identifying_var, independent_var, graph_vars, sui_starts, min_duration,
+                     hrv_min_duration):
+        """
+        Check whether the lines appended to a file can be folded into this state, rather than starting over.
+        :return: True if the state was made with the same options and the file was only appended to since
+        """
+        if (self.identifying_var, self.independent_var, self.min_duration, self.hrv_min_duration) != \
+                (identifying_var, independent_var, min_duration, hrv_min_duration):
+            return False
+        if any(var not in self.graph_vars for var in graph_vars):
+            return False
+        # the day of every sample is relative to the start of its SUI, so an earlier start moves every day
+        if independent_var in TIMESTAMP_VARS and \
+                any(sui_starts.get(sui) != start for sui, start in self.sui_starts.items()):
+            return False
+        return self.end == 0 or (os.path.getsize(filename) >= self.end and
+                                 prefix_hash(filename, self.end) == self.hash)
+
+    def add_file(self, filename, end, chunk_rows=STREAM_CHUNK_ROWS):
+        """
+        Fold the lines of a .csv file between the end of the previous call and the given offset.
+        :param filename: The path of the .csv file
+        :param end: The offset to read up to, at the end of a line
+        :param chunk_rows: The number of lines per chunk
+        :return: None
+        """
+        rows = self.rows
+        with open(filename, 'rb') as f:
+            f.seek(self.end)
+            # header lines are skipped by read_chunks
+            for chunk in read_chunks(read_lines(f, end), self.vars, chunk_rows):
+                self.add_chunk(chunk)
+        self.last_rows = self.rows - rows
+        self.end = end
+        self.hash = prefix_hash(filename, end)
+
+    def add_chunk(self, chunk):
+        """
+        Fold one chunk of rows.
+        :param chunk: A list of columns, each a tuple of strings
+        :return: None
+        """
+        self.rows += len(chunk[0])
+        columns = dict(zip(self.vars, chunk))
+        sui_index = {}
+        codes = encode_categories(columns[self.identifying_var], sui_index)
+        chunk_suis = list(sui_index)
+        duration, _ = convert_column('clinical.duration', columns['clinical.duration'])
+        x_values, _ = convert_column(self.independent_var, columns[self.independent_var])
+        if self.independent_var in TIMESTAMP_VARS:
+            starts = np.array([self.sui_starts.get(sui, 0) for sui in chunk_suis], dtype=np.int64)
+            x_values = (x_values - starts[codes]) / (60 * 60 * 24)
+        # an empty or unparsable x is NaN, which has no day; such rows are left out of the totals, but not of the
+        # duration samples
+        finite = np.isfinite(x_values)
+        days = np.floor(np.where(finite, x_values, 0)).astype(np.int64)
+        values = {var: convert_column(var, columns[var]) for var in self.graph_vars}
+
+        for code, sui in enumerate(chunk_suis):
+            if sui not in self.series:
+                self.series[sui] = {var: SeriesState(self.rng) for var in self.graph_vars}
+                self.durations[sui] = Reservoir(STREAM_SAMPLE_SIZE, 1, self.rng)
+            rows = np.flatnonzero(codes == code)
+            rows = rows[duration[rows] >= self.min_duration]
+            self.durations[sui].add(duration[rows, None])
+            for var in self.graph_vars:
+                state = self.series[sui][var]
+                var_rows = rows
+                if var == 'clinical.hrv':
+                    var_rows = rows[duration[rows] >= self.hrv_min_duration]
+                y, valid = values[var]
+                present = var_rows[valid[var_rows]]
+                missing = var_rows[~valid[var_rows]]
+                dated = present[finite[present]]
+                state.present.add(days[dated], y[dated])
+                state.missing.count(days[missing[finite[missing]]])
+                state.sample.add(np.column_stack((duration[present], y[present])))
+
+    def condense(self, sui, var, window, show_missing):
+        """
+        Aggregate one series with a sliding window, like SeatReader.condense_data.
+        :param sui: The SUI
+        :param var: The variable
+        :param window: The width of the window, in days
+        :param show_missing: When true, the share of missing values in the window of each day is computed
+        :return: The days, the mean and standard deviation of each day, and the missing share times the mean
+        """
+        if sui not in self.series or len(self.series[sui][var].present) == 0:
+            return [], [], [], []
+        state = self.series[sui][var]
+        days, counts, means, std = state.present.window(window)
+        count_missing = np.zeros(len(days), dtype=np.int64)
+        if show_missing:
+            count_missing = state.missing.window_counts(days, window)
+        missing = count_missing / (count_missing + counts) * means
+        return days.tolist(), means.tolist(), std.tolist(), missing.tolist()
+
+    def completeness(self, sui, var):
+        """
+        :return: How complete one series is, as aggregation.completeness reports it
+        """
+        if sui not in self.series:
+            return completeness(DayBuckets(), DayBuckets())
+        return completeness(self.series[sui][var].present, self.series[sui][var].missing)
+
+    def duration_samples(self, sui, var):
+        """
+        :return: The sampled durations and values of a series, sorted like SeatReader.get_data sorts them
+        """
+        if sui not in self.series:
+            return [], []
+        rows = self.series[sui][var].sample.rows
+        order = np.lexsort((rows[:, 1], rows[:, 0]))
+        return rows[order, 0].tolist(), rows[order, 1].tolist()
+
+    def general_durations(self, suis):
+        """
+        :param suis: The SUI's whose durations are combined
+        :return: A sample of the durations of those SUI's
+        """
+        reservoirs = [self.durations[sui] for sui in dict.fromkeys(suis) if sui in self.durations]
+        if not reservoirs:
+            return []
+        # a fresh generator, so that drawing the combined sample does not change the state that is saved
+        rng = np.random.default_rng(self.seed)
+        return combine_samples(reservoirs, STREAM_SAMPLE_SIZE, rng)[:, 0].tolist()
+
+
+def read_lines(f, end):
+    """
+    Read the lines of a file opened in binary mode, from its current position up to an offset.
+    :param f: The open file
+    :param end: The offset to stop at, at the end of a line
+    :return: A generator of the lines as strings
+    """
+    position = f.tell()
+    for line in f:
+        position += len(line)
+        if position > end:
+            return
+        yield line.decode()
+
+
+def complete_end(filename):
+    """
+    :param filename: The path of the file
+    :return: The offset just after the last newline of the file, or 0 if it has none
+    """
+    with open(filename, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - HASH_BLOCK, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+def prefix_hash(filename, end):
+    """
+    Identify the first bytes of a file, so that a change other than an append can be detected without reading all
+    of them.
+    :param filename: The path of the file
+    :param end: The number of bytes to identify
+    :return: A hash of the first megabyte and of the last megabyte before end
+    """
+    digest = hashlib.blake2b(str(end).encode())
+    with open(filename, 'rb') as f:
+        digest.update(f.read(min(end, HASH_BLOCK)))
+        if end > HASH_BLOCK:
+            f.seek(max(end - HASH_BLOCK, HASH_BLOCK))
+            digest.update(f.read(end - f.tell()))
+    return digest.hexdigest()
+
+
+def state_path(filename):
+    """
+    :param filename: The path of the .csv file
+    :return: The path of the file that saves its streamed state
+    """
+    return filename + STATE_SUFFIX
+
+
+def load_state(filename, identifying_var):
+    """
+    Load the streamed state of a .csv file.
+    :param filename: The path of the .csv file
+    :param identifying_var: The name of the variable that is unique for each SUI
+    :return: The StreamScan and StreamAggregator, or None if there is no usable state
+    """
+    # the state is only data, so a damaged or foreign file can at worst fail to load; any failure means a rebuild
+    try:
+        with np.load(state_path(filename), allow_pickle=False) as arrays:
+            header = json.loads(arrays["header"].tobytes().decode())
+            if header.get("version") != STATE_VERSION or header.get("path") != os.path.abspath(filename) or \
+                    header["scan"]["identifying_var"] != identifying_var:
+                return None
+            return scan_from_header(filename, header["scan"]), aggregator_from_state(header["aggregator"], arrays)
+    except Exception:
+        return None
+
+
+def save_state(filename, scan, aggregator):
+    """
+    Save the streamed state of a .csv file next to it, replacing the previous one at once. The state is a .npz file of
+    the per-day totals and samples of every series, concatenated, with a JSON header holding everything else.
+    :param filename: The path of the .csv file
+    :param scan: The StreamScan of the file
+    :param aggregator: The StreamAggregator of the file
+    :return: None
+    """
+    path = state_path(filename)
+    aggregator_header, arrays = aggregator_state(aggregator)
+    header = {"version": STATE_VERSION, "path": os.path.abspath(filename), "scan": scan_header(scan),
+              "aggregator": aggregator_header}
+    arrays["header"] = np.frombuffer(json.dumps(header).encode(), dtype=np.uint8)
+    with open(path + ".tmp", 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + ".tmp", path)
+
+
+def scan_header(scan):
+    """
+    :return: The state of a StreamScan, as JSON-compatible values
+    """
+    return {"identifying_var": scan.identifying_var, "chunk_rows": scan.chunk_rows, "vars": scan.vars,
+            "sui_list": scan.sui_list, "var": scan.var, "minimums": list(scan.minimums.items()), "end": scan.end,
+            "hash": scan.hash}
+
+
+def scan_from_header(filename, header):
+    """
+    :param filename: The path of the .csv file, which may have been named by another relative path when it was saved
+    :param header: The state of a StreamScan, from scan_header
+    :return: The StreamScan
+    """
+    scan = StreamScan(filename, header["identifying_var"], header["chunk_rows"])
+    scan.vars = header["vars"]
+    scan.sui_index = {sui: code for code, sui in enumerate(header["sui_list"])}
+    scan.var = header["var"]
+    scan.minimums = {code: minimum for code, minimum in header["minimums"]}
+    scan.end = header["end"]
+    scan.hash = header["hash"]
+    return scan
+
+
+"""
+The arrays of the DayBuckets saved for each series, and their types.
+"""
+BUCKET_ARRAYS = {"counts": np.int64, "sums": np.float64, "squares": np.float64}
+
+
+def aggregator_state(aggregator):
+    """
+    :return: The state of a StreamAggregator: a header of JSON-compatible values, and a dictionary of arrays holding
+    the buckets and samples of every series, concatenated in the order of the header
+    """
+    series = []
+    durations = []
+    # each list starts with an empty array, so there is something to concatenate without series
+    parts = {kind + "_" + name: [np.zeros(0, dtype=dtype)] for kind in ("present", "missing")
+             for name, dtype in BUCKET_ARRAYS.items()}
+    parts["samples"] = [np.zeros((0, 2))]
+    parts["durations"] = [np.zeros((0, 1))]
+    for sui, states in aggregator.series.items():
+        for var, state in states.items():
+            for kind, buckets in (("present", state.present), ("missing", state.missing)):
+                for name in BUCKET_ARRAYS:
+                    parts[kind + "_" + name].append(getattr(buckets, name))
+            parts["samples"].append(state.sample.rows)
+            series.append([sui, var, state.present.first_day, len(state.present), state.missing.first_day,
+                           len(state.missing), state.sample.seen, len(state.sample.rows)])
+        reservoir = aggregator.durations[sui]
+        parts["durations"].append(reservoir.rows)
+        durations.append([sui, reservoir.seen, len(reservoir.rows)])
+    arrays = {name: np.concatenate(values) for name, values in parts.items()}
+    header = {"vars": aggregator.vars, "identifying_var": aggregator.identifying_var,
+              "independent_var": aggregator.independent_var, "graph_vars": aggregator.graph_vars,
+              "sui_starts": aggregator.sui_starts, "min_duration": aggregator.min_duration,
+              "hrv_min_duration": aggregator.hrv_min_duration, "seed": aggregator.seed,
+              "rng": aggregator.rng.bit_generator.state, "rows": aggregator.rows, "end": aggregator.end,
+              "hash": aggregator.hash, "series": series, "durations": durations}
+    return header, arrays
+
+
+def aggregator_from_state(header, arrays):
+    """
+    :param header: The header of the state, from aggregator_state
+    :param arrays: The arrays of the state, from aggregator_state
+    :return: The StreamAggregator
+    """
+    aggregator = StreamAggregator(header["vars"], header["identifying_var"], header["independent_var"],
+                                  header["graph_vars"], header["sui_starts"], header["min_duration"],
+                                  header["hrv_min_duration"], header["seed"])
+    aggregator.rng.bit_generator.state = header["rng"]
+    aggregator.rows = header["rows"]
+    aggregator.end = header["end"]
+    aggregator.hash = header["hash"]
+    loaded = {name: arrays[name] for name in arrays.files if name != "header"}
+    offsets = dict.fromkeys(loaded, 0)
+
+    def take(name, length):
+        part = loaded[name][offsets[name]:offsets[name] + length]
+        if len(part) != length:
+            raise ValueError("The state is shorter than its header.")
+        offsets[name] += length
+        return part
+
+    for sui, var, present_first, present_length, missing_first, missing_length, seen, sampled in header["series"]:
+        state = SeriesState(aggregator.rng)
+        for kind, buckets, first_day, length in (("present", state.present, present_first, present_length),
+                                                 ("missing", state.missing, missing_first, missing_length)):
+            buckets.first_day = first_day
+            for name in BUCKET_ARRAYS:
+                setattr(buckets, name, take(kind + "_" + name, length))
+        state.sample.seen = seen
+        state.sample.rows = take("samples", sampled)
+        aggregator.series.setdefault(sui, {})[var] = state
+    for sui, seen, sampled in header["durations"]:
+        reservoir = Reservoir(STREAM_SAMPLE_SIZE, 1, aggregator.rng)
+        reservoir.seen = seen
+        reservoir.rows = take("durations", sampled)
+        aggregator.durations[sui] = reservoir
+    return aggregator
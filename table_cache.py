@@ -0,0 +1,210 @@
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from seat_table import SeatTable, merge_tables
+
+"""
+On-disk cache of parsed seat .csv files, so a file only has to be parsed once.
+
+The cache of data.csv lives next to it in data.csv.seatcache/: one .npy file per column and per validity mask, which are
+memory-mapped when the cache is loaded, and a manifest.json that identifies the source file by its path, size,
+modification time and a hash of its first and last megabyte. The cache is ignored and rebuilt as soon as any of those
+change.
+"""
+
+CACHE_SUFFIX = ".seatcache"
+MANIFEST = "manifest.json"
+"""
+Increment when the layout of the cache changes, so that old caches are rebuilt.
+"""
+CACHE_VERSION = 1
+"""
+The number of bytes hashed at the start and at the end of the source file.
+"""
+HASH_BLOCK = 1 << 20
+
+
+def cache_dir(filename):
+    """
+    :param filename: The path of the .csv file
+    :return: The path of the directory that caches it
+    """
+    return filename + CACHE_SUFFIX
+
+
+def file_identity(filename):
+    """
+    Identify the current contents of a file without reading all of it.
+    :param filename: The path of the file
+    :return: A dictionary of the file's absolute path, size, modification time and content hash
+    """
+    stat = os.stat(filename)
+    digest = hashlib.blake2b(str(stat.st_size).encode())
+    with open(filename, 'rb') as f:
+        digest.update(f.read(HASH_BLOCK))
+        if stat.st_size > HASH_BLOCK:
+            f.seek(max(stat.st_size - HASH_BLOCK, HASH_BLOCK))
+            digest.update(f.read(HASH_BLOCK))
+    return {
+        "path": os.path.abspath(filename),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+def read_table(filename, identifying_var="clinical.sui", use_cache=True, rebuild=False):
+    """
+    Read a seat .csv file, using its cache when it is up to date and refreshing the cache otherwise.
+    :param filename: The path of the .csv file
+    :param identifying_var: The name of the variable that is unique for each SUI
+    :param use_cache: When False, the cache is neither read nor written
+    :param rebuild: When True, the cache is rewritten even if it is up to date
+    :return: The SeatTable
+    """
+    if not use_cache:
+        return SeatTable.read_csv(filename, identifying_var)
+    # identify the file before parsing it, so a file that changes while it is parsed is not cached as up to date
+    identity = file_identity(filename)
+    if not rebuild:
+        table = load_table(filename, identity, identifying_var)
+        if table is not None:
+            return table
+    table = SeatTable.read_csv(filename, identifying_var)
+    try:
+        save_table(filename, identity, table)
+    except OSError as e:
+        print("Could not write the cache for " + filename + ": " + str(e))
+    return table
+
+
+def find_input_files(patterns):
+    """
+    Expand the input files given on the command line.
+    :param patterns: Paths of .csv files, glob patterns or directories, whose .csv files are all used
+    :return: The paths of the files, in the given order with the matches of each pattern sorted, without duplicates
+    """
+    filenames = {}
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(glob.escape(pattern), "*.csv")))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        if not matches:
+            raise ValueError("No input files match " + pattern + ".")
+        for filename in matches:
+            filenames.setdefault(os.path.abspath(filename), filename)
+    return list(filenames.values())
+
+
+def read_tables(filenames, identifying_var="clinical.sui", use_cache=True, rebuild=False, jobs=1):
+    """
+    Read several seat .csv files, each in its own worker process, and merge them into one table.
+    :param filenames: The paths of the .csv files
+    :param identifying_var: The name of the variable that is unique for each SUI
+    :param use_cache: When False, the caches are neither read nor written
+    :param rebuild: When True, the caches are rewritten even if they are up to date
+    :param jobs: The number of worker processes
+    :return: The merged SeatTable
+    """
+    if len(filenames) == 1:
+        return read_table(filenames[0], identifying_var, use_cache, rebuild)
+    arguments = [(filename, identifying_var, use_cache, rebuild) for filename in filenames]
+    if jobs == 1:
+        tables = [read_table(*args) for args in arguments]
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as executor:
+            tables = list(executor.map(read_table, *zip(*arguments)))
+    return merge_tables(tables, filenames)
+
+
+def load_table(filename, identity, identifying_var):
+    """
+    Load a table from the cache, with its columns memory-mapped.
+    :param filename: The path of the .csv file
+    :param identity: The current identity of the file, from file_identity
+    :param identifying_var: The name of the variable that is unique for each SUI
+    :return: The SeatTable, or None if there is no up-to-date cache
+    """
+    directory = cache_dir(filename)
+    try:
+        with open(os.path.join(directory, MANIFEST), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != CACHE_VERSION or manifest.get("source") != identity or \
+            manifest.get("identifying_var") != identifying_var:
+        return None
+
+    variables = manifest["vars"]
+    columns = {}
+    valid = {}
+    try:
+        for i, var in enumerate(variables):
+            valid[var] = np.load(os.path.join(directory, "valid_" + str(i) + ".npy"), mmap_mode='r')
+            if var != identifying_var:
+                columns[var] = np.load(os.path.join(directory, "column_" + str(i) + ".npy"), mmap_mode='r')
+        sui_codes = np.load(os.path.join(directory, "sui_codes.npy"), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return SeatTable(variables, columns, valid, identifying_var, sui_codes, manifest["sui_list"])
+
+
+def save_table(filename, identity, table):
+    """
+    Write a table to the cache of its source file. The manifest is removed first and written last, so an interrupted
+    write leaves no cache rather than a broken one. Each array is written to a new file that then replaces the old one,
+    so a process that has the old cache memory-mapped keeps reading the old file.
+    :param filename: The path of the .csv file
+    :param identity: The identity of the file when it was parsed, from file_identity
+    :param table: The SeatTable read from the file
+    :return: None
+    """
+    directory = cache_dir(filename)
+    manifest_path = os.path.join(directory, MANIFEST)
+    os.makedirs(directory, exist_ok=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    for i, var in enumerate(table.vars):
+        save_array(os.path.join(directory, "valid_" + str(i) + ".npy"), table.valid[var])
+        if var != table.identifying_var:
+            save_array(os.path.join(directory, "column_" + str(i) + ".npy"), table.columns[var])
+    save_array(os.path.join(directory, "sui_codes.npy"), table.sui_codes)
+
+    manifest = {
+        "version": CACHE_VERSION,
+        "source": identity,
+        "identifying_var": table.identifying_var,
+        "vars": table.vars,
+        "sui_list": table.sui_list,
+    }
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def save_array(path, array):
+    """
+    Save an array to a .npy file by replacing it, never by writing over it: overwriting a file in place would change
+    the contents of its memory maps, or cut them short.
+    :param path: The path of the .npy file
+    :param array: The array
+    :return: None
+    """
+    temporary = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            np.save(f, array)
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise